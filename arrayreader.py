@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Bounded memory reading of the arrays in HDF5 files.
+
+Full disk products have arrays of several thousand lines and columns, so
+the in-process operations read them in blocks of lines instead of loading
+whole arrays. Blocks are aligned with the HDF5 chunks of the arrays, so
+that each chunk is only decompressed once.
+
+Arrays stored contiguously and without compression can also be memory
+mapped, which lets the operating system page their data in and out as
+needed instead of copying it. Finding where an array's data starts in the
+file requires the h5py library, so memory mapping is only used when h5py
+is installed.
+"""
+
+import logging
+
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+tables = lazy_import("tablescompat")
+
+
+class ArrayReader(object):
+
+    def __init__(self, h5FilePath, blockLines=256, memoryMap=False):
+        """
+        Open an HDF5 file for reading its arrays.
+
+        Inputs:
+            h5FilePath - path to the HDF5 file.
+            blockLines - the number of lines of the blocks. For chunked
+                         arrays it is rounded down to a whole number of
+                         chunks, of at least one chunk.
+            memoryMap - a boolean. If True, contiguous uncompressed arrays
+                        are memory mapped when h5py is available.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.h5FilePath = h5FilePath
+        self.blockLines = blockLines
+        self.memoryMap = memoryMap
+        self.h5File = tables.openFile(h5FilePath)
+        self._memmaps = dict()
+
+    def close(self):
+        self._memmaps.clear()
+        self.h5File.close()
+
+    def read(self, arrayPath, window=None):
+        """
+        Read an array, or a window of it.
+
+        Inputs:
+            arrayPath - the path of the array in the HDF5 file.
+            window - a tuple with firstLine, firstCol, nLines, nCols. Indexes
+                     start at 0. Defaults to the whole array.
+
+        Returns: A numpy array. It is a read only view of the file when the
+        array is memory mapped and a copy otherwise.
+        """
+
+        arr = self._get_array(arrayPath)
+        if window is None:
+            return arr[:]
+        firstLine, firstCol, nLines, nCols = window
+        return arr[firstLine:firstLine + nLines, firstCol:firstCol + nCols]
+
+    def read_blocks(self, arrayPath, window=None):
+        """
+        Yield consecutive blocks of lines of an array, or a window of it.
+
+        Inputs:
+            arrayPath - the path of the array in the HDF5 file.
+            window - a tuple with firstLine, firstCol, nLines, nCols. Indexes
+                     start at 0. Defaults to the whole array.
+
+        Yields: Tuples with the index of the block's first line, relative to
+        the window, and a numpy array with the block.
+        """
+
+        arr = self._get_array(arrayPath)
+        if window is None:
+            window = (0, 0) + tuple(arr.shape[:2])
+        firstLine, firstCol, nLines, nCols = window
+        step = self.block_step(arrayPath)
+        # blocks start at chunk boundaries, except for the first one
+        blockStart = firstLine
+        while blockStart < firstLine + nLines:
+            blockEnd = min((blockStart // step + 1) * step, firstLine + nLines)
+            yield (blockStart - firstLine,
+                   arr[blockStart:blockEnd, firstCol:firstCol + nCols])
+            blockStart = blockEnd
+
+    def block_step(self, arrayPath):
+        """
+        Return the number of lines of the blocks of an array.
+        """
+
+        chunkshape = self.h5File.getNode(arrayPath).chunkshape
+        if chunkshape is None:
+            return self.blockLines
+        chunkLines = int(chunkshape[0])
+        return chunkLines * max(1, self.blockLines // chunkLines)
+
+    def _get_array(self, arrayPath):
+        """
+        Return a memory map of an array, if possible, or the pytables array.
+        """
+
+        if self.memoryMap:
+            if arrayPath not in self._memmaps:
+                self._memmaps[arrayPath] = self._memory_map(arrayPath)
+            if self._memmaps[arrayPath] is not None:
+                return self._memmaps[arrayPath]
+        return self.h5File.getNode(arrayPath)
+
+    def _memory_map(self, arrayPath):
+        """
+        Return a read only memory map of a contiguous uncompressed array.
+
+        Returns None if the array can not be memory mapped.
+        """
+
+        try:
+            import h5py
+        except ImportError:
+            self.logger.debug("h5py is not available. Not memory mapping")
+            return None
+        h5File = h5py.File(self.h5FilePath, "r")
+        try:
+            dataset = h5File[arrayPath]
+            if dataset.chunks is not None or dataset.compression is not None:
+                return None
+            offset = dataset.id.get_offset()
+            if offset is None:
+                # the array has no data written to the file
+                return None
+            self.logger.debug("Memory mapping %s" % arrayPath)
+            return np.memmap(self.h5FilePath, dtype=dataset.dtype, mode="r",
+                             offset=offset, shape=dataset.shape)
+        finally:
+            h5File.close()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Asyncio versions of the georeferencing operations, for event loop services.
+
+The blocking operations of H5Georef wait for each external GDAL and cs2cs
+command to finish before starting the next, so a thread can only drive one
+command at a time. The coroutines in this module run the external commands
+with asyncio's subprocesses instead, so a single thread can keep many of
+them running. The number of commands running at the same time is limited by
+a semaphore shared by everything that uses the same backend.
+
+Example:
+
+    backend = AsyncSubprocessBackend(maxConcurrency=8)
+    h5g = AsyncH5Georef("LST.h5", backend=backend)
+    georefs = await h5g.georef_gtif(h5g.get_sample_coords(), "georefs")
+    warps = await h5g.warp(georefs, "warped")
+
+or, for a list of files processed with the same parameters as the
+georef_hdf5.py script:
+
+    results = await process_files(fileList, georef_hdf5.make_params(...))
+
+This module requires python >= 3.5.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+import georef_hdf5
+from h5georef import H5Georef
+from gdalbackends import SubprocessBackend
+from geocache import GeometryCache
+from metrics import get_metrics
+from outputprofiles import get_profile
+
+
+class AsyncSubprocessBackend(SubprocessBackend):
+    """
+    A backend whose 'translate' and 'warp' methods are coroutines.
+
+    It runs the same external GDAL utility programs as SubprocessBackend.
+    """
+
+    name = "asyncio"
+
+    def __init__(self, maxConcurrency=4):
+        """
+        Inputs:
+            maxConcurrency - the maximum number of external commands that
+                             run at the same time.
+        """
+
+        super(AsyncSubprocessBackend, self).__init__()
+        self.maxConcurrency = maxConcurrency
+        self._semaphore = None
+
+    async def translate(self, options, srcPath, dstPath):
+        """
+        Run the 'gdal_translate' utility.
+        """
+
+        return await self._run_gdal_command(['gdal_translate'] + options +
+                                            [srcPath, dstPath])
+
+    async def warp(self, options, srcPath, dstPath):
+        """
+        Run the 'gdalwarp' utility.
+        """
+
+        return await self._run_gdal_command(['gdalwarp'] + options +
+                                            [srcPath, dstPath])
+
+    async def run_command(self, command, stdin=None):
+        '''
+        Run an external command and return its return code, stdout and stderr.
+
+        If 'stdin' is not None, it is written to the command's standard input.
+        The command waits for a free slot before starting.
+        '''
+
+        if self._semaphore is None:
+            # created on first use, so that it belongs to the running loop
+            self._semaphore = asyncio.Semaphore(self.maxConcurrency)
+        async with self._semaphore:
+            with get_metrics().timer("subprocess",
+                                     program=os.path.basename(command[0])):
+                newProcess = await asyncio.create_subprocess_exec(
+                        *command, stdin=asyncio.subprocess.PIPE,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE)
+                stdout, stderr = await newProcess.communicate(stdin)
+        return newProcess.returncode, stdout, stderr
+
+    async def _run_gdal_command(self, command):
+        self.logger.debug('command:\n\n%s\n' % command)
+        returnCode, stdout, stderr = await self.run_command(command)
+        self.logger.debug('stdout: %s' % stdout)
+        self.logger.debug('stderr: %s' % stderr)
+        self.logger.debug('returnCode: %s' % returnCode)
+        return returnCode == 0
+
+
+class AsyncH5Georef(H5Georef):
+    """
+    An H5Georef whose external commands are run as coroutines.
+
+    The 'georef_gtif', 'georef_and_warp' and 'warp' methods are coroutines
+    that process all the selected arrays concurrently. The other methods,
+    which run in-process, are inherited unchanged.
+    """
+
+    def __init__(self, h5FilePath, lazy=True, statsCache=None, backend=None,
+                 geometryCache=None, memoryMap=False, outputProfile=None,
+                 nativeType=False):
+        """
+        Inputs:
+            backend - an AsyncSubprocessBackend. A new one is created if it
+                      is None. Sharing a backend between instances shares
+                      its limit on the number of running commands.
+
+        See H5Georef for a description of the other arguments.
+        """
+
+        if backend is None:
+            backend = AsyncSubprocessBackend()
+        super(AsyncH5Georef, self).__init__(h5FilePath, lazy, statsCache,
+                                            backend, geometryCache, memoryMap,
+                                            outputProfile, nativeType)
+
+    async def georef_gtif(self, samplePoints, outFileDir=None,
+                          selectedArrays=None):
+        """
+        Create a georeferenced GeoTiff file for each of the selected arrays.
+
+        See H5Georef's 'georef_gtif' method.
+        """
+
+        if outFileDir is None:
+            outFileDir = os.getcwd()
+        selectedArrays = self._selected_arrays(selectedArrays)
+        outFileNames = [self._georef_file_name(arrayName, outFileDir) for
+                        arrayName in selectedArrays]
+        successes = await asyncio.gather(*[
+                self._timed("translate", arrayName,
+                            self.backend.translate(self._georef_options(
+                                    arrayName, samplePoints),
+                                    self._subdataset_name(arrayName),
+                                    outFileName)) for
+                arrayName, outFileName in zip(selectedArrays, outFileNames)])
+        successfullGeorefs = [outFileName for outFileName, success in
+                              zip(outFileNames, successes) if success]
+        self._count_bytes_written(successfullGeorefs, "translate")
+        return successfullGeorefs
+
+    async def georef_and_warp(self, samplePoints, outDir,
+                              projectionString=None, selectedArrays=None,
+                              warpOptions=None):
+        """
+        Georeference and warp the selected arrays in a single stage.
+
+        See H5Georef's 'georef_and_warp' method.
+        """
+
+        selectedArrays = self._selected_arrays(selectedArrays)
+        outFileNames = await asyncio.gather(*[
+                self._georef_and_warp_array(arrayName, samplePoints, outDir,
+                                            projectionString, warpOptions) for
+                arrayName in selectedArrays])
+        warpedFiles = [f for f in outFileNames if f is not None]
+        self._count_bytes_written(warpedFiles, "warp")
+        return warpedFiles
+
+    async def _georef_and_warp_array(self, arrayName, samplePoints, outDir,
+                                     projectionString, warpOptions):
+        baseName = "%s_%s" % (self._base_file_name(), arrayName)
+        vrtPath = self.backend.temp_path("%s.vrt" % baseName)
+        outFileName = os.path.join(outDir, "%s_warped.tif" % baseName)
+        try:
+            translateOptions = ['-of', 'VRT'] + \
+                    self._translate_options(arrayName, samplePoints)
+            if await self._timed("translate", arrayName,
+                                 self.backend.translate(translateOptions,
+                                 self._subdataset_name(arrayName),
+                                 vrtPath)) and \
+                    await self._timed("warp", arrayName,
+                                      self.backend.warp(self._warp_options(
+                                      arrayName, projectionString,
+                                      warpOptions), vrtPath, outFileName)):
+                return outFileName
+        finally:
+            with get_metrics().timer("cleanup"):
+                self.backend.remove_temp(vrtPath)
+        return None
+
+    async def warp(self, fileList, outDir, projectionString=None,
+                   warpOptions=None):
+        """
+        Warp the georeferenced files to the desired projection.
+
+        See H5Georef's 'warp' method.
+        """
+
+        outFileNames = [self._warped_file_name(filePath, outDir) for
+                        filePath in fileList]
+        arrayNames = [self._array_name_from_file(filePath) for filePath in
+                      fileList]
+        successes = await asyncio.gather(*[
+                self._timed("warp", arrayName,
+                            self.backend.warp(self._warp_options(arrayName,
+                                              projectionString, warpOptions),
+                                              filePath, outFileName)) for
+                arrayName, filePath, outFileName in zip(arrayNames, fileList,
+                                                        outFileNames)])
+        warpedFiles = [outFileName for outFileName, success in
+                       zip(outFileNames, successes) if success]
+        self._count_bytes_written(warpedFiles, "warp")
+        return warpedFiles
+
+    async def _timed(self, stage, arrayName, coroutine):
+        """
+        Await a coroutine of a stage, timing it as the blocking methods do.
+        """
+
+        with get_metrics().timer(stage, array=arrayName):
+            return await coroutine
+
+    async def get_east_north_cs2cs(self, lons, lats):
+        """
+        Convert a batch of latlon coordinates to geos coordinates with cs2cs.
+
+        See H5Georef's '_get_east_north_cs2cs' method.
+        """
+
+        cs2csCommand = ['cs2cs', '-f', '%.8f', self.latLongProj, '+to']
+        cs2csCommand += self.GEOSProjString.split()
+        stdin = "".join(["%s %s\n" % (lon, lat) for lon, lat in
+                        zip(lons, lats)])
+        returnCode, stdout, stderr = await self.backend.run_command(
+                cs2csCommand, stdin=stdin.encode("ascii"))
+        self.logger.debug('stderr: %s' % stderr)
+        eastings = []
+        northings = []
+        for outputLine in stdout.decode("ascii").strip().splitlines():
+            easting, northing = outputLine.split()[:2]
+            try:
+                eastings.append(float(easting))
+                northings.append(float(northing))
+            except ValueError:
+                # cs2cs outputs '*' for points it cannot transform
+                eastings.append(None)
+                northings.append(None)
+        return eastings, northings
+
+
+# held while a file is opened in an executor thread, as PyTables can't read
+# files from several threads at once
+_hdf5Lock = threading.Lock()
+
+def _open_file(hdf5FilePath, params, backend, geometryCache):
+    """
+    Open an HDF5 file and sample its GCPs, which blocks.
+
+    Returns: A tuple with the AsyncH5Georef, the GCPs and the warp options.
+    """
+
+    with _hdf5Lock:
+        h5g = AsyncH5Georef(hdf5FilePath, lazy=True, backend=backend,
+                            geometryCache=geometryCache,
+                            memoryMap=params["memoryMap"],
+                            outputProfile=get_profile(params["outputProfile"]),
+                            nativeType=params["nativeType"])
+    if params["bbox"] is not None:
+        h5g.set_bbox(params["bbox"], params["bboxProjection"])
+    samples = None
+    warpOptions = None
+    if params["georefMode"] == "gcp":
+        samples = h5g.get_sample_coords()
+    elif params["georefMode"] == "dense":
+        samples, warpOptions = georef_hdf5.get_dense_samples(h5g,
+                params["gcpMaxError"], params["gcpOrder"])
+    return h5g, samples, warpOptions
+
+async def process_file(hdf5FilePath, params, backend, geometryCache=None,
+                       executor=None):
+    """
+    Georeference and warp a single HDF5 file.
+
+    Inputs:
+        hdf5FilePath - path to the HDF5 file.
+        params - a dictionary with the processing parameters, as built by
+                 georef_hdf5's 'make_params' function.
+        backend - the AsyncSubprocessBackend that runs the GDAL commands.
+        geometryCache - a GeometryCache shared by the files.
+        executor - a concurrent.futures.ProcessPoolExecutor for the files
+                   that are processed in-process. A new one is created for
+                   the file if it is None.
+
+    Returns: A dictionary with the results of the processing, as returned by
+    georef_hdf5's 'process_file' function.
+
+    The numpy warp engine and the single read mode process the arrays
+    in-process, so they are run in a worker process instead, where they
+    don't block the loop and their metrics are kept apart from those of
+    the other files. Otherwise, the file is opened and its GCPs sampled in
+    the loop's default executor.
+    """
+
+    loop = asyncio.get_event_loop()
+    if params["warpEngine"] == "numpy" or params["singleRead"]:
+        if executor is None:
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                return await loop.run_in_executor(executor,
+                        georef_hdf5.process_file, hdf5FilePath, params)
+        return await loop.run_in_executor(executor, georef_hdf5.process_file,
+                                          hdf5FilePath, params)
+    result = {"file" : hdf5FilePath, "success" : False, "georefs" : [],
+              "warped" : [], "error" : None, "skipped" : False}
+    try:
+        logging.debug("Processing file %s..." % hdf5FilePath)
+        h5g, samples, warpOptions = await loop.run_in_executor(None,
+                _open_file, hdf5FilePath, params, backend, geometryCache)
+        if params["warpThreads"] is not None:
+            warpOptions = (warpOptions or []) + ['-multi', '-wo',
+                           'NUM_THREADS=%s' % params["warpThreads"]]
+        if params["singlePass"]:
+            warps = await h5g.georef_and_warp(samples, params["warpedDir"],
+                                              params["projectionString"],
+                                              params["datasets"], warpOptions)
+            numExpected = len(params["datasets"] or [None])
+        else:
+            georefs = await h5g.georef_gtif(samples, params["georefsDir"],
+                                            params["datasets"])
+            result["georefs"] = georefs
+            warps = await h5g.warp(georefs, params["warpedDir"],
+                                   params["projectionString"], warpOptions)
+            numExpected = len(georefs)
+        logging.debug("Warped files: %s" % warps)
+        result["warped"] = warps
+        result["success"] = len(warps) > 0 and len(warps) == numExpected
+    except Exception as err:
+        logging.exception("Error processing file %s" % hdf5FilePath)
+        result["error"] = "%s: %s" % (err.__class__.__name__, err)
+    return result
+
+async def process_files(fileList, params, maxConcurrency=4):
+    """
+    Georeference and warp a list of HDF5 files concurrently.
+
+    Inputs:
+        fileList - a list of paths to HDF5 files.
+        params - a dictionary with the processing parameters, as built by
+                 georef_hdf5's 'make_params' function.
+        maxConcurrency - the maximum number of external commands that run at
+                         the same time, for all the files.
+
+    Returns: A list with the result of processing each file, in the same
+    order as 'fileList'. See georef_hdf5's 'process_file' function.
+    """
+
+    georef_hdf5.create_output_dirs(params)
+    backend = AsyncSubprocessBackend(maxConcurrency)
+    geometryCache = GeometryCache(cacheDir=params["geometryCacheDir"])
+    executor = None
+    if params["warpEngine"] == "numpy" or params["singleRead"]:
+        executor = concurrent.futures.ProcessPoolExecutor(maxConcurrency)
+    try:
+        return await asyncio.gather(*[process_file(f, params, backend,
+                                                   geometryCache, executor) for
+                                      f in fileList])
+    finally:
+        if executor is not None:
+            executor.shutdown()
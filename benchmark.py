@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Benchmark the georeferencing stages on synthetic LSA-SAF HDF5 files.
+
+Synthetic files are generated for some of the LSA-SAF regions, up to the
+full MSG disk. They have the same attributes, datasets, data types and
+compression as the real products and their pixels outside the earth disk
+have the missing value, so the stages do the same amount of work as with
+real files.
+
+Each stage is run, and timed, in a new process, so that the peak memory
+of the process, and of the GDAL programs it runs, can be measured for that
+stage alone. The results are saved as JSON and can be compared with the
+results of another revision:
+
+    benchmark.py -o new.json
+    benchmark.py -o new.json --compare old.json
+
+Stages that need the GDAL utility programs are skipped when they are not
+installed. Peak memory is not measured on Windows.
+
+The start up of the command line script, which is run very often by
+schedulers, has a time budget instead. It is checked with:
+
+    benchmark.py --startup
+
+which exits with an error status when importing the script takes longer
+than the budget or imports any of the heavy libraries.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import logging
+import platform
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+from subprocess import Popen, PIPE
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import tablescompat as tables
+from h5georef import H5Georef, __version__
+from rasterwriters import RawWriter
+
+# lines, columns and the line and column of the first pixel in the MSG disk,
+# approximating the areas of the LSA-SAF regions
+REGIONS = {
+    "Euro" : (651, 1701, 50, 1550),
+    "NAfr" : (1191, 1511, 700, 1240),
+    "SAfr" : (1101, 1301, 1850, 1790),
+    "SAme" : (1351, 1211, 1520, 40),
+    "MSG-Disk" : (3712, 3712, 0, 0),
+}
+
+# seconds that importing the command line script may add to the start up of
+# the python interpreter
+IMPORT_TIME_BUDGET = 0.1
+
+# libraries that the command line script must only import when they are used
+HEAVY_MODULES = ("numpy", "tables", "h5py", "osgeo", "PyQt4")
+
+# COFF, LOFF, CFAC and LFAC of the full MSG disk
+DISK_OFFSET = 1857
+DISK_FACTOR = 13642337
+
+# name, scaling factor and missing value of the synthetic datasets
+DATASETS = (
+    ("LST", 100.0, -8000),
+    ("errorbar_LST", 100.0, -8000),
+    ("Q_FLAGS", 1.0, 0),
+)
+
+
+def make_fixture(path, region, blockLines=256):
+    """
+    Create a synthetic LSA-SAF LST file for a region.
+
+    Inputs:
+        path - the path of the new HDF5 file.
+        region - the name of the region, one of the keys of REGIONS.
+        blockLines - the number of lines generated at a time.
+    """
+
+    nLines, nCols, firstLine, firstCol = REGIONS[region]
+    h5File = tables.openFile(path, "w")
+    try:
+        attrs = h5File.root._v_attrs
+        attrs.PRODUCT = "LST"
+        attrs.PROJECTION_NAME = "GEOS<+000.0>"
+        attrs.REGION_NAME = region
+        attrs.SATELLITE = "MSG2"
+        attrs.IMAGE_ACQUISITION_TIME = "201107011200"
+        attrs.COFF = DISK_OFFSET - firstCol
+        attrs.LOFF = DISK_OFFSET - firstLine
+        attrs.CFAC = DISK_FACTOR
+        attrs.LFAC = DISK_FACTOR
+        attrs.NC = nCols
+        attrs.NL = nLines
+        filters = tables.Filters(complevel=6, complib="zlib", shuffle=True)
+        arrays = []
+        for name, scalingFactor, missingValue in DATASETS:
+            arr = h5File.createCArray(h5File.root, name, tables.Int16Atom(),
+                                      (nLines, nCols), filters=filters)
+            arr._v_attrs.SCALING_FACTOR = scalingFactor
+            arr._v_attrs.MISSING_VALUE = missingValue
+            arr._v_attrs.N_COLS = nCols
+            arr._v_attrs.N_LINES = nLines
+            arrays.append(arr)
+        randomState = np.random.RandomState(0)
+        cols = np.arange(firstCol, firstCol + nCols)
+        for start in range(0, nLines, blockLines):
+            lines = np.arange(firstLine + start,
+                              min(firstLine + start + blockLines,
+                                  firstLine + nLines))[:, np.newaxis]
+            # scan angles, in degrees, from the sub-satellite point
+            x = (cols - DISK_OFFSET) * 2 ** 16 / float(DISK_FACTOR)
+            y = (lines - DISK_OFFSET) * 2 ** 16 / float(DISK_FACTOR)
+            onDisk = np.hypot(x, y) < 8.6
+            # a smooth temperature field, colder towards the poles, in K
+            lst = 300 - 3 * np.abs(y) + 5 * np.sin(x / 2.0) + \
+                  randomState.normal(0, 1, onDisk.shape)
+            values = (
+                np.where(onDisk, lst * 100, -8000),
+                np.where(onDisk, randomState.uniform(50, 400, onDisk.shape),
+                         -8000),
+                np.where(onDisk, randomState.randint(1, 255, onDisk.shape),
+                         0),
+            )
+            for arr, value in zip(arrays, values):
+                arr[start:start + lines.shape[0]] = value.astype(np.int16)
+    finally:
+        h5File.close()
+
+
+def _setup_open(path, workDir):
+    return lambda: H5Georef(path, lazy=True)
+
+def _setup_open_stats(path, workDir):
+    return lambda: H5Georef(path, lazy=False)
+
+def _setup_sample_coords(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    return h5g.get_sample_coords
+
+def _setup_dense_sample_coords(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    return h5g.get_dense_sample_coords
+
+def _setup_east_north(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    nLines, nCols = h5g._get_dimensions()
+    randomState = np.random.RandomState(0)
+    lons, lats = h5g.get_lat_lon(randomState.randint(0, nLines, 100000),
+                                 randomState.randint(0, nCols, 100000))
+    return lambda: h5g.get_east_north(lons, lats)
+
+def _setup_lat_lon_grid(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    return h5g.get_lat_lon_grid
+
+def _setup_georef_gtif(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    samples = h5g.get_sample_coords()
+    return lambda: h5g.georef_gtif(samples, workDir)
+
+def _setup_warp(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    georefs = h5g.georef_gtif(h5g.get_sample_coords(), workDir)
+    return lambda: h5g.warp(georefs, workDir)
+
+def _setup_extract_arrays(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    selectedArrays = [name for name, scalingFactor, missingValue in
+                      DATASETS]
+    return lambda: h5g.extract_arrays(None, workDir, selectedArrays,
+                                      writer=RawWriter())
+
+def _setup_resample(path, workDir):
+    h5g = H5Georef(path, lazy=True)
+    return lambda: h5g.resample(workDir, writer=RawWriter())
+
+# name, setup function and the external programs each stage needs. The
+# setup function returns the callable that is timed.
+STAGES = (
+    ("open", _setup_open, []),
+    ("open_stats", _setup_open_stats, []),
+    ("sample_coords", _setup_sample_coords, []),
+    ("dense_gcps", _setup_dense_sample_coords, []),
+    ("east_north", _setup_east_north, []),
+    ("lat_lon_grid", _setup_lat_lon_grid, []),
+    ("georef_gtif", _setup_georef_gtif, ["gdal_translate"]),
+    ("warp", _setup_warp, ["gdal_translate", "gdalwarp"]),
+    ("extract_arrays", _setup_extract_arrays, []),
+    ("resample", _setup_resample, []),
+)
+
+
+def _find_program(name):
+    """
+    Return True if an executable program is found in the PATH.
+    """
+
+    for dirPath in os.environ.get("PATH", "").split(os.pathsep):
+        for extension in ("", ".exe"):
+            if os.access(os.path.join(dirPath, name + extension), os.X_OK):
+                return True
+    return False
+
+def _peak_memory():
+    """
+    Return the peak memory, in kB, of this process and of its children.
+    """
+
+    if resource is None:
+        return None, None
+    scale = 1
+    if sys.platform == "darwin":
+        # macOS reports bytes instead of kB
+        scale = 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+def _run_stage(stageName, path, queue):
+    """
+    Run a stage in the current process and put its result in the queue.
+    """
+
+    setupFunction = dict((s[0], s[1]) for s in STAGES)[stageName]
+    workDir = tempfile.mkdtemp()
+    try:
+        # the same random sample points in every run
+        random.seed(0)
+        stageFunction = setupFunction(path, workDir)
+        startTime = time.time()
+        stageFunction()
+        elapsed = time.time() - startTime
+        peakMemory, childPeakMemory = _peak_memory()
+        queue.put({"seconds" : elapsed, "peakMemoryKB" : peakMemory,
+                   "childPeakMemoryKB" : childPeakMemory, "error" : None})
+    except Exception as err:
+        queue.put({"error" : "%s: %s" % (err.__class__.__name__, err)})
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+def run_stage(stageName, path):
+    """
+    Run a stage in a new process and return its timing and peak memory.
+    """
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stage,
+                                      args=(stageName, path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def run_benchmark(regions, stageNames, fixturesDir, repeat=3):
+    """
+    Run the stages on the fixtures of the regions.
+
+    Inputs:
+        regions - a list with the names of the regions.
+        stageNames - a list with the names of the stages.
+        fixturesDir - directory with the synthetic files. Missing files are
+                      created.
+        repeat - the number of times each stage is run.
+
+    Returns: A list of dictionaries, one for each region and stage, with
+    the times of each run, in seconds, and the largest peak memory, in kB.
+    """
+
+    results = []
+    for region in regions:
+        path = os.path.join(fixturesDir, "LST_%s.h5" % region)
+        if not os.path.isfile(path):
+            logging.info("Creating %s..." % path)
+            make_fixture(path, region)
+        for stageName, setupFunction, programs in STAGES:
+            if stageName not in stageNames:
+                continue
+            nLines, nCols = REGIONS[region][:2]
+            result = {"region" : region, "nLines" : nLines, "nCols" : nCols,
+                      "stage" : stageName, "times" : [],
+                      "peakMemoryKB" : None, "childPeakMemoryKB" : None,
+                      "error" : None}
+            missing = [p for p in programs if not _find_program(p)]
+            if len(missing) > 0:
+                result["error"] = "skipped, missing %s" % ", ".join(missing)
+            for i in range(repeat if len(missing) == 0 else 0):
+                run = run_stage(stageName, path)
+                if run["error"] is not None:
+                    result["error"] = run["error"]
+                    break
+                result["times"].append(run["seconds"])
+                for key in ("peakMemoryKB", "childPeakMemoryKB"):
+                    if run[key] is not None:
+                        result[key] = max(result[key] or 0, run[key])
+            if len(result["times"]) > 0:
+                result["min"] = min(result["times"])
+                result["median"] = float(np.median(result["times"]))
+            logging.info("%s %s: %s" % (region, stageName,
+                         result.get("median", result["error"])))
+            results.append(result)
+    return results
+
+def _time_command(command, repeat):
+    """
+    Run a command several times and return its median time and last output.
+    """
+
+    times = []
+    for i in range(repeat):
+        startTime = time.time()
+        process = Popen(command, stdout=PIPE, stderr=PIPE,
+                        cwd=os.path.dirname(os.path.abspath(__file__)))
+        stdout, stderr = process.communicate()
+        times.append(time.time() - startTime)
+        if process.returncode != 0:
+            raise RuntimeError("%s failed: %s" % (" ".join(command),
+                               stderr.decode("utf-8", "replace")))
+    return float(np.median(times)), stdout.decode("ascii").strip()
+
+def check_startup(repeat=5):
+    """
+    Measure the start up time of the command line script.
+
+    Each measure is the median of 'repeat' runs of a new python
+    interpreter, so that the modules are imported from scratch.
+
+    Returns: A dictionary with the time, in seconds, taken by an interpreter
+    that does nothing ('interpreter'), that imports georef_hdf5 ('import')
+    and that prints the script's help ('help'), the time that the import
+    adds to the interpreter's ('importOverhead'), the 'budget' for it, the
+    list of the 'heavyModules' loaded by the import and whether the start
+    up is 'withinBudget'.
+    """
+
+    interpreterTime = _time_command([sys.executable, "-c", "pass"],
+                                    repeat)[0]
+    code = "import sys, georef_hdf5; print(','.join([m for m in %r if " \
+           "m in sys.modules]))" % (HEAVY_MODULES,)
+    importTime, heavyModules = _time_command([sys.executable, "-c", code],
+                                             repeat)
+    helpTime = _time_command([sys.executable, "georef_hdf5.py", "-h"],
+                             repeat)[0]
+    heavyModules = [m for m in heavyModules.split(",") if m != ""]
+    overhead = importTime - interpreterTime
+    return {"interpreter" : interpreterTime, "import" : importTime,
+            "help" : helpTime, "importOverhead" : overhead,
+            "budget" : IMPORT_TIME_BUDGET, "heavyModules" : heavyModules,
+            "withinBudget" : overhead <= IMPORT_TIME_BUDGET and \
+                             len(heavyModules) == 0}
+
+def print_startup(result):
+    """
+    Print the result of the 'check_startup' function.
+    """
+
+    for key in ("interpreter", "import", "help", "importOverhead", "budget"):
+        print("%-15s %8.3f s" % (key, result[key]))
+    print("%-15s %s" % ("heavyModules", ", ".join(result["heavyModules"]) or
+                        "none"))
+    print("%-15s %s" % ("withinBudget", result["withinBudget"]))
+
+def _revision():
+    """
+    Return the git revision of the code, or None if it is unknown.
+    """
+
+    try:
+        process = Popen(["git", "describe", "--always", "--dirty"],
+                        stdout=PIPE, stderr=PIPE,
+                        cwd=os.path.dirname(os.path.abspath(__file__)))
+        stdout, stderr = process.communicate()
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return stdout.decode("ascii").strip()
+
+def print_results(results, previousResults=None):
+    """
+    Print a table with the results, compared with previous ones if given.
+    """
+
+    previous = dict()
+    if previousResults is not None:
+        previous = dict(((r["region"], r["stage"]), r) for r in
+                        previousResults)
+    print("%-10s %-15s %10s %12s %12s %10s" % ("region", "stage",
+          "median(s)", "peak(MB)", "gdal(MB)", "change"))
+    for result in results:
+        if "median" not in result:
+            print("%-10s %-15s %s" % (result["region"], result["stage"],
+                                      result["error"]))
+            continue
+        change = ""
+        old = previous.get((result["region"], result["stage"]))
+        if old is not None and old.get("median"):
+            change = "%+.1f%%" % (100.0 * (result["median"] / old["median"] -
+                                           1))
+        print("%-10s %-15s %10.3f %12s %12s %10s" % (result["region"],
+              result["stage"], result["median"],
+              _megabytes(result["peakMemoryKB"]),
+              _megabytes(result["childPeakMemoryKB"]), change))
+
+def _megabytes(kiloBytes):
+    if kiloBytes is None:
+        return "-"
+    return "%.1f" % (kiloBytes / 1024.0)
+
+def create_parser():
+    usage = """
+    Benchmark the georeferencing stages on synthetic HDF5 files.
+
+            %prog [options]
+
+    """
+    parser = OptionParser(usage=usage, version="%%prog %s" % __version__)
+    parser.add_option("-r", "--regions", dest="regions",
+                      help="Comma separated list of the regions to use."
+                      " Defaults to all: %s" % ",".join(sorted(REGIONS)),
+                      default=",".join(sorted(REGIONS)))
+    parser.add_option("-s", "--stages", dest="stages",
+                      help="Comma separated list of the stages to run."
+                      " Defaults to all: %s" % ",".join(s[0] for s in STAGES),
+                      default=",".join(s[0] for s in STAGES))
+    parser.add_option("-n", "--repeat", dest="repeat", type="int",
+                      help="Number of runs of each stage. Defaults to 3.",
+                      default=3)
+    parser.add_option("-f", "--fixtures-dir", dest="fixturesDir",
+                      help="Directory for the synthetic HDF5 files. They are"
+                      " created if missing and reused otherwise. Defaults"
+                      " to a temporary directory.", default=None)
+    parser.add_option("-o", "--output", dest="output",
+                      help="Path to a JSON file where the results are"
+                      " saved.", default=None)
+    parser.add_option("-c", "--compare", dest="compare",
+                      help="Path to the JSON results of a previous run,"
+                      " to compare with.", default=None)
+    parser.add_option("--startup", action="store_true", dest="startup",
+                      help="Check the start up time of the command line"
+                      " script against its budget, instead of running the"
+                      " stages. Exits with an error status when it is over"
+                      " budget.", default=False)
+    parser.add_option("-v", "--verbose", action="count", dest="verbose",
+                      help="Increase verbosity (specify "
+                      "multiple times for more)", default=1)
+    return parser
+
+if __name__ == "__main__":
+    parser = create_parser()
+    options, args = parser.parse_args(sys.argv[1:])
+    if options.verbose == 1:
+        logLevel = logging.INFO
+    elif options.verbose > 1:
+        logLevel = logging.DEBUG
+    logging.basicConfig(level=logLevel)
+    if options.startup:
+        startup = check_startup(max(options.repeat, 5))
+        print_startup(startup)
+        sys.exit(0 if startup["withinBudget"] else 1)
+    regions = options.regions.split(",")
+    unknown = [r for r in regions if r not in REGIONS]
+    if len(unknown) > 0:
+        parser.error("Unknown regions: %s" % unknown)
+    stageNames = options.stages.split(",")
+    unknown = [s for s in stageNames if s not in [st[0] for st in STAGES]]
+    if len(unknown) > 0:
+        parser.error("Unknown stages: %s" % unknown)
+    fixturesDir = options.fixturesDir
+    removeFixtures = fixturesDir is None
+    if removeFixtures:
+        fixturesDir = tempfile.mkdtemp()
+    elif not os.path.isdir(fixturesDir):
+        os.makedirs(fixturesDir)
+    try:
+        results = run_benchmark(regions, stageNames, fixturesDir,
+                                options.repeat)
+    finally:
+        if removeFixtures:
+            shutil.rmtree(fixturesDir, ignore_errors=True)
+    previousResults = None
+    if options.compare is not None:
+        fh = open(options.compare)
+        try:
+            previousResults = json.load(fh)["results"]
+        finally:
+            fh.close()
+    print_results(results, previousResults)
+    if options.output is not None:
+        report = {"revision" : _revision(), "version" : __version__,
+                  "python" : platform.python_version(),
+                  "platform" : platform.platform(),
+                  "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "repeat" : options.repeat, "results" : results}
+        fh = open(options.output, "w")
+        try:
+            json.dump(report, fh, indent=2)
+        finally:
+            fh.close()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Polynomial fits of GCPs, like those of GDAL's GCP transformer.
+
+When a file is georeferenced with GCPs, gdalwarp fits a polynomial that
+maps the GEOS coordinates of the output pixels to lines and columns of the
+source array. These functions fit the same kind of polynomial, so that the
+error of a set of GCPs can be measured, in pixels, before warping.
+
+The GCPs are tuples of line, column, northing and easting, as returned by
+H5Georef's 'get_sample_coords' method.
+"""
+
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+
+
+def num_terms(order):
+    """
+    Return the number of terms of a polynomial of the given order.
+
+    It is also the minimum number of GCPs needed to fit the polynomial.
+    """
+
+    return (order + 1) * (order + 2) // 2
+
+def _terms(xs, ys, order):
+    columns = []
+    for degree in range(order + 1):
+        for yPower in range(degree + 1):
+            columns.append(xs ** (degree - yPower) * ys ** yPower)
+    return np.column_stack(columns)
+
+def fit_polynomial(samplePoints, order=1):
+    """
+    Fit a polynomial from the GEOS coordinates to the lines and columns.
+
+    Inputs:
+        samplePoints - a sequence of line, col, northing, easting tuples.
+        order - the order of the polynomial, from 1 to 3, as in gdalwarp's
+                '-order' option.
+
+    Returns: A tuple with the fit's parameters, to pass to
+    'evaluate_polynomial'.
+    """
+
+    points = np.asarray(samplePoints, dtype=np.float64).reshape(-1, 4)
+    if len(points) < num_terms(order):
+        raise ValueError("A polynomial of order %i needs at least %i GCPs" %
+                         (order, num_terms(order)))
+    # centred and scaled coordinates keep the higher order terms from
+    # making the fit ill conditioned
+    center = points[:, 2:].mean(axis=0)
+    scale = max(np.abs(points[:, 2:] - center).max(), 1.0)
+    northings = (points[:, 2] - center[0]) / scale
+    eastings = (points[:, 3] - center[1]) / scale
+    coefficients = np.linalg.lstsq(_terms(eastings, northings, order),
+                                   points[:, :2], rcond=-1)[0]
+    return (order, center, scale, coefficients)
+
+def evaluate_polynomial(fit, northings, eastings):
+    """
+    Return the lines and columns given by a fit at some GEOS coordinates.
+
+    Inputs:
+        fit - the output of 'fit_polynomial'.
+        northings, eastings - numpy arrays with the coordinates.
+
+    Returns: A tuple of numpy arrays with the lines and columns.
+    """
+
+    order, center, scale, coefficients = fit
+    terms = _terms((np.ravel(eastings) - center[1]) / scale,
+                   (np.ravel(northings) - center[0]) / scale, order)
+    linesCols = np.dot(terms, coefficients)
+    return linesCols[:, 0], linesCols[:, 1]
+
+def fit_residuals(fit, checkPoints):
+    """
+    Return the distance, in pixels, between some points and a fit.
+
+    Inputs:
+        fit - the output of 'fit_polynomial'.
+        checkPoints - a sequence of line, col, northing, easting tuples.
+
+    Returns: A numpy array with the distance between the line and column of
+    each point and those that the fit gives at its GEOS coordinates.
+    """
+
+    points = np.asarray(checkPoints, dtype=np.float64).reshape(-1, 4)
+    lines, cols = evaluate_polynomial(fit, points[:, 2], points[:, 3])
+    return np.hypot(lines - points[:, 0], cols - points[:, 1])
+
+def fit_error(samplePoints, order=1, checkPoints=None):
+    """
+    Return the error of a polynomial fit of some GCPs.
+
+    Inputs:
+        samplePoints - a sequence of line, col, northing, easting tuples.
+        order - the order of the polynomial.
+        checkPoints - the points where the error is measured. Defaults to
+                      the GCPs themselves, which underestimates the error
+                      between them.
+
+    Returns: A tuple with the root mean square and the maximum error, in
+    pixels.
+    """
+
+    fit = fit_polynomial(samplePoints, order)
+    if checkPoints is None:
+        checkPoints = samplePoints
+    residuals = fit_residuals(fit, checkPoints)
+    return (float(np.sqrt(np.mean(residuals ** 2))),
+            float(residuals.max()))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Backends for running GDAL's translate and warp operations.
+
+A backend exposes 'translate' and 'warp' methods that receive the same
+options that would be given to the 'gdal_translate' and 'gdalwarp' utility
+programs, without the input and output file names, and return True if the
+operation has succeeded. Backends also provide paths for intermediate
+files through their 'temp_path' and 'remove_temp' methods.
+
+Available backends:
+    SubprocessBackend - Runs the external GDAL utility programs. The running
+                        programs can be killed with its 'cancel' method.
+    GDALBackend - Uses GDAL's python bindings to run the operations in the
+                  current process. It requires GDAL >= 2.1.
+"""
+
+import os
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+
+from metrics import get_metrics
+
+
+class SubprocessBackend(object):
+
+    name = "subprocess"
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cancelled = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Kill the running commands and make the next ones fail.
+
+        The backend stays cancelled until its 'reset' method is called. It
+        may be called from any thread.
+        """
+
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                try:
+                    process.kill()
+                except OSError:
+                    # the process has already finished
+                    pass
+
+    def reset(self):
+        """
+        Let a cancelled backend run commands again.
+        """
+
+        with self._lock:
+            self.cancelled = False
+
+    def translate(self, options, srcPath, dstPath):
+        """
+        Run the 'gdal_translate' utility.
+        """
+
+        return self._run_gdal_command(['gdal_translate'] + options +
+                                      [srcPath, dstPath])
+
+    def warp(self, options, srcPath, dstPath):
+        """
+        Run the 'gdalwarp' utility.
+        """
+
+        return self._run_gdal_command(['gdalwarp'] + options +
+                                      [srcPath, dstPath])
+
+    def temp_path(self, fileName):
+        """
+        Return a path, in a new temporary directory, for an intermediate file.
+        """
+
+        return os.path.join(tempfile.mkdtemp(), fileName)
+
+    def remove_temp(self, path):
+        """
+        Remove an intermediate file created with a path from 'temp_path'.
+        """
+
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def _run_gdal_command(self, command):
+        self.logger.debug('command:\n\n%s\n' % command)
+        returnCode, stdout, stderr = self._run_command(command)
+        self.logger.debug('stdout: %s' % stdout)
+        self.logger.debug('stderr: %s' % stderr)
+        self.logger.debug('returnCode: %s' % returnCode)
+        return returnCode == 0
+
+    def _run_command(self, command):
+        '''
+        Run an external command and return its return code, stdout and stderr.
+        '''
+
+        with self._lock:
+            if self.cancelled:
+                return -1, "", "cancelled"
+            newProcess = Popen(command, stdout=PIPE, stderr=PIPE)
+            self._processes.add(newProcess)
+        try:
+            with get_metrics().timer("subprocess",
+                                     program=os.path.basename(command[0])):
+                stdout, stderr = newProcess.communicate()
+        finally:
+            with self._lock:
+                self._processes.discard(newProcess)
+        return newProcess.returncode, stdout, stderr
+
+
+class GDALBackend(object):
+
+    name = "gdal"
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # importing here so that the subprocess backend does not require
+        # the GDAL python bindings to be installed
+        from osgeo import gdal
+        self.gdal = gdal
+        self.gdal.UseExceptions()
+
+    def translate(self, options, srcPath, dstPath):
+        """
+        Run GDAL's translate operation in the current process.
+        """
+
+        self.logger.debug('translate options:\n\n%s\n' % options)
+        return self._run(self.gdal.Translate, options, srcPath, dstPath)
+
+    def warp(self, options, srcPath, dstPath):
+        """
+        Run GDAL's warp operation in the current process.
+        """
+
+        self.logger.debug('warp options:\n\n%s\n' % options)
+        return self._run(self.gdal.Warp, options, srcPath, dstPath)
+
+    def temp_path(self, fileName):
+        """
+        Return a path in GDAL's in-memory filesystem for an intermediate file.
+        """
+
+        return "/vsimem/%s/%s" % (uuid.uuid4().hex, fileName)
+
+    def remove_temp(self, path):
+        """
+        Remove an intermediate file created with a path from 'temp_path'.
+        """
+
+        if self.gdal.VSIStatL(path) is not None:
+            self.gdal.Unlink(path)
+
+    def _run(self, operation, options, srcPath, dstPath):
+        try:
+            outDataset = operation(dstPath, srcPath, options=options)
+        except RuntimeError as err:
+            self.logger.error('GDAL error: %s' % err)
+            return False
+        success = outDataset is not None
+        # dereferencing the dataset closes it, flushing it to disk
+        outDataset = None
+        return success
+
+
+BACKENDS = {
+    SubprocessBackend.name : SubprocessBackend,
+    GDALBackend.name : GDALBackend,
+}
+
+def get_backend(name):
+    """
+    Return a new instance of the backend with the given name.
+    """
+
+    try:
+        backendClass = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Invalid backend: %s. Choose one of %s" %
+                         (name, sorted(BACKENDS.keys())))
+    return backendClass()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+A cache for the geometry shared by the HDF5 files of the same region.
+
+All the LSA-SAF files of a region (MSG-Disk, Euro, NAfr, SAfr, SAme) share
+the same sub-satellite longitude, COFF, LOFF, CFAC, LFAC and dimensions.
+The geometry that is derived from these parameters (GCPs, lat lon grids,
+pixel index maps, ...) is therefore the same for every file of a region and
+can be computed once and reused. H5Georef's 'geometry_key' method returns
+the key that identifies a region's geometry.
+
+Cached items are dictionaries of numpy arrays. They are kept in memory,
+with the least recently used items being evicted first, and optionally
+saved to disk as .npz files, so that they can be reused by other processes.
+A cache can be shared by several threads.
+"""
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+
+
+class GeometryCache(object):
+
+    def __init__(self, maxItems=16, cacheDir=None):
+        """
+        Inputs:
+            maxItems - the maximum number of items to keep in memory.
+            cacheDir - path to a directory where the items are saved. If
+                       None, items are only kept in memory.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.maxItems = maxItems
+        self.cacheDir = cacheDir
+        self._items = OrderedDict()
+        # guards '_items', which the threads of a pool share
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, itemName, computeFunction):
+        """
+        Return a cached item, computing and storing it if needed.
+
+        Inputs:
+            key - the geometry key of the region, as returned by H5Georef's
+                  'geometry_key' method.
+            itemName - a string identifying the item, such as 'latLonGrid'.
+            computeFunction - a callable that takes no arguments and returns
+                              the item, a dictionary of numpy arrays.
+        """
+
+        item = self.get(key, itemName)
+        if item is None:
+            self.logger.debug("Computing %s for %s" % (itemName, key))
+            item = computeFunction()
+            self.set(key, itemName, item)
+        return item
+
+    def get(self, key, itemName):
+        """
+        Return a cached item, or None if it is not in the cache.
+        """
+
+        itemKey = (key, itemName)
+        with self._lock:
+            item = self._items.get(itemKey)
+        if item is None and self.cacheDir is not None:
+            item = self._load(itemKey)
+        if item is not None:
+            self._remember(itemKey, item)
+        return item
+
+    def set(self, key, itemName, item):
+        """
+        Store an item in the cache.
+        """
+
+        itemKey = (key, itemName)
+        self._remember(itemKey, item)
+        if self.cacheDir is not None:
+            self._save(itemKey, item)
+
+    def clear(self):
+        """
+        Remove all the items from memory. Items saved to disk are kept.
+        """
+
+        with self._lock:
+            self._items.clear()
+
+    def _remember(self, itemKey, item):
+        """
+        Keep an item in memory, as the most recently used.
+        """
+
+        with self._lock:
+            # reinserting the item marks it as the most recently used
+            self._items.pop(itemKey, None)
+            self._items[itemKey] = item
+            while len(self._items) > self.maxItems:
+                self._items.popitem(last=False)
+
+    def _item_path(self, itemKey):
+        digest = hashlib.sha1(repr(itemKey).encode("utf-8")).hexdigest()
+        return os.path.join(self.cacheDir, "%s.npz" % digest)
+
+    def _load(self, itemKey):
+        path = self._item_path(itemKey)
+        if not os.path.isfile(path):
+            return None
+        self.logger.debug("Loading %s from %s" % (itemKey[1], path))
+        npzFile = np.load(path)
+        try:
+            item = dict((name, npzFile[name]) for name in npzFile.files)
+        finally:
+            npzFile.close()
+        return item
+
+    def _save(self, itemKey, item):
+        """
+        Save an item to disk.
+
+        The item is written to a temporary file which is then renamed, so
+        that concurrent processes never load a partially written item.
+        """
+
+        if not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                # another process may have just created it
+                if not os.path.isdir(self.cacheDir):
+                    raise
+        path = self._item_path(itemKey)
+        fd, tempPath = tempfile.mkstemp(dir=self.cacheDir, suffix=".npz")
+        fh = os.fdopen(fd, "wb")
+        try:
+            np.savez(fh, **item)
+        finally:
+            fh.close()
+        try:
+            os.rename(tempPath, path)
+        except OSError:
+            # windows does not allow renaming over an existing file
+            os.remove(path)
+            os.rename(tempPath, path)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+A daemon that georeferences the HDF5 files arriving in a directory.
+
+The daemon watches an input directory, using inotify when the pyinotify
+library is available and polling the directory otherwise. Files are only
+processed once they have stopped changing for a while, so that files that
+are still being written are left alone. Each new file is processed once, by
+a pool of worker processes, with the same processing as the georef_hdf5.py
+script, whose options are also accepted.
+
+A ledger of the processed files is kept in an SQLite database, so that a
+restarted daemon neither processes the same files again nor skips the
+files that arrived, or were being processed, while it was stopped. Files
+that fail are retried, up to a maximum number of attempts.
+"""
+
+import os
+import sys
+import time
+import fnmatch
+import logging
+import signal
+import sqlite3
+import multiprocessing
+
+import georef_hdf5
+
+
+class ProcessedLedger(object):
+    """
+    Persistent record of the files that have already been processed.
+
+    A file is identified by its path, modification time and size, so a file
+    that is replaced by a new version is processed again. A file that failed
+    is only done with once it has no attempts left.
+    """
+
+    def __init__(self, ledgerPath, maxAttempts=3):
+        """
+        Inputs:
+            ledgerPath - path to the SQLite database.
+            maxAttempts - the number of times that a file is processed
+                          before its failure is final.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.maxAttempts = maxAttempts
+        self.connection = sqlite3.connect(ledgerPath)
+        self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+                "success INTEGER, finished REAL, outputs TEXT, error TEXT, "
+                "attempts INTEGER)")
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(processed)")]
+        if "attempts" not in columns:
+            # a ledger written before failed files were retried
+            self.connection.execute("ALTER TABLE processed ADD COLUMN "
+                                    "attempts INTEGER DEFAULT 1")
+        self.connection.commit()
+
+    def _failed_attempts(self, path, mtime, size):
+        """
+        Return the number of times that a version of a file has failed, or
+        None if it has been processed successfully.
+        """
+
+        row = self.connection.execute(
+                "SELECT mtime, size, success, attempts FROM processed WHERE "
+                "path = ?", (path,)).fetchone()
+        if row is None or row[0] != mtime or row[1] != size:
+            return 0
+        if row[2]:
+            return None
+        return row[3]
+
+    def is_processed(self, path, mtime, size):
+        """
+        Return True if a version of a file has been processed successfully,
+        or has failed as many times as it is attempted.
+        """
+
+        attempts = self._failed_attempts(path, mtime, size)
+        return attempts is None or attempts >= self.maxAttempts
+
+    def record(self, path, mtime, size, result):
+        """
+        Record the result of processing a file.
+
+        Inputs:
+            path, mtime, size - identify the version of the file.
+            result - a dictionary, as returned by georef_hdf5's
+                     'process_file' function.
+        """
+
+        attempts = (self._failed_attempts(path, mtime, size) or 0) + 1
+        self.connection.execute(
+                "INSERT OR REPLACE INTO processed VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, mtime, size, int(result["success"]), time.time(),
+                 ";".join(result["warped"]), result["error"], attempts))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class PollingWatcher(object):
+    """
+    Find candidate files by listing the input directory periodically.
+    """
+
+    def __init__(self, inputDir, pattern, pollInterval):
+        self.inputDir = inputDir
+        self.pattern = pattern
+        self.pollInterval = pollInterval
+
+    def wait(self):
+        """
+        Wait for changes and return the paths of the candidate files.
+        """
+
+        time.sleep(self.pollInterval)
+        return self.list_files()
+
+    def list_files(self):
+        return [os.path.join(self.inputDir, name) for name in
+                sorted(os.listdir(self.inputDir)) if
+                fnmatch.fnmatch(name, self.pattern)]
+
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Find candidate files with inotify events.
+
+    Only the files that have been written to, or moved into, the input
+    directory are returned, so the directory needs not be listed.
+    """
+
+    def __init__(self, inputDir, pattern, pollInterval):
+        super(InotifyWatcher, self).__init__(inputDir, pattern, pollInterval)
+        import pyinotify
+        self.changedPaths = set()
+        watchManager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(watchManager, self._handle_event,
+                                           timeout=int(pollInterval * 1000))
+        watchManager.add_watch(inputDir, pyinotify.IN_CLOSE_WRITE |
+                               pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY)
+
+    def _handle_event(self, event):
+        if fnmatch.fnmatch(os.path.basename(event.pathname), self.pattern):
+            self.changedPaths.add(event.pathname)
+
+    def wait(self):
+        if self.notifier.check_events():
+            self.notifier.read_events()
+            self.notifier.process_events()
+        paths = sorted(self.changedPaths)
+        self.changedPaths.clear()
+        return paths
+
+
+class GeorefDaemon(object):
+
+    def __init__(self, inputDir, params, ledgerPath, pattern="*", jobs=1,
+                 settleTime=10, pollInterval=5, useInotify=True,
+                 maxAttempts=3):
+        """
+        Inputs:
+            inputDir - the directory to watch.
+            params - a dictionary with the processing parameters, as built
+                     by georef_hdf5's 'make_params' function.
+            ledgerPath - path to the SQLite database with the ledger of the
+                         processed files.
+            pattern - a shell-style pattern that the names of the files to
+                      process must match.
+            jobs - the number of files to process concurrently.
+            settleTime - number of seconds that a file must remain unchanged
+                         before being processed.
+            pollInterval - number of seconds between checks for new files.
+            useInotify - a boolean. If True and the pyinotify library is
+                         available, inotify is used to detect new files.
+            maxAttempts - the number of times that a file is processed
+                          before its failure is final. Failed files are
+                          attempted again after the settle time.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.inputDir = inputDir
+        self.params = params
+        self.ledgerPath = ledgerPath
+        self.ledger = None
+        self.maxAttempts = maxAttempts
+        self.jobs = jobs
+        self.settleTime = settleTime
+        self.watcher = None
+        if useInotify:
+            try:
+                self.watcher = InotifyWatcher(inputDir, pattern, pollInterval)
+            except ImportError:
+                self.logger.info("pyinotify is not available. Polling the "
+                                 "input directory.")
+        if self.watcher is None:
+            self.watcher = PollingWatcher(inputDir, pattern, pollInterval)
+        # path -> (mtime, size, time when it was last seen changing)
+        self.pending = dict()
+        # path -> (mtime, size, AsyncResult)
+        self.running = dict()
+        self.stopped = False
+
+    def run(self):
+        """
+        Process new files until the 'stop' method is called.
+        """
+
+        georef_hdf5.create_output_dirs(self.params)
+        self.ledger = ProcessedLedger(self.ledgerPath, self.maxAttempts)
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            # files that arrived while the daemon was not running
+            candidates = self.watcher.list_files()
+            while not self.stopped:
+                self._update_pending(candidates)
+                self._submit_settled(pool)
+                self._collect_results()
+                candidates = self.watcher.wait()
+        finally:
+            pool.close()
+            pool.join()
+            self._collect_results()
+            self.ledger.close()
+
+    def stop(self):
+        self.stopped = True
+
+    def _update_pending(self, candidates):
+        now = time.time()
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # the file has been removed in the meantime
+                self.pending.pop(path, None)
+                continue
+            fileVersion = (stat.st_mtime, stat.st_size)
+            if path in self.running or self.ledger.is_processed(path,
+                                                                *fileVersion):
+                continue
+            previous = self.pending.get(path)
+            if previous is None or previous[:2] != fileVersion:
+                self.pending[path] = fileVersion + (now,)
+        # with inotify, pending files are only reported when they change,
+        # so they are checked again here
+        for path in list(self.pending.keys()):
+            if path not in candidates:
+                self._update_pending_file(path, now)
+
+    def _update_pending_file(self, path, now):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            del self.pending[path]
+            return
+        fileVersion = (stat.st_mtime, stat.st_size)
+        if self.pending[path][:2] != fileVersion:
+            self.pending[path] = fileVersion + (now,)
+
+    def _submit_settled(self, pool):
+        now = time.time()
+        for path, (mtime, size, lastChange) in sorted(self.pending.items()):
+            if now - lastChange >= self.settleTime:
+                self.logger.info("Processing %s" % path)
+                del self.pending[path]
+                self.running[path] = (mtime, size, pool.apply_async(
+                        georef_hdf5.process_file, (path, self.params)))
+
+    def _collect_results(self):
+        for path, (mtime, size, asyncResult) in list(self.running.items()):
+            if asyncResult.ready():
+                del self.running[path]
+                try:
+                    result = asyncResult.get()
+                except Exception as err:
+                    result = {"file" : path, "success" : False,
+                              "georefs" : [], "warped" : [],
+                              "skipped" : False,
+                              "error" : "%s: %s" % (err.__class__.__name__,
+                                                    err)}
+                if result["success"]:
+                    # the latency is measured from the file's last change,
+                    # which is when it finished arriving
+                    self.logger.info("Processed %s in %.1f s: %s" % (path,
+                                     time.time() - mtime, result["warped"]))
+                else:
+                    self.logger.error("Failed to process %s: %s" % (path,
+                                      result["error"]))
+                self.ledger.record(path, mtime, size, result)
+                if not self.ledger.is_processed(path, mtime, size):
+                    # with inotify, an unchanged file is not reported again
+                    self.pending[path] = (mtime, size, time.time())
+
+
+def create_parser():
+    parser = georef_hdf5.create_parser()
+    parser.set_usage("""
+    Watch a directory and georeference the HDF5 files that arrive in it.
+
+            %prog [options] input_dir
+
+    """)
+    parser.add_option("--pattern", dest="pattern",
+                      help="Shell-style pattern that the names of the files"
+                      " to process must match. Defaults to '*'.",
+                      default="*")
+    parser.add_option("--ledger", dest="ledger",
+                      help="Path to the database with the ledger of the"
+                      " processed files. Defaults to"
+                      " <output_dir>/processed.sqlite", default=None)
+    parser.add_option("--settle-time", dest="settleTime", type="float",
+                      help="Number of seconds that a file must remain"
+                      " unchanged before being processed. Defaults to 10.",
+                      default=10)
+    parser.add_option("--poll-interval", dest="pollInterval", type="float",
+                      help="Number of seconds between checks for new files."
+                      " Defaults to 5.", default=5)
+    parser.add_option("--no-inotify", action="store_false",
+                      dest="useInotify",
+                      help="Poll the input directory even if inotify is"
+                      " available.", default=True)
+    parser.add_option("--max-attempts", dest="maxAttempts", type="int",
+                      help="Number of times that a file is processed before"
+                      " its failure is final. Defaults to 3.", default=3)
+    return parser
+
+if __name__ == "__main__":
+    parser = create_parser()
+    options, args = parser.parse_args(sys.argv[1:])
+    if len(args) != 1:
+        parser.error("Please specify the input directory.")
+    if options.verbose == 1:
+        logLevel = logging.INFO
+    elif options.verbose > 1:
+        logLevel = logging.DEBUG
+    logging.basicConfig(level=logLevel)
+    params = georef_hdf5.make_params(**georef_hdf5.options_to_kwargs(options))
+    ledgerPath = options.ledger
+    if ledgerPath is None:
+        ledgerPath = os.path.join(params["warpedDir"], "processed.sqlite")
+    georef_hdf5.create_output_dirs(params)
+    daemon = GeorefDaemon(args[0], params, ledgerPath, options.pattern,
+                          options.jobs, options.settleTime,
+                          options.pollInterval, options.useInotify,
+                          options.maxAttempts)
+    # finish the files being processed before exiting
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        logging.info("Stopping...")
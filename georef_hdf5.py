@@ -3,14 +3,26 @@
 
 """
 Script description goes here...
+
+This script is called very often by schedulers, so its module level imports
+are kept light: numpy and pytables are only imported by h5georef when they
+are first used, and the modules needed by some of the options only (the
+worker pool, the caches and the ledger of outputs) are imported by the
+functions that use them. Printing the help, listing the datasets or the
+geometry of a file and planning a run with --dry-run do not pay for them.
 """
 
 import sys
 from optparse import OptionParser
 import logging
 import os
+import json
 
-from h5georef import H5Georef
+from h5georef import H5Georef, __version__
+from gdalbackends import BACKENDS, get_backend
+from resample import METHODS
+from outputprofiles import PROFILES, get_profile
+from metrics import get_metrics, Aggregator, JSONLinesSink
 
 def create_parser():
     usage = """
@@ -19,7 +31,7 @@ def create_parser():
             %prog [options] [input_hdf5_file]
 
     """
-    parser = OptionParser(usage=usage, version="%prog 0.9")
+    parser = OptionParser(usage=usage, version="%%prog %s" % __version__)
     parser.add_option("-d", "--dataset", dest="datasetName",
                       help="Name of a specific dataset to process. If not"
                       " specified, only the main dataset will be processed.",
@@ -41,47 +53,818 @@ def create_parser():
                       dest="deleteGeorefs",
                       help="Delete intermediary georeferenced files.",
                       default=False)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="Number of files to process concurrently."
+                      " Defaults to 1.", default=1)
+    parser.add_option("-m", "--manifest", dest="manifest",
+                      help="Path to a JSON file where the results of"
+                      " processing each file are to be saved.",
+                      default=None)
+    parser.add_option("-b", "--backend", dest="backend",
+                      choices=sorted(BACKENDS.keys()),
+                      help="How to run the GDAL operations. 'subprocess'"
+                      " calls the gdal_translate and gdalwarp programs and"
+                      " 'gdal' uses GDAL's python bindings. Defaults to"
+                      " 'subprocess'.", default="subprocess")
+    parser.add_option("-t", "--warp-threads", dest="warpThreads",
+                      help="Number of threads that gdalwarp is to use, or"
+                      " ALL_CPUS. Defaults to single threaded warping.",
+                      default=None)
+    parser.add_option("-1", "--single-pass", action="store_true",
+                      dest="singlePass",
+                      help="Georeference and warp each dataset in a single"
+                      " stage, without writing intermediary georeferenced"
+                      " files.", default=False)
+    parser.add_option("-r", "--georef-mode", dest="georefMode",
+                      choices=["gcp", "dense", "exact"],
+                      help="How to georeference the datasets. 'gcp' uses"
+                      " randomly sampled GCPs, 'dense' uses GCPs spread over"
+                      " the visible disk, as many as needed for the fit"
+                      " error to be below --gcp-max-error, and 'exact' uses"
+                      " the geotransform defined by the file's header, which"
+                      " is reproducible and spares gdalwarp a GCP fit."
+                      " Defaults to 'gcp'.", default="gcp")
+    parser.add_option("--gcp-max-error", dest="gcpMaxError", type="float",
+                      help="The largest error, in pixels, of the fit of the"
+                      " GCPs of the 'dense' georeferencing mode. Defaults to"
+                      " 0.1.", default=0.1)
+    parser.add_option("--gcp-order", dest="gcpOrder",
+                      choices=["1", "2", "3"],
+                      help="Order of the polynomial that gdalwarp fits to"
+                      " the GCPs of the 'dense' georeferencing mode. Higher"
+                      " orders need fewer GCPs for the same fit error, but"
+                      " are slower to warp. Defaults to 1.", default="1")
+    parser.add_option("-G", "--geometry-cache", dest="geometryCache",
+                      help="Directory where the geometry shared by files of"
+                      " the same region (GCPs, coordinate grids, ...) is"
+                      " saved, so that it is computed only once. By default"
+                      " it is only kept in memory.", default=None)
+    parser.add_option("-w", "--warp-engine", dest="warpEngine",
+                      choices=["gdal", "numpy"],
+                      help="How to warp the datasets. 'gdal' uses GDAL's"
+                      " warp operation and 'numpy' resamples the datasets"
+                      " with precomputed index maps, which is faster when"
+                      " processing many files of the same region. Defaults"
+                      " to 'gdal'.", default="gdal")
+    parser.add_option("-R", "--resampling", dest="resampling",
+                      choices=list(METHODS),
+                      help="Resampling method of the 'numpy' warp engine."
+                      " Defaults to 'nearest'.", default="nearest")
+    parser.add_option("-S", "--single-read", action="store_true",
+                      dest="singleRead",
+                      help="Read all the datasets of each file in a single"
+                      " pass, instead of running gdal_translate once for each"
+                      " dataset. Requires GDAL's python bindings.",
+                      default=False)
+    parser.add_option("-M", "--multi-band", action="store_true",
+                      dest="multiBand",
+                      help="When used with --single-read, store all the"
+                      " datasets of a file as the bands of a single file.",
+                      default=False)
+    parser.add_option("-B", "--bbox", dest="bbox", type="float", nargs=4,
+                      metavar="MINX MINY MAXX MAXY",
+                      help="Bounding box of the region to process. Only the"
+                      " part of the datasets that covers it is read and"
+                      " warped.", default=None)
+    parser.add_option("-P", "--bbox-projection", dest="bboxProjection",
+                      help="Projection string of the bounding box's"
+                      " coordinates. Defaults to '+init=epsg:4326'.",
+                      default="+init=epsg:4326")
+    parser.add_option("-O", "--output-profile", dest="outputProfile",
+                      choices=sorted(PROFILES.keys()),
+                      help="Format, layout and compression of the output"
+                      " files: 'plain' GeoTiffs, as written by GDAL by"
+                      " default, 'tiled' GeoTiffs, tiled GeoTiffs compressed"
+                      " with 'deflate', 'lzw' or 'zstd', or Cloud Optimized"
+                      " GeoTiffs with overviews ('cog', requires GDAL >="
+                      " 3.1). Can not be used with --stack, whose cube is"
+                      " always written by pytables. Defaults to 'plain'.",
+                      default="plain")
+    parser.add_option("-N", "--native-type", action="store_true",
+                      dest="nativeType",
+                      help="Keep the datasets' integer values in the"
+                      " output files, with the scaling factor as their"
+                      " scale, instead of converting them to Float32"
+                      " physical values. The files georeferenced by GDAL"
+                      " require GDAL >= 2.3. Can not be used with --stack,"
+                      " whose cube always holds Float32 physical values.",
+                      default=False)
+    parser.add_option("--memory-map", action="store_true", dest="memoryMap",
+                      help="Memory map the datasets that are stored"
+                      " contiguously and without compression, when reading"
+                      " them in-process. Requires h5py.", default=False)
+    parser.add_option("--metrics", dest="metrics",
+                      help="Path to a file where the timers and counters of"
+                      " each stage are appended, as lines of JSON.",
+                      default=None)
+    parser.add_option("-i", "--incremental", action="store_true",
+                      dest="incremental",
+                      help="Skip the files whose outputs are up to date,"
+                      " according to the ledger of outputs, and record the"
+                      " outputs of the processed files.", default=False)
+    parser.add_option("--output-ledger", dest="outputLedger",
+                      help="Path to the ledger of outputs used by"
+                      " --incremental. Defaults to"
+                      " <output_dir>/georef_outputs.sqlite", default=None)
+    parser.add_option("--stack", dest="stack", metavar="CUBE",
+                      help="Warp the files, which must be slots of the same"
+                      " region, with the 'numpy' warp engine and stack them"
+                      " in a single HDF5 time series cube, at this path"
+                      " relative to the output directory. Slots are appended"
+                      " to an existing cube.", default=None)
+    parser.add_option("--time-chunk", dest="timeChunk", type="int",
+                      help="Number of slots in each chunk of the time series"
+                      " cube. The time series of a pixel is read with one"
+                      " chunk read for each this number of slots, but as"
+                      " many slots are held in memory while stacking."
+                      " Defaults to 32.", default=32)
+    parser.add_option("--list-datasets", action="store_true",
+                      dest="listDatasets",
+                      help="Print the datasets of each file and exit.",
+                      default=False)
+    parser.add_option("--stats", action="store_true", dest="stats",
+                      help="Print the datasets of each file, with the"
+                      " minimum, maximum and number of valid pixels of each"
+                      " dataset, and exit. The whole datasets are read.",
+                      default=False)
+    parser.add_option("-C", "--stats-cache", dest="statsCache",
+                      help="Path to a file where the statistics printed by"
+                      " --stats are cached, so that files that are listed"
+                      " again need not be read.", default=None)
+    parser.add_option("--print-geometry", action="store_true",
+                      dest="printGeometry",
+                      help="Print the geometry defined by the header of each"
+                      " file and exit.", default=False)
+    parser.add_option("-n", "--dry-run", action="store_true", dest="dryRun",
+                      help="Print which files would be processed, and which"
+                      " would be skipped, and exit. Only the headers of the"
+                      " files are read.", default=False)
     parser.add_option("-v", "--verbose", action="count", dest="verbose",
                       help="Increase verbosity (specify "
                       "multiple times for more)", default=1)
     return parser
 
-def main(fileList, georefsDir, warpedDir, projectionString):
-    logging.info("Starting execution...")
+# geometry caches of the current process, indexed by their directory
+_geometryCaches = dict()
+
+def _get_geometry_cache(cacheDir):
+    """
+    Return the current process' geometry cache for the given directory.
+
+    Keeping the caches at module level lets the files processed by the same
+    worker process share geometry, even when using a pool.
+    """
+
+    if cacheDir not in _geometryCaches:
+        from geocache import GeometryCache
+        _geometryCaches[cacheDir] = GeometryCache(cacheDir=cacheDir)
+    return _geometryCaches[cacheDir]
+
+def process_file(hdf5FilePath, params):
+    """
+    Georeference and warp a single HDF5 file.
+
+    Inputs:
+        hdf5FilePath - path to the HDF5 file.
+        params - a dictionary with the processing parameters, as built by
+                 the 'make_params' function.
+
+    Returns: A dictionary with the results of the processing. Any error
+    is caught and reported in the results, so that a failing file does not
+    affect the processing of the others. The 'metrics' key holds the
+    summary of the file's timers and counters (see metrics.Aggregator).
+    """
+
+    aggregator = Aggregator()
+    sinks = [aggregator]
+    if params["metricsPath"] is not None:
+        sinks.append(JSONLinesSink(params["metricsPath"]))
+    metrics = get_metrics()
+    try:
+        with metrics.using(*sinks):
+            with metrics.timer("file", file=os.path.basename(hdf5FilePath)):
+                result = _process_file(hdf5FilePath, params)
+    finally:
+        for sink in sinks[1:]:
+            sink.close()
+    result["metrics"] = aggregator.summary()
+    return result
+
+def _process_file(hdf5FilePath, params):
+    result = {"file" : hdf5FilePath, "success" : False, "georefs" : [],
+              "warped" : [], "error" : None, "skipped" : False}
+    try:
+        logging.debug("Processing file %s..." % hdf5FilePath)
+        h5g = H5Georef(hdf5FilePath, lazy=True,
+                       backend=get_backend(params["backend"]),
+                       geometryCache=_get_geometry_cache(
+                                params["geometryCacheDir"]),
+                       memoryMap=params["memoryMap"],
+                       outputProfile=get_profile(params["outputProfile"]),
+                       nativeType=params["nativeType"])
+        if params["bbox"] is not None:
+            h5g.set_bbox(params["bbox"], params["bboxProjection"])
+        samples = None
+        warpOptions = None
+        if params["georefMode"] == "gcp" and params["warpEngine"] == "gdal":
+            samples = h5g.get_sample_coords()
+            logging.debug("Sample points: %s" % [s for s in samples])
+        elif params["georefMode"] == "dense" and \
+                params["warpEngine"] == "gdal":
+            samples, warpOptions = get_dense_samples(h5g,
+                                                     params["gcpMaxError"],
+                                                     params["gcpOrder"])
+        if params["warpThreads"] is not None:
+            warpOptions = (warpOptions or []) + ['-multi', '-wo',
+                           'NUM_THREADS=%s' % params["warpThreads"]]
+        if params["warpEngine"] == "numpy":
+            logging.debug("Resampling...")
+            warps = h5g.resample(params["warpedDir"],
+                                 params["projectionString"],
+                                 params["datasets"], params["resampling"])
+            numExpected = len(params["datasets"] or [None])
+        elif params["singlePass"]:
+            logging.debug("Georeferencing and warping...")
+            warps = h5g.georef_and_warp(samples, params["warpedDir"],
+                                        params["projectionString"],
+                                        params["datasets"], warpOptions)
+            numExpected = len(params["datasets"] or [None])
+        else:
+            logging.debug("Georeferencing...")
+            if params["singleRead"]:
+                georefs = h5g.extract_arrays(samples, params["georefsDir"],
+                                             params["datasets"],
+                                             params["multiBand"])
+            else:
+                georefs = h5g.georef_gtif(samples, params["georefsDir"],
+                                          params["datasets"])
+            logging.debug("Georeferenced files: %s" % [f for f in georefs])
+            result["georefs"] = georefs
+            logging.debug("Warping...")
+            warps = h5g.warp(georefs, params["warpedDir"],
+                             params["projectionString"], warpOptions)
+            numExpected = len(georefs)
+        logging.debug("Warped files: %s" % [f for f in warps])
+        result["warped"] = warps
+        result["success"] = len(warps) > 0 and len(warps) == numExpected
+    except Exception as err:
+        logging.exception("Error processing file %s" % hdf5FilePath)
+        result["error"] = "%s: %s" % (err.__class__.__name__, err)
+    return result
+
+def get_dense_samples(h5g, maxError, order=1):
+    """
+    Return the GCPs of the 'dense' georeferencing mode and the warp options.
+
+    Inputs:
+        h5g - the H5Georef instance of the file.
+        maxError - the largest error, in pixels, of the fit of the GCPs.
+        order - the order of the polynomial fitted to the GCPs.
+
+    Returns: A tuple with the GCPs and a list with the warp options that
+    make gdalwarp use the polynomial order they were fitted with.
+    """
+
+    samples, (rmsError, maximumError) = h5g.get_dense_sample_coords(
+            maxError, order)
+    logging.info("%i GCPs, fit error: %.3g pixels (RMS), %.3g pixels (max)"
+                 % (len(samples), rmsError, maximumError))
+    if maximumError > maxError:
+        logging.warning("The GCPs' fit error is above %s pixels" % maxError)
+    return samples, ['-order', '%i' % order]
+
+def _process_file_star(args):
+    """
+    Unpack the arguments of 'process_file' when called from a pool.
+    """
+
+    return process_file(*args)
+
+def make_params(georefsDir, warpedDir, projectionString,
+                datasets=None, backend="subprocess",
+                warpThreads=None, singlePass=False, georefMode="gcp",
+                geometryCacheDir=None, warpEngine="gdal",
+                resampling="nearest", singleRead=False, multiBand=False,
+                bbox=None, bboxProjection=None, memoryMap=False,
+                metricsPath=None, outputProfile="plain", nativeType=False,
+                gcpMaxError=0.1, gcpOrder=1):
+    """
+    Return a dictionary with the processing parameters of 'process_file'.
+
+    Inputs:
+        georefsDir - output directory for the georeferenced files. Defaults
+                     to <warpedDir>/georefs.
+        warpedDir - output directory for the warped files.
+        projectionString - projection string of the warped files.
+        datasets - a list with the names of the datasets to process. If
+                   None, only the main dataset is processed.
+        backend - the name of the gdalbackends backend used to run the
+                  GDAL operations.
+        warpThreads - the number of threads used by each warp operation.
+        singlePass - a boolean. If True, the datasets are warped without
+                     writing intermediary georeferenced files.
+        georefMode - either 'gcp', to georeference the datasets with randomly
+                     sampled GCPs, 'dense', to use GCPs spread over the
+                     visible disk, or 'exact', to use the geotransform that
+                     is defined by the files' header.
+        geometryCacheDir - directory where the geometry shared by files of
+                           the same region is saved. If None, it is only
+                           kept in memory.
+        warpEngine - either 'gdal', to warp the datasets with GDAL, or
+                     'numpy', to resample them with precomputed index maps.
+                     The 'numpy' engine does not write intermediary
+                     georeferenced files.
+        resampling - the resampling method of the 'numpy' warp engine.
+        singleRead - a boolean. If True, all the datasets of a file are read
+                     in a single pass to create the georeferenced files.
+        multiBand - a boolean. If True, the datasets read in a single pass
+                    are stored as the bands of a single georeferenced file.
+        bbox - a tuple with the minimum x, minimum y, maximum x and maximum
+               y coordinates of the region to process. If None, the whole
+               datasets are processed.
+        bboxProjection - the projection string of the bbox's coordinates.
+        memoryMap - a boolean. If True, the datasets that are read
+                    in-process are memory mapped when possible.
+        metricsPath - path to a file where the timers and counters of each
+                      stage are appended, as lines of JSON.
+        outputProfile - the name of the outputprofiles profile of the
+                        output files.
+        nativeType - a boolean. If True, the output files keep the
+                     datasets' integer values, with the scaling factor as
+                     their scale.
+        gcpMaxError - the largest error, in pixels, of the fit of the GCPs
+                      of the 'dense' georeferencing mode.
+        gcpOrder - the order, from 1 to 3, of the polynomial fitted to the
+                   GCPs of the 'dense' georeferencing mode.
+    """
+
     if georefsDir is None:
         georefsDir = os.path.join(warpedDir, "georefs")
+    return {"georefsDir" : georefsDir, "warpedDir" : warpedDir,
+            "projectionString" : projectionString,
+            "datasets" : datasets,
+            "backend" : backend, "warpThreads" : warpThreads,
+            "singlePass" : singlePass, "georefMode" : georefMode,
+            "geometryCacheDir" : geometryCacheDir,
+            "warpEngine" : warpEngine, "resampling" : resampling,
+            "singleRead" : singleRead, "multiBand" : multiBand,
+            "bbox" : bbox, "bboxProjection" : bboxProjection,
+            "memoryMap" : memoryMap, "metricsPath" : metricsPath,
+            "outputProfile" : outputProfile, "nativeType" : nativeType,
+            "gcpMaxError" : gcpMaxError,
+            "gcpOrder" : gcpOrder}
+
+def options_to_kwargs(options):
+    """
+    Return the arguments of 'make_params' from the command line options.
+    """
+
+    datasets = None
+    if options.datasetName is not None:
+        datasets = [options.datasetName]
+    return {"georefsDir" : options.georefDir,
+            "warpedDir" : options.outputDir,
+            "projectionString" : options.projectionString,
+            "datasets" : datasets,
+            "backend" : options.backend, "warpThreads" : options.warpThreads,
+            "singlePass" : options.singlePass,
+            "georefMode" : options.georefMode,
+            "geometryCacheDir" : options.geometryCache,
+            "warpEngine" : options.warpEngine,
+            "resampling" : options.resampling,
+            "singleRead" : options.singleRead,
+            "multiBand" : options.multiBand, "bbox" : options.bbox,
+            "bboxProjection" : options.bboxProjection,
+            "memoryMap" : options.memoryMap,
+            "metricsPath" : options.metrics,
+            "outputProfile" : options.outputProfile,
+            "nativeType" : options.nativeType,
+            "gcpMaxError" : options.gcpMaxError,
+            "gcpOrder" : int(options.gcpOrder)}
+
+def output_settings(params):
+    """
+    Return the processing parameters that change the outputs.
+
+    Together with the selected datasets and the projection string, these
+    parameters decide whether recorded outputs are up to date. Parameters
+    that only change how fast the outputs are produced are left out.
+    """
+
+    names = ["georefMode", "warpEngine", "resampling", "singlePass",
+             "singleRead", "multiBand", "bbox", "bboxProjection",
+             "outputProfile", "nativeType"]
+    # the GCPs of the other modes don't depend on them
+    if params["georefMode"] == "dense":
+        names += ["gcpMaxError", "gcpOrder"]
+    return dict((name, params[name]) for name in names)
+
+def create_output_dirs(params):
+    """
+    Create the output directories needed by the processing parameters.
+    """
+
+    outputDirs = [params["warpedDir"]]
+    if not params["singlePass"] and params["warpEngine"] == "gdal":
+        outputDirs.append(params["georefsDir"])
+    for dirPath in outputDirs:
+        logging.debug("Creating directory: %s" % dirPath)
+        if not os.path.isdir(dirPath):
+            os.makedirs(dirPath)
+
+def main(fileList, georefsDir, warpedDir, projectionString,
+         deleteGeorefs=False, jobs=1, manifestPath=None, incremental=False,
+         outputLedgerPath=None, printSummary=False, **kwargs):
+    """
+    Georeference and warp a list of HDF5 files.
+
+    Inputs:
+        deleteGeorefs - a boolean. If True, the intermediary georeferenced
+                        files are deleted at the end.
+        jobs - the number of files to process concurrently. When greater
+               than 1 the files are processed by a pool of worker processes.
+        manifestPath - path to a JSON file where the results manifest is
+                       to be saved.
+        incremental - a boolean. If True, the files whose outputs are up to
+                      date are skipped and the outputs of the processed
+                      files are recorded, as soon as each file is done.
+        outputLedgerPath - path to the ledger of outputs used in incremental
+                           mode. Defaults to
+                           <warpedDir>/georef_outputs.sqlite.
+        printSummary - a boolean. If True, a table with the time spent in
+                       each stage, for all the files, is printed at the end.
+        kwargs - further processing parameters. See the 'make_params'
+                 function.
+
+    Returns: A list with the result of processing each file, in the same
+    order as 'fileList'. See the 'process_file' function. The results of
+    skipped files have their 'skipped' key set to True.
+    """
+
+    logging.info("Starting execution...")
+    params = make_params(georefsDir, warpedDir, projectionString, **kwargs)
+    georefsDir = params["georefsDir"]
     logging.debug("georefsDir: %s" % georefsDir)
     logging.debug("warpedDir: %s" % warpedDir)
     logging.debug("projectionString: %s" % projectionString)
     logging.debug("fileList: %s" % fileList)
-    for dirPath in (warpedDir, georefsDir):
-        logging.debug("Creating directory: %s" % dirPath)
-        if not os.path.isdir(dirPath):
-            os.makedirs(dirPath)
-    georefFiles = []
-    for hdf5FilePath in fileList:
-        logging.debug("Processing file %s..." % hdf5FilePath)
-        h5g = H5Georef(hdf5FilePath)
-        samples = h5g.get_sample_coords()
-        logging.debug("Sample points: %s" % [s for s in samples])
-        logging.debug("Georeferencing...")
-        georefs = h5g.georef_gtif(samples, georefsDir)
-        logging.debug("Georeferenced files: %s" % [f for f in georefs])
-        logging.debug("Warping...")
-        warps = h5g.warp(georefs, warpedDir, projectionString)
-        logging.debug("Warped files: %s" % [f for f in warps])
-        georefFiles += georefs
-    if options.deleteGeorefs:
+    create_output_dirs(params)
+    ledger = None
+    if incremental:
+        from outputledger import OutputLedger
+        if outputLedgerPath is None:
+            outputLedgerPath = _default_ledger_path(warpedDir)
+        ledger = OutputLedger(outputLedgerPath, __version__)
+    settings = output_settings(params)
+    results = dict()
+    pendingFiles = []
+    for filePath in fileList:
+        outputs = None
+        if ledger is not None:
+            outputs = ledger.get_outputs(filePath, params["datasets"],
+                                         projectionString, settings)
+        if outputs is None:
+            pendingFiles.append(filePath)
+        else:
+            logging.debug("Skipping up to date file %s" % filePath)
+            results[filePath] = {"file" : filePath, "success" : True,
+                                 "georefs" : [], "warped" : outputs,
+                                 "error" : None, "skipped" : True}
+    if ledger is not None:
+        logging.info("Skipping %i up to date files" % len(results))
+    pool = None
+    if jobs > 1:
+        import multiprocessing
+        logging.info("Processing files with %i workers..." % jobs)
+        pool = multiprocessing.Pool(jobs)
+        # chunksize=1 keeps the workers busy when some files take longer
+        processed = pool.imap(_process_file_star,
+                              [(f, params) for f in pendingFiles], 1)
+    else:
+        processed = (process_file(f, params) for f in pendingFiles)
+    try:
+        for result in processed:
+            results[result["file"]] = result
+            if ledger is None:
+                continue
+            # recording each file as it is done keeps the finished work when
+            # a run is interrupted
+            if result["success"]:
+                ledger.record(result["file"], result["warped"],
+                              params["datasets"], projectionString, settings)
+            else:
+                ledger.forget(result["file"])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if ledger is not None:
+            ledger.close()
+    manifest = [results[f] for f in fileList]
+    failed = [r["file"] for r in manifest if not r["success"]]
+    if len(failed) > 0:
+        logging.error("Failed to process %i files: %s" % (len(failed),
+                      failed))
+    if manifestPath is not None:
+        _save_manifest(manifest, manifestPath)
+    runAggregator = Aggregator()
+    for result in manifest:
+        if "metrics" in result:
+            runAggregator.merge(result["metrics"])
+    if deleteGeorefs:
         logging.info("About to delete intermediary files...")
-        for filePath in georefFiles:
-            logging.debug("Deleting %s" % filePath)
-            os.remove(filePath)
+        sinks = [runAggregator]
+        if params["metricsPath"] is not None:
+            sinks.append(JSONLinesSink(params["metricsPath"]))
+        metrics = get_metrics()
         try:
-            logging.debug("Deleting %s" % georefsDir)
-            os.rmdir(georefsDir)
-        except OSError:
-            logging.debug("Unable to delete the temporary files' directory.")
+            with metrics.using(*sinks):
+                with metrics.timer("cleanup"):
+                    _delete_georefs(manifest, georefsDir)
+        finally:
+            for sink in sinks[1:]:
+                sink.close()
+    if printSummary:
+        print(runAggregator.format_summary())
     logging.info("Done!")
+    return manifest
+
+def _save_manifest(manifest, manifestPath):
+    logging.debug("Saving results manifest to %s" % manifestPath)
+    fh = open(manifestPath, "w")
+    try:
+        json.dump(manifest, fh, indent=2)
+    finally:
+        fh.close()
+
+def stack(fileList, cubePath, georefsDir, warpedDir, projectionString,
+          timeChunk=32, manifestPath=None, **kwargs):
+    """
+    Warp many slots of a region and stack them in a time series cube.
+
+    The files are warped with the 'numpy' warp engine. They must share the
+    same geometry, so the index map that warps them is computed only once.
+    Slots are stacked in order of time, and those already in the cube are
+    skipped. See the timecube module for the cube's layout.
+
+    Inputs:
+        cubePath - path to the cube, relative to 'warpedDir'. If it exists,
+                   the slots are appended to it.
+        timeChunk - the number of slots in each chunk of the cube.
+        See the 'main' function for the other arguments. The 'resampling',
+        'datasets', 'bbox', 'bboxProjection', 'geometryCacheDir' and
+        'memoryMap' processing parameters are used. The cube always holds
+        float32 physical values, so 'nativeType' and an 'outputProfile'
+        other than 'plain' raise ValueError.
+
+    Returns: A list with the result of stacking each file, in the same
+    order as 'fileList'. Each result is a dictionary with the 'file' path,
+    the 'timestamp' of its slot, in seconds since 1970 UTC, whether it was
+    stacked with 'success', whether it was 'skipped', for slots already in
+    the cube, and the 'error' that made it fail.
+    """
+
+    from timecube import CubeWriter, slot_timestamp
+    logging.info("Starting execution...")
+    params = make_params(georefsDir, warpedDir, projectionString, **kwargs)
+    if params["nativeType"] or params["outputProfile"] != "plain":
+        raise ValueError("The time series cube can not be written with"
+                         " native types or an output profile")
+    if not os.path.isdir(warpedDir):
+        os.makedirs(warpedDir)
+    cubePath = os.path.join(warpedDir, cubePath)
+    geometryCache = _get_geometry_cache(params["geometryCacheDir"])
+    results = dict()
+    slots = []
+    for filePath in fileList:
+        result = {"file" : filePath, "timestamp" : None, "success" : False,
+                  "skipped" : False, "error" : None}
+        results[filePath] = result
+        try:
+            h5g = H5Georef(filePath, lazy=True, geometryCache=geometryCache,
+                           memoryMap=params["memoryMap"])
+            result["timestamp"] = slot_timestamp(filePath, h5g.acquisitionTime)
+        except Exception as err:
+            logging.exception("Error reading file %s" % filePath)
+            result["error"] = "%s: %s" % (err.__class__.__name__, err)
+            continue
+        slots.append((result["timestamp"], filePath, h5g))
+    slots.sort(key=lambda slot: slot[0])
+    cube = None
+    try:
+        for timestamp, filePath, h5g in slots:
+            result = results[filePath]
+            try:
+                if params["bbox"] is not None:
+                    h5g.set_bbox(params["bbox"], params["bboxProjection"])
+                datasets = h5g._selected_arrays(params["datasets"])
+                if cube is None:
+                    logging.debug("Opening cube %s..." % cubePath)
+                    targetGrid = h5g.get_output_grid(projectionString)
+                    cube = CubeWriter(cubePath, [(d,
+                            h5g.arrays[d]["missingValue"]) for d in
+                            datasets], targetGrid, projectionString,
+                            h5g.geometry_key(), timeChunk)
+                if h5g.geometry_key() != tuple(cube.header["geometryKey"]):
+                    raise ValueError("The file's geometry is different from "
+                                     "the cube's")
+                if cube.has_slot(timestamp):
+                    logging.debug("Skipping stacked file %s" % filePath)
+                    result["skipped"] = True
+                    result["success"] = True
+                    continue
+                logging.debug("Stacking file %s..." % filePath)
+                h5g.resample(warpedDir, projectionString, datasets,
+                             params["resampling"], targetGrid,
+                             cube.slot_writer())
+                cube.add_slot(timestamp, filePath)
+                result["success"] = True
+            except Exception as err:
+                logging.exception("Error stacking file %s" % filePath)
+                result["error"] = "%s: %s" % (err.__class__.__name__, err)
+    finally:
+        if cube is not None:
+            cube.close()
+    manifest = [results[f] for f in fileList]
+    failed = [r["file"] for r in manifest if not r["success"]]
+    if len(failed) > 0:
+        logging.error("Failed to stack %i files: %s" % (len(failed), failed))
+    if manifestPath is not None:
+        _save_manifest(manifest, manifestPath)
+    logging.info("Done!")
+    return manifest
+
+def _delete_georefs(manifest, georefsDir):
+    for result in manifest:
+        for filePath in result["georefs"]:
+            logging.debug("Deleting %s" % filePath)
+            os.remove(filePath)
+    try:
+        logging.debug("Deleting %s" % georefsDir)
+        os.rmdir(georefsDir)
+    except OSError:
+        logging.debug("Unable to delete the temporary files' directory.")
+
+def _default_ledger_path(warpedDir):
+    return os.path.join(warpedDir, "georef_outputs.sqlite")
+
+def describe_file(hdf5FilePath, stats=False, statsCache=None):
+    """
+    Return a dictionary with the datasets and geometry of an HDF5 file.
+
+    Inputs:
+        hdf5FilePath - path to the HDF5 file.
+        stats - a boolean. If True, the datasets are read to compute their
+                statistics.
+        statsCache - a statscache.StatsCache where the statistics are
+                     looked up before reading the datasets, and saved.
+
+    Returns: A dictionary with the 'file' path, a list with a dictionary
+    for each of the file's 'datasets', holding its name, dimensions,
+    scaling factor and missing value, and a 'geometry' dictionary, holding
+    the sub-satellite longitude, the COFF, LOFF, CFAC and LFAC parameters,
+    the GEOS projection string and the exact geotransform of the file. With
+    'stats', the datasets also hold their scaled 'min' and 'max' values and
+    the 'count' of valid pixels.
+
+    Without 'stats', only the file's header is read, so this is fast even
+    for full disk products.
+    """
+
+    h5g = H5Georef(hdf5FilePath, lazy=True, statsCache=statsCache)
+    datasets = []
+    for name, params in sorted(h5g.arrays.items()):
+        dataset = {"name" : name, "nLines" : int(params["nLines"]),
+                   "nCols" : int(params["nCols"]),
+                   "scalingFactor" : float(params["scalingFactor"]),
+                   "missingValue" : float(params["rawMissingValue"]),
+                   "main" : params.get("mainArray", False)}
+        if stats:
+            h5g.compute_stats(name)
+            dataset.update({"min" : params["min"], "max" : params["max"],
+                            "count" : params["count"]})
+        datasets.append(dataset)
+    nLines, nCols = h5g._get_dimensions()
+    geometry = {"subLon" : h5g.subLon, "coff" : float(h5g.coff),
+                "loff" : float(h5g.loff), "cfac" : float(h5g.cfac),
+                "lfac" : float(h5g.lfac), "nLines" : int(nLines),
+                "nCols" : int(nCols), "projection" : h5g.GEOSProjString,
+                "geotransform" : h5g.get_geotransform()}
+    return {"file" : hdf5FilePath, "datasets" : datasets,
+            "geometry" : geometry}
+
+def format_datasets(description):
+    """
+    Return a text table with the datasets of a file's description.
+    """
+
+    withStats = any(["count" in d for d in description["datasets"]])
+    header = "  %-20s %7s %7s %10s %10s" % ("dataset", "lines", "cols",
+                                             "scaling", "missing")
+    if withStats:
+        header += " %10s %10s %10s" % ("min", "max", "valid")
+    lines = [description["file"], header]
+    for dataset in description["datasets"]:
+        line = "  %-20s %7i %7i %10g %10g" % (dataset["name"],
+               dataset["nLines"], dataset["nCols"],
+               dataset["scalingFactor"], dataset["missingValue"])
+        if withStats:
+            line += " %10g %10g %10i" % (dataset["min"], dataset["max"],
+                                         dataset["count"])
+        lines.append(line + (" (main)" if dataset["main"] else ""))
+    return "\n".join(lines)
+
+def format_geometry(description):
+    """
+    Return the geometry of a file's description as text.
+    """
+
+    geometry = description["geometry"]
+    lines = [description["file"]]
+    for key in ("subLon", "coff", "loff", "cfac", "lfac", "nLines", "nCols",
+                "projection"):
+        lines.append("  %-12s %s" % (key, geometry[key]))
+    lines.append("  %-12s %s" % ("geotransform", ", ".join(["%.6f" % c for
+                 c in geometry["geotransform"]])))
+    return "\n".join(lines)
+
+def plan(fileList, georefsDir, warpedDir, projectionString, incremental=False,
+         outputLedgerPath=None, **kwargs):
+    """
+    Return what 'main' would do with a list of HDF5 files, without doing it.
+
+    Only the headers of the files are read and nothing is written: no
+    output directory is created and the ledger of outputs is only read,
+    when it exists.
+
+    Inputs:
+        See the 'main' function.
+
+    Returns: A list with a dictionary for each file, in the same order as
+    'fileList', with the 'file' path, the 'action' that would be taken
+    ('process', 'skip', for up to date files, or 'fail', for files that can
+    not be processed), the 'datasets' that would be processed, the
+    'geometryKey' of the file (see H5Georef's 'geometry_key' method) and
+    the 'error' that makes a file fail.
+    """
+
+    params = make_params(georefsDir, warpedDir, projectionString, **kwargs)
+    ledger = None
+    if incremental:
+        if outputLedgerPath is None:
+            outputLedgerPath = _default_ledger_path(warpedDir)
+        if os.path.isfile(outputLedgerPath):
+            from outputledger import OutputLedger
+            ledger = OutputLedger(outputLedgerPath, __version__)
+    settings = output_settings(params)
+    result = []
+    try:
+        for filePath in fileList:
+            item = {"file" : filePath, "action" : "process",
+                    "datasets" : [], "geometryKey" : None, "error" : None}
+            result.append(item)
+            try:
+                h5g = H5Georef(filePath, lazy=True)
+                item["geometryKey"] = h5g.geometry_key()
+                item["datasets"] = h5g._selected_arrays(params["datasets"])
+            except Exception as err:
+                item["action"] = "fail"
+                item["error"] = "%s: %s" % (err.__class__.__name__, err)
+                continue
+            missing = [d for d in item["datasets"] if d not in h5g.arrays]
+            if len(missing) > 0:
+                item["action"] = "fail"
+                item["error"] = "No such datasets: %s" % ", ".join(missing)
+            elif ledger is not None and ledger.get_outputs(filePath,
+                    params["datasets"], projectionString,
+                    settings) is not None:
+                item["action"] = "skip"
+    finally:
+        if ledger is not None:
+            ledger.close()
+    return result
+
+def format_plan(planned):
+    """
+    Return the result of the 'plan' function as text.
+    """
+
+    lines = []
+    for item in planned:
+        if item["action"] == "fail":
+            details = item["error"]
+        else:
+            details = ", ".join(item["datasets"])
+        lines.append("%-7s %s: %s" % (item["action"], item["file"], details))
+    counts = dict((action, len([i for i in planned if
+                  i["action"] == action])) for action in
+                  ("process", "skip", "fail"))
+    geometries = set([i["geometryKey"] for i in planned if
+                      i["action"] == "process"])
+    lines.append("%i files to process, with %i different geometries, %i up "
+                 "to date and %i failing" % (counts["process"],
+                 len(geometries), counts["skip"], counts["fail"]))
+    return "\n".join(lines)
 
 if __name__ == "__main__":
     parser = create_parser()
@@ -91,5 +874,33 @@ if __name__ == "__main__":
     elif options.verbose > 1:
         logLevel = logging.DEBUG
     logging.basicConfig(level=logLevel)
-    main(fileList, options.georefDir, options.outputDir,
-         options.projectionString)
+    if options.stack is not None and (options.nativeType or
+                                      options.outputProfile != "plain"):
+        parser.error("--native-type and --output-profile can not be used"
+                     " with --stack")
+    if options.statsCache is not None and not options.stats:
+        parser.error("--stats-cache can only be used with --stats")
+    if options.listDatasets or options.stats or options.printGeometry:
+        statsCache = None
+        if options.statsCache is not None:
+            from statscache import StatsCache
+            statsCache = StatsCache(options.statsCache)
+        for filePath in fileList:
+            description = describe_file(filePath, options.stats, statsCache)
+            if options.listDatasets or options.stats:
+                print(format_datasets(description))
+            if options.printGeometry:
+                print(format_geometry(description))
+    elif options.stack is not None:
+        stack(fileList, options.stack, timeChunk=options.timeChunk,
+              manifestPath=options.manifest, **options_to_kwargs(options))
+    elif options.dryRun:
+        print(format_plan(plan(fileList, incremental=options.incremental,
+                               outputLedgerPath=options.outputLedger,
+                               **options_to_kwargs(options))))
+    else:
+        main(fileList, deleteGeorefs=options.deleteGeorefs,
+             jobs=options.jobs, manifestPath=options.manifest,
+             incremental=options.incremental,
+             outputLedgerPath=options.outputLedger, printSummary=True,
+             **options_to_kwargs(options))
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+A worker that georeferences the HDF5 files of a shared job queue.
+
+Files are submitted to a queue (see the jobqueue module) along with the
+processing parameters of the georef_hdf5.py script, whose options are also
+accepted. Any number of workers, on any number of machines with access to
+the queue, the input files and the output directories, take jobs from the
+queue and process them, so that reprocessing campaigns can be spread across
+a cluster.
+
+Each job is leased by a single worker, which renews the lease while the job
+is running. The job of a worker that dies is leased by another worker once
+the lease expires, and failed jobs are retried. A file may therefore be
+processed more than once, so outputs are first written to private work
+directories and only then renamed into the output directories. An output
+is either absent or complete, and processing a file again replaces its
+outputs with identical ones.
+"""
+
+import os
+import re
+import sys
+import time
+import socket
+import shutil
+import signal
+import logging
+import multiprocessing
+
+import georef_hdf5
+from jobqueue import QUEUES, get_queue
+
+WORK_DIR_NAME = ".work"
+
+def process_job(filePath, params, workName, keepGeorefs=True):
+    """
+    Process a file, as georef_hdf5's 'process_file', with atomic outputs.
+
+    Inputs:
+        filePath - path to the HDF5 file.
+        params - a dictionary with the processing parameters, as built by
+                 georef_hdf5's 'make_params' function.
+        workName - the name of the job's work directories, which must be
+                   unique to each attempt.
+        keepGeorefs - a boolean. If False, the georeferenced files are
+                      deleted instead of being moved to their output
+                      directory.
+
+    Returns: The result of 'process_file', with the paths of the outputs
+    in their output directories.
+
+    The outputs are written to work directories inside the output
+    directories, so that they are in the same filesystem, and renamed into
+    the output directories if the file is processed successfully.
+    """
+
+    workParams = dict(params)
+    for key in ("warpedDir", "georefsDir"):
+        workParams[key] = os.path.join(params[key], WORK_DIR_NAME, workName)
+    try:
+        georef_hdf5.create_output_dirs(workParams)
+        result = georef_hdf5.process_file(filePath, workParams)
+        if result["success"]:
+            outputs = [("warped", "warpedDir")]
+            if keepGeorefs:
+                outputs.append(("georefs", "georefsDir"))
+            for resultKey, dirKey in outputs:
+                _publish(workParams[dirKey], params[dirKey])
+                result[resultKey] = [os.path.join(params[dirKey],
+                                     os.path.basename(p)) for p in
+                                     result[resultKey]]
+            if not keepGeorefs:
+                result["georefs"] = []
+    finally:
+        for key in ("warpedDir", "georefsDir"):
+            shutil.rmtree(workParams[key], ignore_errors=True)
+    return result
+
+def _publish(workDir, outDir):
+    """
+    Move the files of a work directory, with their sidecar files, to an
+    output directory, replacing existing files.
+    """
+
+    if not os.path.isdir(workDir):
+        return
+    for fileName in os.listdir(workDir):
+        filePath = os.path.join(workDir, fileName)
+        if os.path.isfile(filePath):
+            os.rename(filePath, os.path.join(outDir, fileName))
+
+def absolute_params(params):
+    """
+    Return the processing parameters with absolute paths.
+
+    Jobs are processed by workers that may run in other directories.
+    """
+
+    params = dict(params)
+    for key in ("georefsDir", "warpedDir", "geometryCacheDir",
+                "metricsPath"):
+        if params[key] is not None:
+            params[key] = os.path.abspath(params[key])
+    return params
+
+
+class QueueWorker(object):
+
+    def __init__(self, queue, jobs=1, leaseTime=600, pollInterval=5,
+                 exitWhenIdle=False, keepGeorefs=True, workerId=None):
+        """
+        Inputs:
+            queue - the jobqueue queue to take the jobs from.
+            jobs - the number of jobs to process concurrently.
+            leaseTime - number of seconds after which the lease of a job
+                        expires, unless it is renewed. Leases are renewed
+                        three times per lease time while the jobs are
+                        running.
+            pollInterval - number of seconds between checks for new jobs.
+            exitWhenIdle - a boolean. If True, the worker stops when the
+                           queue has no jobs to lease and its jobs are done.
+            keepGeorefs - a boolean. If False, the georeferenced files are
+                          deleted.
+            workerId - a name for the worker, which is recorded with the
+                       jobs it leases. Defaults to <host name>:<pid>.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.queue = queue
+        self.jobs = jobs
+        self.leaseTime = leaseTime
+        self.pollInterval = pollInterval
+        self.exitWhenIdle = exitWhenIdle
+        self.keepGeorefs = keepGeorefs
+        if workerId is None:
+            workerId = "%s:%i" % (socket.gethostname(), os.getpid())
+        self.workerId = workerId
+        # job id -> (job, AsyncResult, time when the lease was renewed)
+        self.running = dict()
+        self.stopped = False
+
+    def run(self):
+        """
+        Process jobs until the 'stop' method is called.
+
+        Once stopped, no more jobs are leased, but the running jobs are
+        finished.
+        """
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            while not self.stopped or len(self.running) > 0:
+                idle = True
+                if not self.stopped:
+                    idle = not self._lease_jobs(pool)
+                self._collect_results()
+                self._renew_leases()
+                if idle and len(self.running) == 0 and self.exitWhenIdle:
+                    break
+                self._wait()
+        finally:
+            pool.close()
+            pool.join()
+            self._collect_results()
+
+    def stop(self):
+        self.stopped = True
+
+    def _lease_jobs(self, pool):
+        """
+        Lease jobs until all the worker's slots are used.
+
+        Returns False if there are no jobs to lease.
+        """
+
+        while len(self.running) < self.jobs:
+            job = self.queue.lease(self.workerId, self.leaseTime)
+            if job is None:
+                return False
+            self.logger.info("Processing %s (attempt %i of %i)" %
+                             (job.filePath, job.attempts, job.maxAttempts))
+            workName = re.sub(r"[^\w.-]", "_", "%s-%s-%i" %
+                              (self.workerId, job.jobId, job.attempts))
+            self.running[job.jobId] = (job, pool.apply_async(process_job,
+                    (job.filePath, job.params, workName, self.keepGeorefs)),
+                    time.time())
+        return True
+
+    def _collect_results(self):
+        for jobId, (job, asyncResult, renewed) in list(self.running.items()):
+            if not asyncResult.ready():
+                continue
+            del self.running[jobId]
+            try:
+                result = asyncResult.get()
+            except Exception as err:
+                result = {"file" : job.filePath, "success" : False,
+                          "georefs" : [], "warped" : [], "skipped" : False,
+                          "error" : "%s: %s" % (err.__class__.__name__,
+                                                err)}
+            if result["success"]:
+                self.logger.info("Processed %s: %s" % (job.filePath,
+                                 result["warped"]))
+                recorded = self.queue.complete(job, result)
+            else:
+                self.logger.error("Failed to process %s: %s" %
+                                  (job.filePath, result["error"]))
+                recorded = self.queue.fail(job, result["error"])
+            if not recorded:
+                self.logger.warning("The lease of %s was lost. Its result "
+                                    "is left to the worker that leased it "
+                                    "again" % job.filePath)
+
+    def _renew_leases(self):
+        now = time.time()
+        for jobId, (job, asyncResult, renewed) in list(self.running.items()):
+            if now - renewed < self.leaseTime / 3.0:
+                continue
+            if not self.queue.renew(job, self.leaseTime):
+                self.logger.warning("The lease of %s was lost" %
+                                    job.filePath)
+            self.running[jobId] = (job, asyncResult, now)
+
+    def _wait(self):
+        """
+        Wait for a running job to finish, or for the poll interval.
+        """
+
+        if len(self.running) > 0:
+            job, asyncResult, renewed = list(self.running.values())[0]
+            asyncResult.wait(min(self.pollInterval, self.leaseTime / 3.0))
+        else:
+            time.sleep(self.pollInterval)
+
+
+def create_parser():
+    parser = georef_hdf5.create_parser()
+    parser.set_usage("""
+    Process the jobs of a queue of HDF5 files:
+
+            %prog [options] queue
+
+    Submit HDF5 files to a queue, with the processing options:
+
+            %prog [options] --submit queue input_hdf5_file ...
+
+    """)
+    parser.add_option("--queue-type", dest="queueType",
+                      choices=sorted(QUEUES.keys()),
+                      help="The type of the queue: 'sqlite', an SQLite"
+                      " database, or 'filesystem', a directory, for shared"
+                      " storage whose locks SQLite can not rely on, such as"
+                      " NFS. Defaults to 'sqlite'.", default="sqlite")
+    parser.add_option("--submit", action="store_true", dest="submit",
+                      help="Submit the input files to the queue.",
+                      default=False)
+    parser.add_option("--status", action="store_true", dest="status",
+                      help="Print the number of jobs in each state.",
+                      default=False)
+    parser.add_option("--max-attempts", dest="maxAttempts", type="int",
+                      help="Number of times that the submitted jobs are"
+                      " attempted before being given up. Defaults to 3.",
+                      default=3)
+    parser.add_option("--lease-time", dest="leaseTime", type="float",
+                      help="Number of seconds after which the job of a"
+                      " worker that stopped responding is given to another"
+                      " worker. Defaults to 600.", default=600)
+    parser.add_option("--poll-interval", dest="pollInterval", type="float",
+                      help="Number of seconds between checks for new jobs."
+                      " Defaults to 5.", default=5)
+    parser.add_option("--exit-when-idle", action="store_true",
+                      dest="exitWhenIdle",
+                      help="Stop when the queue has no more jobs, instead of"
+                      " waiting for new ones.", default=False)
+    return parser
+
+if __name__ == "__main__":
+    parser = create_parser()
+    options, args = parser.parse_args(sys.argv[1:])
+    if len(args) < 1:
+        parser.error("Please specify the queue.")
+    if options.verbose == 1:
+        logLevel = logging.INFO
+    elif options.verbose > 1:
+        logLevel = logging.DEBUG
+    logging.basicConfig(level=logLevel)
+    queue = get_queue(options.queueType, args[0])
+    try:
+        if options.submit:
+            params = absolute_params(georef_hdf5.make_params(
+                    **georef_hdf5.options_to_kwargs(options)))
+            for filePath in args[1:]:
+                queue.submit(os.path.abspath(filePath), params,
+                             options.maxAttempts)
+            logging.info("Submitted %i files" % len(args[1:]))
+        elif options.status:
+            counts = queue.counts()
+            for state in ("pending", "leased", "done", "failed"):
+                print("%-8s %i" % (state, counts[state]))
+        else:
+            worker = QueueWorker(queue, options.jobs, options.leaseTime,
+                                 options.pollInterval, options.exitWhenIdle,
+                                 not options.deleteGeorefs)
+            # finish the running jobs before exiting
+            signal.signal(signal.SIGTERM, lambda signum, frame:
+                          worker.stop())
+            try:
+                worker.run()
+            except KeyboardInterrupt:
+                logging.info("Stopping...")
+    finally:
+        queue.close()
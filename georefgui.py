@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+The PyQt4 dialog of the HDF5Georeferencer graphical interface.
+
+It is kept apart from the HDF5Georeferencer.py script so that the script
+can parse its arguments before paying for PyQt4's import.
+"""
+
+# TODO
+#
+#   - Use QMessageBox's property-based API instead of the static functions
+#   - Use validators for both browse... operations
+
+import logging
+import os
+import getpass
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+
+from h5georef import H5Georef
+from gdalbackends import SubprocessBackend
+from ui_HDF5Georeferencer import Ui_Form
+
+class HDF5Georeferencer(QDialog, Ui_Form):
+
+    def __init__(self, log="debug", parent=None):
+        """
+        ...
+        """
+
+        self.logger = create_logger(log, logName=self.__class__.__name__)
+        self.logger.debug("Starting execution")
+        super(HDF5Georeferencer, self).__init__(parent)
+        self.setupUi(self)
+        self.finishedStages = dict()
+        self.lastFilesDir = os.path.expanduser('~%s' % getpass.getuser())
+        self.lastOutputDir = os.path.expanduser('~%s' % getpass.getuser())
+        self.filePaths = []
+        self.datasetsLW.setSelectionMode(3) # multiple selection
+        self.progressBar.setVisible(False)
+        self.progressBar.setMaximum(100)
+        self.progressBar.setMinimum(0)
+        self.deleteIntermediaryCB.setChecked(True)
+        self.workersSB.setValue(min(multiprocessing.cpu_count(),
+                                    self.workersSB.maximum()))
+        self.cancelPB.setEnabled(False)
+        self.processingThread = GeoreferencerThread()
+        self.connect(self.processingThread, SIGNAL("finished(bool)"),
+                     self.finish_processing)
+        self.connect(self.processingThread, SIGNAL("processedFile(QString)"),
+                     self.update_progress)
+        self.connect(self.processingThread,
+                     SIGNAL("stageStarted(QString, QString)"),
+                     self.show_stage)
+        self.connect(self.processingThread,
+                     SIGNAL("stageFinished(QString, QString)"),
+                     self.update_stage_progress)
+        self.connect(self.cancelPB, SIGNAL("clicked()"), self.cancel_processing)
+        self.connect(self.inputFilesPB, SIGNAL("clicked()"), self.get_files)
+        self.connect(self.outputDirPB, SIGNAL("clicked()"), 
+                     self.select_output_dir)
+        self.connect(self.processFilesPB, SIGNAL("clicked()"), 
+                     self.process_files)
+        self.connect(self.loadFilePB, SIGNAL("clicked()"), self.get_datasets)
+        self.connect(self.wgs84RB, SIGNAL("toggled(bool)"),
+                     self.toggle_radio_buttons)
+        self.wgs84RB.setChecked(True)
+        self.enable_other_widgets(toggleState=False)
+
+    def toggle_widgets(self, widgetList, toggleState=True):
+        """Toggle widgets' enabled state."""
+
+        self.logger.debug("toggle_widgets method called.")
+        for wid in widgetList:
+            wid.setEnabled(toggleState)
+        self.logger.debug("toggle_widgets method exiting.")
+
+    def get_files(self):
+        self.logger.debug("get_files method called.")
+        filePaths = QFileDialog.getOpenFileNames(self, "Select HDF5 files", 
+                                                 directory=self.lastFilesDir)
+        if len(filePaths) > 0:
+            self.logger.debug("Some files have been selected.")
+            self.lastFilesDir = os.path.dirname(str(filePaths[0]))
+            self.inputFilesLE.setText(";".join([str(p) for p in filePaths]))
+        else:
+            self.logger.debug("No files have been selected.")
+            self.inputFilesLE.setText("")
+        self.logger.debug("get_files method exiting.")
+
+    def get_selected_file_paths(self):
+        self.logger.debug("get_selected_file_paths method called.")
+        self.logger.debug("get_selected_file_paths method exiting.")
+        return [str(s) for s in self.inputFilesLE.text().split(";")]
+
+    def get_datasets(self):
+        """Open one of the user selected files and extract dataset names."""
+
+        self.logger.debug("get_datasets method called.")
+        filePaths = self.get_selected_file_paths()
+        self.datasetsLW.clear()
+        try:
+            h5f = H5Georef(filePaths[0], lazy=True)
+            datasets = h5f.arrays.keys()
+            mainDataset = [name for name, params in h5f.arrays.items() \
+                           if params.get("mainArray")][0]
+            self.logger.info("datasets: %s" % datasets)
+            self.logger.info("main dataset: %s" % mainDataset)
+            for datasetName in datasets:
+                self.datasetsLW.addItem(datasetName)
+            if len(datasets) > 0:
+                self.enable_other_widgets(toggleState=True)
+            else:
+                self.enable_other_widgets(toggleState=False)
+                raise IOError("Invalid HDF5 file.\nCouldn't determine "
+                              "available datasets.")
+        except IOError, msg:
+            self.enable_other_widgets(toggleState=False)
+            self.logger.error(msg)
+            QMessageBox.critical(self, "Error", msg.args[0])
+        self.logger.debug("get_datasets method exiting.")
+
+    def toggle_radio_buttons(self):
+        self.logger.debug("toggle_radio_buttons method called.")
+        if self.wgs84RB.isChecked():
+            self.customProjectionTE.setEnabled(False)
+        else:
+            self.customProjectionTE.setEnabled(True)
+        self.logger.debug("toggle_radio_buttons method exiting.")
+
+    def enable_other_widgets(self, toggleState=True):
+        self.logger.debug("enable_other_widgets method called.")
+        widgetsToActUpon = (self.label_2, self.datasetsLW, self.label_4,
+                            self.wgs84RB, self.customProjRB,
+                            self.customProjectionTE, self.label_3,
+                            self.outputDirLE, self.outputDirPB,
+                            self.deleteIntermediaryCB, self.processFilesPB)
+        self.toggle_widgets(widgetsToActUpon, toggleState=toggleState)
+        self.logger.debug("enable_other_widgets method exiting.")
+
+    def select_output_dir(self):
+        self.logger.debug("select_output_dir method called.")
+        outputDir = QFileDialog.getExistingDirectory(self, "Select an output" \
+                                     " directory", 
+                                     directory=self.lastOutputDir)
+        self.logger.debug("outputDir: %s" % outputDir)
+        if outputDir:
+            self.logger.debug("There is an output directory selected.")
+            self.lastOutputDir = outputDir
+            self.outputDirLE.setText(outputDir)
+        else:
+            self.logger.debug("No output directory selected. Using current directory.")
+            self.outputDirLE.setText("")
+        self.logger.debug("select_output_dir method exiting.")
+
+    def get_selected_projection(self):
+        self.logger.debug("get_selected_projection method called.")
+        if self.wgs84RB.isChecked():
+            projectionString = "+proj=latlong"
+        else:
+            projectionString = str(self.customProjectionTE.toPlainText())
+        self.logger.debug("get_selected_projection method exiting.")
+        return projectionString
+
+    def process_files(self):
+        self.logger.debug("process_files method called.")
+        infoDict = self.get_necessary_info()
+        self.logger.info("infoDict: %s" % infoDict)
+        self.filePaths = infoDict["filePaths"]
+        self.finishedStages = dict((filePath, 0) for filePath in
+                                   self.filePaths)
+        self.progressBar.setValue(0)
+        self.progressBar.setMaximum(len(self.filePaths) *
+                                    len(GeoreferencerThread.stages))
+        self.progressBar.setVisible(True)
+        self.statusLabel.setText("")
+        self.processFilesPB.setEnabled(False)
+        self.cancelPB.setEnabled(True)
+        self.processingThread.initialize(infoDict)
+        self.processingThread.start()
+        self.logger.debug("process_files method exiting.")
+
+    def get_necessary_info(self):
+        self.logger.debug("get_necessary_info method called.")
+        filePaths = self.get_selected_file_paths()
+        datasets = [str(i.text()) for i in self.datasetsLW.selectedItems()]
+        projectionString = self.get_selected_projection()
+        outputDir = str(self.outputDirLE.text())
+        error = False
+        if len(filePaths) == 0:
+            error = True
+            msg = "No HDF5 files selected."
+        elif len(datasets) == 0:
+            error = True
+            msg = "No dataset selected."
+        elif outputDir == "":
+            error = True
+            msg = "No output directory specified."
+        elif projectionString == "":
+            error = True
+            msg = "No projection specified."
+        if error:
+            QMessageBox.critical(self, "Error", msg)
+        deleteIntermediary = self.deleteIntermediaryCB.isChecked()
+        numWorkers = self.workersSB.value()
+        self.logger.debug("get_necessary_info method exiting.")
+        return {"filePaths" : filePaths, "datasets" : datasets,
+                "projectionString" : projectionString, "outputDir" : outputDir,
+                "deleteIntermediary" : deleteIntermediary,
+                "numWorkers" : numWorkers}
+
+    def update_progress(self, filePath):
+        """
+        Update progress bar when files are processed by the secondary thread.
+
+        A file whose processing has stopped early counts as fully processed.
+        """
+
+        self.logger.debug("update_progress method called.")
+        self.finishedStages[str(filePath)] = len(GeoreferencerThread.stages)
+        self.progressBar.setValue(sum(self.finishedStages.values()))
+        self.logger.debug("update_progress method exiting.")
+
+    def update_stage_progress(self, filePath, stage):
+        """
+        Update progress bar when a stage of a file has been processed.
+        """
+
+        self.logger.debug("update_stage_progress method called.")
+        self.finishedStages[str(filePath)] += 1
+        self.progressBar.setValue(sum(self.finishedStages.values()))
+        self.logger.debug("update_stage_progress method exiting.")
+
+    def show_stage(self, filePath, stage):
+        """
+        Show the stage that the secondary thread has started on a file.
+        """
+
+        self.statusLabel.setText("%s: %s" % (stage,
+                                 os.path.basename(str(filePath))))
+
+    def cancel_processing(self):
+        self.logger.debug("cancel_processing method called.")
+        self.cancelPB.setEnabled(False)
+        self.statusLabel.setText("Cancelling...")
+        self.processingThread.cancel()
+        self.logger.debug("cancel_processing method exiting.")
+
+    def finish_processing(self, finishStatus):
+        """
+        Terminate the processing and inform the user.
+        """
+
+        self.logger.debug("finish_processing method called.")
+        self.logger.debug("finishStatus: %s" % finishStatus)
+        self.processFilesPB.setEnabled(True)
+        self.cancelPB.setEnabled(False)
+        self.statusLabel.setText("")
+        if self.processingThread.is_cancelled():
+            QMessageBox.warning(self, "Cancelled", "The processing of the"
+                                " files has been cancelled.")
+        elif finishStatus:
+            QMessageBox.information(self, "Success", "Files have been"
+                                    " processed successfully.")
+        else:
+            QMessageBox.critical(self, "Error", "there was an error"
+                                    " processing the files.")
+        self.progressBar.setVisible(False)
+        self.logger.debug("finish_processing method exiting.")
+
+
+class GeoreferencerThread(QThread):
+    """
+    Process files in the background, with a pool of worker threads.
+
+    The heavy work is done by the external GDAL programs, so worker threads
+    are enough to keep several files processing at the same time. PyTables
+    can not read HDF5 files from several threads at once, so the workers
+    take turns to open the files. Each stage of a file emits the 'stageStarted(QString, QString)' and
+    'stageFinished(QString, QString)' signals, with the path of the file and
+    the name of the stage. Cancelling kills the running GDAL programs and
+    stops the files that have not finished.
+    """
+
+    stages = ("gcps", "translate", "warp")
+    # held by the worker threads while they use PyTables
+    hdf5Lock = threading.Lock()
+
+    def __init__(self, parent=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        super(GeoreferencerThread, self).__init__(parent)
+        self.backend = SubprocessBackend()
+        self.cancelEvent = threading.Event()
+
+    def initialize(self, paramsDict):
+
+        self.logger.debug("initialize method called.")
+        self.filePaths = paramsDict["filePaths"]
+        self.datasets = paramsDict["datasets"]
+        self.outputDir = paramsDict["outputDir"]
+        self.projectionString = paramsDict["projectionString"]
+        self.numWorkers = paramsDict.get("numWorkers", 1)
+        self.cancelEvent.clear()
+        self.backend.reset()
+        self.logger.debug("initialize method exiting.")
+
+    def cancel(self):
+        """
+        Stop the processing. It may be called from any thread.
+        """
+
+        self.logger.debug("cancel method called.")
+        self.cancelEvent.set()
+        self.backend.cancel()
+        self.logger.debug("cancel method exiting.")
+
+    def is_cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def run(self):
+        self.logger.debug("run method called.")
+        processResults = self.process_files()
+        success = False
+        if not self.is_cancelled() and \
+                not False in [res.values()[0] for res in processResults]:
+            success = True
+        self.emit(SIGNAL("finished(bool)"), success)
+        self.logger.debug("run method exiting.")
+
+    def process_files(self):
+        self.logger.debug("process_files method called.")
+        pool = ThreadPool(self.numWorkers)
+        try:
+            # chunksize=1 keeps the workers busy when some files take longer
+            results = pool.map(self._process_file_result, self.filePaths, 1)
+        finally:
+            pool.close()
+            pool.join()
+        self.logger.debug("results: %s" % results)
+        self.logger.debug("process_files method exiting.")
+        return results
+
+    def _process_file_result(self, filePath):
+        """
+        Process a file in a worker thread and return its result.
+        """
+
+        self.logger.debug("filePath: %s" % filePath)
+        try:
+            warpedFiles = self.process_file(filePath)
+        except Exception:
+            self.logger.exception("Error processing file %s" % filePath)
+            warpedFiles = []
+        result = {filePath : len(warpedFiles) > 0}
+        self.logger.debug("result: %s" % result)
+        self.emit(SIGNAL("processedFile(QString)"), filePath)
+        return result
+
+    def process_file(self, filePath):
+
+        self.logger.debug("process_file method called.")
+        if self.is_cancelled():
+            return []
+        self._start_stage(filePath, "gcps")
+        with self.hdf5Lock:
+            h5f = H5Georef(filePath, lazy=True, backend=self.backend)
+            sampleCoords = h5f.get_sample_coords()
+        self.logger.debug("sampleCoords: %s" % sampleCoords)
+        self._finish_stage(filePath, "gcps")
+        self._start_stage(filePath, "translate")
+        georefFiles = []
+        # an array at a time, to stop as soon as the processing is cancelled
+        for arrayName in h5f._selected_arrays(self.datasets):
+            if self.is_cancelled():
+                return []
+            georefFiles += h5f.georef_gtif(sampleCoords, self.outputDir,
+                                           [arrayName])
+        self.logger.debug("georefFiles: %s" % georefFiles)
+        self._finish_stage(filePath, "translate")
+        self._start_stage(filePath, "warp")
+        warpedFiles = []
+        for georefFile in georefFiles:
+            if self.is_cancelled():
+                return []
+            warpedFiles += h5f.warp([georefFile], self.outputDir,
+                                    self.projectionString)
+        self.logger.debug("warpedFiles: %s" % warpedFiles)
+        self._finish_stage(filePath, "warp")
+        self.logger.debug("process_file method exiting.")
+        return warpedFiles
+
+    def _start_stage(self, filePath, stage):
+        self.emit(SIGNAL("stageStarted(QString, QString)"), filePath, stage)
+
+    def _finish_stage(self, filePath, stage):
+        self.emit(SIGNAL("stageFinished(QString, QString)"), filePath, stage)
+
+
+def create_logger(logLevel, logName):
+    level = eval("logging.%s" % (logLevel.upper()))
+    logging.basicConfig(level=level)
+    logger = logging.getLogger(logName)
+    return logger
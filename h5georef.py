@@ -44,19 +44,202 @@ from subprocess import Popen, PIPE
 from math import pow, sin, cos, atan, sqrt, radians, degrees
 import logging
 
-import tables
+from lazyimport import lazy_import
+from gdalbackends import SubprocessBackend
+from rasterwriters import get_writer
+from outputprofiles import get_profile
+from arrayreader import ArrayReader
+from metrics import get_metrics
+from resample import resample
+import gcpfit
+
+np = lazy_import("numpy")
+tables = lazy_import("tablescompat")
+
+__version__ = "0.13"
+
+def _is_lat_lon(projectionString):
+    """
+    Return True if a projection string describes WGS84 geographic coordinates.
+    """
+
+    normalized = " ".join(projectionString.lower().split())
+    return normalized in ("+init=epsg:4326", "epsg:4326", "+proj=latlong",
+                          "+proj=longlat", "+proj=latlong +datum=wgs84",
+                          "+proj=longlat +datum=wgs84",
+                          "+proj=longlat +ellps=wgs84 +datum=wgs84 +no_defs")
+
+def _densify_bbox(bbox, numSteps=51):
+    """
+    Return the coordinates of a grid of points covering a bounding box.
+
+    The bounding box's edges may map to curves in other projections, so its
+    corners alone are not enough to find the region it covers.
+    """
+
+    minX, minY, maxX, maxY = bbox
+    steps = np.linspace(0, 1, numSteps)
+    xs = (minX + steps * (maxX - minX)).reshape(1, -1)
+    ys = (minY + steps * (maxY - minY)).reshape(-1, 1)
+    return np.broadcast_arrays(xs, ys)
+
+def _transform_coords(xs, ys, fromProjection, toProjection):
+    """
+    Transform arrays of coordinates between two projections.
+
+    Transformations between WGS84 geographic coordinates are done directly.
+    Other projections require GDAL's python bindings. Points that cannot be
+    transformed are set to NaN.
+    """
+
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    xs, ys = np.broadcast_arrays(xs, ys)
+    if _is_lat_lon(fromProjection) and _is_lat_lon(toProjection):
+        return xs.copy(), ys.copy()
+    # importing here so that GDAL's python bindings are only required for
+    # projections other than latlon
+    from osgeo import osr
+    spatialRefs = []
+    for projection in (fromProjection, toProjection):
+        spatialRef = osr.SpatialReference()
+        spatialRef.SetFromUserInput(projection)
+        if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+            # GDAL >= 3 would otherwise use latlon axis order for EPSG:4326
+            spatialRef.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        spatialRefs.append(spatialRef)
+    transformation = osr.CoordinateTransformation(*spatialRefs)
+    points = np.column_stack((xs.ravel(), ys.ravel()))
+    transformed = np.array(transformation.TransformPoints(points.tolist()),
+                           dtype=np.float64)
+    transformed[~np.isfinite(transformed)] = np.nan
+    return (transformed[:, 0].reshape(xs.shape),
+            transformed[:, 1].reshape(xs.shape))
+
+def to_physical(rawData, scalingFactor, rawMissingValue, missingValue=None):
+    """
+    Convert raw array values to float32 physical values.
+
+    Inputs:
+        rawData - a numpy array with the raw values, as stored in the HDF5
+                  files and in the outputs written with native types.
+        scalingFactor - the array's SCALING_FACTOR. Physical values are the
+                        raw values divided by it.
+        rawMissingValue - the array's raw MISSING_VALUE.
+        missingValue - the value given to the pixels with the raw missing
+                       value, such as NaN. Defaults to the scaled missing
+                       value, as in the Float32 outputs.
+
+    The values are divided in a single float32 pass into the result array,
+    without the intermediary copies of an 'astype' conversion.
+    """
+
+    if missingValue is None:
+        missingValue = rawMissingValue / float(scalingFactor)
+    data = np.empty(rawData.shape, dtype=np.float32)
+    np.divide(rawData, scalingFactor, out=data, dtype=np.float32,
+              casting="unsafe")
+    np.copyto(data, missingValue, where=(rawData == rawMissingValue),
+              casting="unsafe")
+    return data
+
+class _ValueCounter(object):
+    """
+    Accumulate the number of occurrences of each value of an array.
+
+    This allows an histogram to be built in the same pass over the data that
+    computes the minimum and maximum values, before the range of the
+    histogram is known. Only integer types of up to 16 bits are supported.
+    """
+
+    def __init__(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype.kind not in "iu" or dtype.itemsize > 2:
+            raise ValueError("Histograms are only supported for integer "
+                             "arrays of up to 16 bits, not %s" % dtype)
+        self.offset = int(np.iinfo(dtype).min) if dtype.kind == "i" else 0
+        self.counts = np.zeros(2 ** (8 * dtype.itemsize), dtype=np.int64)
+
+    def add(self, values):
+        blockCounts = np.bincount((values.astype(np.int64) - \
+                                  self.offset).ravel())
+        self.counts[:blockCounts.size] += blockCounts
+
+    def histogram(self, numBins, minValue, maxValue):
+        """
+        Return a dictionary with the 'bins' edges and their 'counts'.
+        """
+
+        values = np.arange(self.counts.size) + self.offset
+        counts, edges = np.histogram(values, bins=numBins,
+                                     range=(minValue, maxValue + 1),
+                                     weights=self.counts)
+        return {"bins" : edges.tolist(),
+                "counts" : counts.astype(np.int64).tolist()}
+
 
 class H5Georef(object):
 
     latLongProj = '+init=epsg:4326'
+    # WGS84 ellipsoid parameters. This is the ellipsoid that proj4 uses
+    # when the GEOS projection string does not specify one
+    semiMajorAxis = 6378137.0
+    flattening = 1 / 298.257223563
 
-    def __init__(self, h5FilePath):
+    # minimum number of lines to read at a time when scanning an array
+    blockLines = 256
+
+    def __init__(self, h5FilePath, lazy=True, statsCache=None, backend=None,
+                 geometryCache=None, memoryMap=False, outputProfile=None,
+                 nativeType=False):
         """
         Open an HDF5 file and extract its relevant parameters.
+
+        Inputs:
+            h5FilePath - path to the HDF5 file.
+            lazy - a boolean. If False, every array is scanned when the
+                   file is opened, to compute its statistics. By default
+                   only the metadata of the file is read, as no processing
+                   needs the statistics, which are computed on request
+                   (see the 'compute_stats' method).
+            statsCache - a statscache.StatsCache instance. If specified,
+                         array statistics are looked up in it before
+                         scanning the arrays and stored in it afterwards.
+            backend - the gdalbackends backend instance used to run GDAL's
+                      translate and warp operations. Defaults to a
+                      gdalbackends.SubprocessBackend.
+            geometryCache - a geocache.GeometryCache instance. If specified,
+                            the GCPs, lat lon grids and index maps computed
+                            for this file are reused by other files that
+                            share the same geometry.
+            memoryMap - a boolean. If True, the in-process operations
+                        memory map the arrays that are stored contiguously
+                        and without compression, when h5py is available.
+            outputProfile - an outputprofiles.OutputProfile instance with
+                            the format, layout and compression of the
+                            output files. Defaults to the 'plain' profile.
+            nativeType - a boolean. If True, the output files keep the
+                         arrays' integer values and data type, with the
+                         scaling factor as their scale and the raw missing
+                         value as their nodata value, instead of being
+                         converted to Float32 physical values. The files
+                         written by GDAL's translate operation require
+                         GDAL >= 2.3. See the 'to_physical' function for
+                         converting the values.
         """
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.h5FilePath = h5FilePath
+        self.memoryMap = memoryMap
+        self.statsCache = statsCache
+        self.geometryCache = geometryCache
+        if outputProfile is None:
+            outputProfile = get_profile("plain")
+        self.outputProfile = outputProfile
+        self.nativeType = nativeType
+        if backend is None:
+            backend = SubprocessBackend()
+        self.backend = backend
         # the LSA-SAF parameters have this shift because they use Fortran
         # (an array's first index starts at 1 and not 0)
         self.CLCorrection = -1 
@@ -64,87 +247,593 @@ class H5Georef(object):
         self.p1 = 42164 
         self.p2 = 1.006803
         self.p3 = 1737121856
-        h5File = tables.openFile(h5FilePath)
-        self.arrays = dict()
-        mainArrayName = h5File.root._f_getChild(h5File.root._v_attrs[\
-                        "PRODUCT"]).name
-        for arr in h5File.walkNodes("/", "Array"):
-            npArray = arr.read()
-            scalingFactor = arr._v_attrs["SCALING_FACTOR"]
-            self.arrays[arr.name] = {
-                        "nCols" : arr._v_attrs["N_COLS"],
-                        "nLines" : arr._v_attrs["N_LINES"],
-                        "scalingFactor" : scalingFactor,
-                        "missingValue" : arr._v_attrs["MISSING_VALUE"] / scalingFactor,
-                        "min" : npArray.min() / scalingFactor,
-                        "max" : npArray.max() / scalingFactor,
-                        "oldMin" : npArray.min(),
-                        "oldMax" : npArray.max()}
-            if arr.name == mainArrayName:
-                self.arrays[arr.name]["mainArray"] = True
-        subLonRE = re.search(r"[A-Za-z]{4}[<(][-+]*[0-9]{3}\.?[0-9]*[>)]",
-                             h5File.root._v_attrs["PROJECTION_NAME"])
-
-        if subLonRE:
-            self.subLon = float(subLonRE.group()[5:-1])
-        else:
-            raise ValueError
-        self.coff = h5File.root._v_attrs["COFF"] + self.CLCorrection
-        self.loff = h5File.root._v_attrs["LOFF"] + self.CLCorrection
-        self.cfac = h5File.root._v_attrs["CFAC"] # should this be corrected too?
-        self.lfac = h5File.root._v_attrs["LFAC"] # should this be corrected too?
-        self.satHeight = 35785831
-        self.GEOSProjString = "+proj=geos +lon_0=%s +h=%s +x_0=0.0 +y_0=0.0" \
-                              % (self.subLon, self.satHeight)
+        with get_metrics().timer("open", file=os.path.basename(h5FilePath)):
+            h5File = tables.openFile(h5FilePath)
+            self.arrays = dict()
+            mainArrayName = h5File.root._f_getChild(h5File.root._v_attrs[\
+                            "PRODUCT"]).name
+            for arr in h5File.walkNodes("/", "Array"):
+                scalingFactor = arr._v_attrs["SCALING_FACTOR"]
+                self.arrays[arr.name] = {
+                            "path" : arr._v_pathname,
+                            "nCols" : arr._v_attrs["N_COLS"],
+                            "nLines" : arr._v_attrs["N_LINES"],
+                            "dtype" : arr.dtype.name,
+                            "scalingFactor" : scalingFactor,
+                            "rawMissingValue" : arr._v_attrs["MISSING_VALUE"],
+                            "missingValue" : arr._v_attrs["MISSING_VALUE"] / scalingFactor}
+                if arr.name == mainArrayName:
+                    self.arrays[arr.name]["mainArray"] = True
+            subLonRE = re.search(r"[A-Za-z]{4}[<(][-+]*[0-9]{3}\.?[0-9]*[>)]",
+                                 h5File.root._v_attrs["PROJECTION_NAME"])
+
+            if subLonRE:
+                self.subLon = float(subLonRE.group()[5:-1])
+            else:
+                raise ValueError
+            self.coff = h5File.root._v_attrs["COFF"] + self.CLCorrection
+            self.loff = h5File.root._v_attrs["LOFF"] + self.CLCorrection
+            self.cfac = h5File.root._v_attrs["CFAC"] # should this be corrected too?
+            self.lfac = h5File.root._v_attrs["LFAC"] # should this be corrected too?
+            self.satHeight = 35785831
+            self.GEOSProjString = "+proj=geos +lon_0=%s +h=%s +x_0=0.0 +y_0=0.0" \
+                                  % (self.subLon, self.satHeight)
+            # the time of the file's slot, as 'YYYYMMDDHHMMSS', if known
+            self.acquisitionTime = None
+            if "IMAGE_ACQUISITION_TIME" in h5File.root._v_attrs._v_attrnames:
+                acquisitionTime = h5File.root._v_attrs[\
+                                  "IMAGE_ACQUISITION_TIME"]
+                if isinstance(acquisitionTime, bytes):
+                    acquisitionTime = acquisitionTime.decode("ascii")
+                self.acquisitionTime = str(acquisitionTime).strip()
         h5File.close()
+        if not lazy:
+            reader = self._open_reader()
+            try:
+                for arrayName in self.arrays.keys():
+                    if not self._get_cached_stats(arrayName):
+                        self._update_stats(reader, arrayName)
+            finally:
+                reader.close()
+        # the region of interest, set with the 'set_bbox' method
+        self.bbox = None
+        self.bboxProjection = None
+        self.window = None
+        self._bboxExtent = None
+
+    def compute_stats(self, arrayName, histogramBins=None):
+        """
+        Compute the statistics of an array.
+
+        Inputs:
+            arrayName - the name of the array.
+            histogramBins - an integer with the number of bins of an
+                            histogram of the array's values. If None, no
+                            histogram is computed.
+
+        The statistics are stored in the array's entry of the 'arrays'
+        attribute: 'oldMin' and 'oldMax' hold the raw minimum and maximum
+        values, 'min' and 'max' hold the same values after applying the
+        scaling factor, 'count' holds the number of valid pixels and
+        'histogram', if requested, holds a dictionary with the 'bins' edges
+        and their 'counts', in raw values. Pixels set to the array's missing
+        value are not taken into account. Arrays whose statistics are
+        already known are not read again.
+        """
+
+        params = self.arrays[arrayName]
+        if "oldMin" in params and (histogramBins is None or \
+                len(params.get("histogram", {}).get("counts", [])) == \
+                histogramBins):
+            return
+        if self._get_cached_stats(arrayName, histogramBins):
+            return
+        reader = self._open_reader()
+        try:
+            self._update_stats(reader, arrayName, histogramBins)
+        finally:
+            reader.close()
+
+    def _get_cached_stats(self, arrayName, histogramBins=None):
+        """
+        Look up the statistics of an array in the stats cache.
+
+        Returns True if suitable statistics were found, False otherwise.
+        """
+
+        if self.statsCache is None:
+            return False
+        stats = self.statsCache.get(self.h5FilePath, arrayName)
+        if stats is None or (histogramBins is not None and \
+                len(stats.get("histogram", {}).get("counts", [])) != \
+                histogramBins):
+            return False
+        self.logger.debug('Using cached statistics for %s' % arrayName)
+        self.arrays[arrayName].update(stats)
+        return True
+
+    def _update_stats(self, reader, arrayName, histogramBins=None):
+        """
+        Scan an array with an ArrayReader and store its statistics.
+
+        The array is read in blocks of lines that are aligned with its HDF5
+        chunks, so that only a block is held in memory at any time. All the
+        statistics are computed in this single pass over the data.
+        """
+
+        self.logger.debug('Computing statistics for %s' % arrayName)
+        params = self.arrays[arrayName]
+        rawMissingValue = params["rawMissingValue"]
+        if histogramBins is not None:
+            valueCounts = _ValueCounter(params["dtype"])
+        oldMin = oldMax = None
+        count = 0
+        with get_metrics().timer("stats", array=arrayName):
+            for firstLine, block in reader.read_blocks(params["path"]):
+                validValues = block[block != rawMissingValue]
+                if validValues.size == 0:
+                    continue
+                count += validValues.size
+                blockMin = validValues.min()
+                blockMax = validValues.max()
+                if oldMin is None or blockMin < oldMin:
+                    oldMin = blockMin
+                if oldMax is None or blockMax > oldMax:
+                    oldMax = blockMax
+                if histogramBins is not None:
+                    valueCounts.add(validValues)
+        if count == 0:
+            oldMin = oldMax = rawMissingValue
+        # convert from numpy scalars, so that the stats can be cached as JSON
+        oldMin = oldMin.item() if hasattr(oldMin, "item") else oldMin
+        oldMax = oldMax.item() if hasattr(oldMax, "item") else oldMax
+        scalingFactor = params["scalingFactor"]
+        stats = {
+                "min" : oldMin / scalingFactor,
+                "max" : oldMax / scalingFactor,
+                "oldMin" : oldMin,
+                "oldMax" : oldMax,
+                "count" : count}
+        if histogramBins is not None:
+            stats["histogram"] = valueCounts.histogram(histogramBins, oldMin,
+                                                       oldMax)
+        params.update(stats)
+        if self.statsCache is not None:
+            self.statsCache.set(self.h5FilePath, arrayName, stats)
+
+    def set_bbox(self, bbox, bboxProjection=None):
+        """
+        Restrict the processing to a bounding box.
+
+        Inputs:
+            bbox - a tuple with the minimum x, minimum y, maximum x and
+                   maximum y coordinates of the bounding box. If None, the
+                   whole arrays are processed.
+            bboxProjection - a string, taking any of the accepted PROJ4
+                             formats for describing a projection, with the
+                             projection of the bounding box's coordinates.
+                             Defaults to +init=epsg:4326
+
+        Once a bounding box is set, only the window of the arrays that
+        covers it is read and georeferenced (see the 'get_window' method)
+        and the warped files are cropped to the bounding box.
+        """
+
+        if bboxProjection is None:
+            bboxProjection = self.latLongProj
+        if bbox is None:
+            self.window = None
+            self._bboxExtent = None
+        else:
+            self._bboxExtent = self._bbox_extent(bbox, bboxProjection)
+            self.window = self._clip_window(self._bboxExtent, bbox)
+            self.logger.debug('window: %s' % (self.window,))
+        self.bbox = bbox
+        self.bboxProjection = bboxProjection
+
+    def get_window(self, bbox, bboxProjection=None, arrayName=None):
+        """
+        Return the window of an array that covers a bounding box.
+
+        Inputs:
+            bbox - a tuple with the minimum x, minimum y, maximum x and
+                   maximum y coordinates of the bounding box.
+            bboxProjection - a string, taking any of the accepted PROJ4
+                             formats for describing a projection, with the
+                             projection of the bounding box's coordinates.
+                             Defaults to +init=epsg:4326
+            arrayName - the name of the array, whose dimensions the window
+                        is clipped to. Defaults to the main array.
+
+        Returns: A tuple with firstLine, firstCol, nLines, nCols. Indexes
+        start at 0. The window includes a margin of one pixel, so that
+        resampling at its edges is not affected.
+
+        Raises ValueError if the bounding box is not visible in the array.
+        """
+
+        return self._clip_window(self._bbox_extent(bbox, bboxProjection),
+                                 bbox, arrayName)
+
+    def _bbox_extent(self, bbox, bboxProjection=None):
+        """
+        Return the first and last lines and columns that cover a bounding
+        box, with a margin of one pixel, before clipping them to an array.
+        """
+
+        if bboxProjection is None:
+            bboxProjection = self.latLongProj
+        xs, ys = _densify_bbox(bbox)
+        lons, lats = _transform_coords(xs, ys, bboxProjection,
+                                       self.latLongProj)
+        eastings, northings = self.get_east_north(lons, lats)
+        valid = ~np.isnan(eastings)
+        if not valid.any():
+            raise ValueError("The bounding box %s is not visible from the "
+                             "satellite" % (bbox,))
+        geotransform = self.get_geotransform()
+        cols = (eastings[valid] - geotransform[0]) / geotransform[1] - 0.5
+        lines = (northings[valid] - geotransform[3]) / geotransform[5] - 0.5
+        return (int(np.floor(lines.min())) - 1, int(np.floor(cols.min())) - 1,
+                int(np.ceil(lines.max())) + 1, int(np.ceil(cols.max())) + 1)
+
+    def _clip_window(self, extent, bbox, arrayName=None):
+        """
+        Return the window of an array within the extent of a bounding box,
+        as returned by '_bbox_extent'.
+        """
+
+        nLines, nCols = self._get_dimensions(arrayName)
+        firstLine = max(extent[0], 0)
+        firstCol = max(extent[1], 0)
+        lastLine = min(extent[2], nLines - 1)
+        lastCol = min(extent[3], nCols - 1)
+        if firstLine > lastLine or firstCol > lastCol:
+            raise ValueError("The bounding box %s does not intersect the "
+                             "arrays" % (bbox,))
+        return (firstLine, firstCol, lastLine - firstLine + 1,
+                lastCol - firstCol + 1)
+
+    def _get_window(self, arrayName=None):
+        """
+        Return the window of an array being processed: the window of the
+        bounding box, if one is set, or the whole array.
+
+        The arrays share the geometry of the file's header, so the bounding
+        box covers the same lines and columns in all of them, clipped to
+        the dimensions of each array. If arrayName is None, the window of
+        the main array is returned.
+        """
+
+        if self.window is not None:
+            if arrayName is None:
+                return self.window
+            return self._clip_window(self._bboxExtent, self.bbox,
+                                     arrayName)
+        nLines, nCols = self._get_dimensions(arrayName)
+        return (0, 0, nLines, nCols)
+
+    def geometry_key(self):
+        """
+        Return a tuple with the parameters that define the file's geometry.
+
+        Files with the same geometry key, such as all the files of an
+        LSA-SAF region, have the same GCPs, lat lon grids and index maps.
+        """
+
+        nLines, nCols = self._get_dimensions()
+        return (float(self.subLon), float(self.coff), float(self.loff),
+                float(self.cfac), float(self.lfac), int(nLines), int(nCols))
+
+    def _cached_geometry(self, itemName, computeFunction):
+        """
+        Return a geometry item, using the geometry cache when there is one.
+        """
+
+        if self.geometryCache is None:
+            return computeFunction()
+        return self.geometryCache.get_or_compute(self.geometry_key(),
+                                                 itemName, computeFunction)
 
     def get_sample_coords(self, numSamples=10):
         """
         Return a list of tuples holding line, col, northing,easting.
+
+        When the instance has a geometry cache, the same sample points are
+        returned for every file with the same geometry. When a bounding box
+        is set, the sample points are drawn from its window.
         """
 
+        with get_metrics().timer("sampling"):
+            item = self._cached_geometry("sampleCoords|%i|%r" % (numSamples,
+                    self.window), lambda: {"points" :
+                    np.array(self._sample_coords(numSamples))})
+        return [(int(line), int(col), float(northing), float(easting)) for
+                line, col, northing, easting in item["points"]]
+
+    def _sample_coords(self, numSamples):
         samplePoints = []
         #using the main array to extract nCols and nLines
-        nCols, nLines = [(v["nCols"], v["nLines"]) for k, v in\
-                        self.arrays.iteritems() if v.get("mainArray")][0]
+        firstLine, firstCol, nLines, nCols = self._get_window()
         while len(samplePoints) < numSamples:
-            line = random.randint(1, nLines)
-            col = random.randint(1, nCols)
-            lon, lat = self._get_lat_lon(line, col)
-            if lon:
-                easting, northing = self._get_east_north(lon, lat)
-                samplePoints.append((line, col, northing, easting))
+            lines = [random.randint(firstLine + 1, firstLine + nLines) for
+                     i in range(numSamples)]
+            cols = [random.randint(firstCol + 1, firstCol + nCols) for
+                    i in range(numSamples)]
+            lons, lats = self.get_lat_lon(lines, cols)
+            eastings, northings = self.get_east_north(lons, lats)
+            for line, col, northing, easting in zip(lines, cols, northings,
+                                                    eastings):
+                if not np.isnan(easting) and len(samplePoints) < numSamples:
+                    samplePoints.append((line, col, float(northing),
+                                         float(easting)))
         return samplePoints
 
+    def get_dense_sample_coords(self, maxError=0.1, order=1, gridSize=4,
+                                maxSamples=256):
+        """
+        Return GCPs spread over the visible part of the arrays.
+
+        Inputs:
+            maxError - the largest error, in pixels, that is accepted in
+                       the polynomial fit of the GCPs.
+            order - the order of the polynomial, which should be given to
+                    gdalwarp's '-order' option when warping with the GCPs.
+            gridSize - the number of lines and columns of the initial grid
+                       of cells.
+            maxSamples - the largest number of GCPs.
+
+        Returns: A tuple with a list of tuples holding line, col, northing,
+        easting, and a tuple with the root mean square and the maximum
+        error of their fit, in pixels.
+
+        The window is divided in a grid of cells, each with a GCP at its
+        visible pixel nearest to the centre. The GCPs are fitted with a
+        polynomial, as gdalwarp does, and the fit is checked at other
+        pixels of each cell, which are held out of the fit. Cells where the
+        error exceeds 'maxError' are split in four, until the fit is good
+        enough or there would be more than 'maxSamples' GCPs. Cells with no
+        visible pixels are dropped.
+        The same GCPs are returned for every file with the same geometry.
+        """
+
+        with get_metrics().timer("sampling"):
+            item = self._cached_geometry("denseSampleCoords|%r|%i|%i|%i|%r" %
+                    (maxError, order, gridSize, maxSamples, self.window),
+                    lambda: self._dense_sample_coords(maxError, order,
+                                                      gridSize, maxSamples))
+        samplePoints = [(int(line), int(col), float(northing),
+                         float(easting)) for line, col, northing, easting in
+                        item["points"]]
+        rmsError, maximumError = item["fitError"]
+        return samplePoints, (float(rmsError), float(maximumError))
+
+    def _dense_sample_coords(self, maxError, order, gridSize, maxSamples):
+        firstLine, firstCol, nLines, nCols = self._get_window()
+        lineEdges = [firstLine + i * nLines // gridSize for i in
+                     range(gridSize + 1)]
+        colEdges = [firstCol + i * nCols // gridSize for i in
+                    range(gridSize + 1)]
+        newCells = [(lineEdges[i], colEdges[j],
+                     lineEdges[i + 1] - lineEdges[i],
+                     colEdges[j + 1] - colEdges[j]) for i in
+                    range(gridSize) for j in range(gridSize)]
+        # the GCP and the check points of each cell
+        cells = dict()
+        while True:
+            cells.update(self._cell_samples([c for c in newCells if
+                                             c[2] > 0 and c[3] > 0]))
+            cellKeys = sorted(cells.keys())
+            samplePoints = np.array([cells[c][0] for c in cellKeys])
+            if len(samplePoints) < gcpfit.num_terms(order):
+                raise ValueError("Not enough visible pixels to fit the GCPs")
+            fit = gcpfit.fit_polynomial(samplePoints, order)
+            # a cell with a single visible pixel has no check points
+            errors = [gcpfit.fit_residuals(fit, cells[c][1]).max() if
+                      len(cells[c][1]) > 0 else 0.0 for c in cellKeys]
+            badCells = [c for c, error in zip(cellKeys, errors) if
+                        error > maxError and min(c[2], c[3]) > 1]
+            if len(badCells) == 0 or \
+                    len(cells) + 3 * len(badCells) > maxSamples:
+                break
+            newCells = []
+            for cell in badCells:
+                del cells[cell]
+                cellLine, cellCol, cellLines, cellCols = cell
+                halfLines = cellLines // 2
+                halfCols = cellCols // 2
+                newCells += [
+                        (cellLine, cellCol, halfLines, halfCols),
+                        (cellLine, cellCol + halfCols, halfLines,
+                         cellCols - halfCols),
+                        (cellLine + halfLines, cellCol, cellLines - halfLines,
+                         halfCols),
+                        (cellLine + halfLines, cellCol + halfCols,
+                         cellLines - halfLines, cellCols - halfCols)]
+        checkPoints = np.concatenate([cells[c][1] for c in cellKeys])
+        if len(checkPoints) == 0:
+            checkPoints = samplePoints
+        residuals = gcpfit.fit_residuals(fit, checkPoints)
+        self.logger.debug("%i GCPs, fit error: %s pixels (RMS), %s pixels "
+                          "(max)" % (len(samplePoints),
+                          np.sqrt(np.mean(residuals ** 2)), residuals.max()))
+        return {"points" : samplePoints,
+                "fitError" : np.array([np.sqrt(np.mean(residuals ** 2)),
+                                       residuals.max()])}
+
+    def _cell_samples(self, cells, numSteps=5):
+        """
+        Return the GCP and the check points of some cells.
+
+        Inputs:
+            cells - a list of tuples with firstLine, firstCol, nLines, nCols.
+            numSteps - the number of lines and columns of the grid of
+                       candidate pixels of each cell.
+
+        Returns: A dictionary with a tuple for each cell that has visible
+        pixels, holding its GCP and a numpy array with its check points,
+        as line, col, northing, easting. The check points are the cell's
+        other visible candidates, so that the fit is not checked at the
+        GCPs it was fitted to.
+        """
+
+        if len(cells) == 0:
+            return dict()
+        cellArray = np.array(cells, dtype=np.float64)
+        steps = (np.arange(numSteps) + 0.5) / numSteps
+        lines = (cellArray[:, 0:1] + steps * cellArray[:, 2:3]).astype(int)
+        cols = (cellArray[:, 1:2] + steps * cellArray[:, 3:4]).astype(int)
+        # all the candidate pixels of all the cells at once
+        shape = (len(cells), numSteps, numSteps)
+        lines = np.broadcast_to(lines[:, :, np.newaxis], shape)
+        cols = np.broadcast_to(cols[:, np.newaxis, :], shape)
+        lons, lats = self.get_lat_lon(lines, cols)
+        eastings, northings = self.get_east_north(lons, lats)
+        visible = ~np.isnan(eastings)
+        distances = \
+            ((lines - cellArray[:, 0, None, None] - cellArray[:, 2, None,
+              None] / 2.0) / cellArray[:, 2, None, None]) ** 2 + \
+            ((cols - cellArray[:, 1, None, None] - cellArray[:, 3, None,
+              None] / 2.0) / cellArray[:, 3, None, None]) ** 2
+        distances[~visible] = np.inf
+        points = np.stack([lines, cols, northings, eastings],
+                          axis=-1).reshape(len(cells), -1, 4)
+        samples = dict()
+        for cellIndex, cell in enumerate(cells):
+            if not visible[cellIndex].any():
+                continue
+            nearest = np.argmin(distances[cellIndex])
+            checked = visible[cellIndex].ravel().copy()
+            checked[nearest] = False
+            samples[cell] = (points[cellIndex][nearest],
+                             points[cellIndex][checked])
+        return samples
+
+    def get_geotransform(self, window=None):
+        """
+        Return the exact geotransform of the arrays in the GEOS projection.
+
+        Inputs:
+            window - a tuple with firstLine, firstCol, nLines, nCols
+                     specifying a rectangular region of the arrays. Indexes
+                     start at 0. Defaults to the whole array.
+
+        Returns: A tuple with the six coefficients of a GDAL geotransform:
+        the easting of the upper left corner, the pixel width, the row
+        rotation, the northing of the upper left corner, the column rotation
+        and the (negative) pixel height.
+
+        The COFF, LOFF, CFAC and LFAC parameters define the scanning angles
+        of each pixel, which are linear with the line and column indexes. The
+        GEOS projection coordinates are these angles multiplied by the
+        satellite's height, so the geotransform follows directly from the
+        header, with no need for GCPs. The line and column indexes refer to
+        the centre of the pixels, hence the half pixel shift.
+        """
+
+        firstLine, firstCol = (0, 0) if window is None else window[:2]
+        pixelWidth = self.satHeight * radians(pow(2, 16) / self.cfac)
+        pixelHeight = -self.satHeight * radians(pow(2, 16) / self.lfac)
+        upperLeftEasting = (firstCol - 0.5 - self.coff) * pixelWidth
+        upperLeftNorthing = (firstLine - 0.5 - self.loff) * pixelHeight
+        return (upperLeftEasting, pixelWidth, 0.0, upperLeftNorthing, 0.0,
+                pixelHeight)
+
+    def get_east_north(self, lons, lats):
+        """
+        Convert a batch of latlon coordinates to geos coordinates.
+
+        Inputs:
+            lons - a sequence (or numpy array) with the longitudes, in
+                   degrees.
+            lats - a sequence (or numpy array) with the latitudes, in
+                   degrees. It must be broadcastable against 'lons'.
+
+        Returns: A tuple of numpy arrays holding the eastings and northings,
+        in meters. Points that are not visible from the satellite (and NaN
+        inputs) are set to NaN.
+
+        This method implements the forward GEOS projection, as done by proj4
+        for the 'GEOSProjString' of this instance (ellipsoidal earth, sweep
+        angle axis 'y'), so no external utility is needed.
+        """
+
+        with get_metrics().timer("projection", direction="forward"):
+            es = self.flattening * (2 - self.flattening)
+            radiusG1 = self.satHeight / self.semiMajorAxis
+            radiusG = 1 + radiusG1
+            radiusP = sqrt(1 - es)
+            lam = np.radians(np.asarray(lons, dtype=np.float64) - self.subLon)
+            phi = np.radians(np.asarray(lats, dtype=np.float64))
+            # geocentric latitude
+            phi = np.arctan((1 - es) * np.tan(phi))
+            # vector from the center of the earth to the position on its
+            # surface
+            r = radiusP / np.hypot(radiusP * np.cos(phi), np.sin(phi))
+            vx = r * np.cos(lam) * np.cos(phi)
+            vy = r * np.sin(lam) * np.cos(phi)
+            vz = r * np.sin(phi)
+            tmp = radiusG - vx
+            with np.errstate(invalid="ignore"):
+                visible = (tmp * vx - vy ** 2 - vz ** 2 / (1 - es)) >= 0
+            easting = self.semiMajorAxis * radiusG1 * np.arctan(vy / tmp)
+            northing = self.semiMajorAxis * radiusG1 * \
+                       np.arctan(vz / np.hypot(vy, tmp))
+            easting = np.where(visible, easting, np.nan)
+            northing = np.where(visible, northing, np.nan)
+            return easting, northing
+
     def _get_east_north(self, lon, lat):
         """
         Convert between latlon and geos coordinates.
 
+        Returns a tuple with the easting and northing, or (None, None) if
+        the point is not visible from the satellite.
+        """
+
+        easting, northing = self.get_east_north(lon, lat)
+        if np.isnan(easting):
+            easting = northing = None
+        else:
+            easting = float(easting)
+            northing = float(northing)
+        self.logger.debug('easting: %s' % easting)
+        self.logger.debug('northing: %s' % northing)
+        return easting, northing
+
+    def _get_east_north_cs2cs(self, lons, lats):
+        """
+        Convert a batch of latlon coordinates to geos coordinates with cs2cs.
+
         This method uses the external 'cs2cs' utility to perform coordinate
-        transformation.
-        """
-
-        self.logger.debug('lon: %s' % lon)
-        self.logger.debug('lat: %s' % lat)
-        oldDir = os.getcwd()
-        os.chdir(os.path.dirname(self.h5FilePath))
-        tempName = 'temp.txt'
-        fh = open(tempName, 'w')
-        fh.write('%s %s\n' % (lon, lat))
-        fh.close()
-        self.logger.debug('tempName: %s' % tempName)
+        transformation. It feeds the coordinates through cs2cs' standard
+        input in a single call. It is kept as a reference implementation
+        against which the results of 'get_east_north' may be checked.
+
+        Returns: A tuple of lists with the eastings and northings. Points
+        that cs2cs cannot transform are set to None.
+        """
+
         cs2csCommand = ['cs2cs', '-f', '%.8f', self.latLongProj, '+to']
         cs2csCommand += self.GEOSProjString.split()
-        cs2csCommand += [tempName]
         self.logger.debug('cs2csCommand:\n\n%s' % cs2csCommand)
-        returnCode, stdout, stderr = self._run_command(cs2csCommand)
-        self.logger.debug('stdout: %s' % stdout)
+        stdin = "".join(["%s %s\n" % (lon, lat) for lon, lat in
+                        zip(lons, lats)])
+        returnCode, stdout, stderr = self._run_command(cs2csCommand,
+                                                       stdin=stdin)
         self.logger.debug('stderr: %s' % stderr)
-        easting, northing, other = stdout.strip().split()
-        self.logger.debug('easting: %s' % easting)
-        self.logger.debug('northing: %s' % northing)
-        os.remove(tempName)
-        return float(easting), float(northing)
+        eastings = []
+        northings = []
+        for outputLine in stdout.strip().splitlines():
+            easting, northing = outputLine.split()[:2]
+            try:
+                eastings.append(float(easting))
+                northings.append(float(northing))
+            except ValueError:
+                # cs2cs outputs '*' for points it cannot transform
+                eastings.append(None)
+                northings.append(None)
+        return eastings, northings
 
     def _get_lat_lon(self, nLin, nCol):
         """
@@ -169,6 +858,208 @@ class H5Georef(object):
             lon = lat = None
         return lon, lat
 
+    def get_lat_lon(self, lines, cols):
+        """
+        Get the lat lon coordinates of a batch of pixels.
+
+        Inputs:
+            lines - a sequence (or numpy array) with the line indexes of the
+                    pixels. Indexes start at 0.
+            cols - a sequence (or numpy array) with the column indexes of
+                   the pixels. It must be broadcastable against 'lines'.
+
+        Returns: A tuple of numpy arrays holding the longitudes and latitudes,
+        in degrees. Pixels that fall outside the Earth's disk are set to NaN.
+
+        This is the vectorized counterpart of the '_get_lat_lon' method.
+        """
+
+        with get_metrics().timer("projection", direction="inverse"):
+            lines = np.asarray(lines, dtype=np.float64)
+            cols = np.asarray(cols, dtype=np.float64)
+            x = np.radians((cols - self.coff) / (pow(2, -16) * self.cfac))
+            y = np.radians((lines - self.loff) / (pow(2, -16) * self.lfac))
+            cosX = np.cos(x)
+            cosY = np.cos(y)
+            sinY = np.sin(y)
+            denominator = cosY ** 2 + self.p2 * sinY ** 2
+            sdSquared = (self.p1 * cosX * cosY) ** 2 - self.p3 * denominator
+            # pixels where sdSquared is negative are not looking at the Earth
+            sd = np.sqrt(np.where(sdSquared < 0, np.nan, sdSquared))
+            sn = (self.p1 * cosX * cosY - sd) / denominator
+            s1 = self.p1 - sn * cosX * cosY
+            s2 = sn * np.sin(x) * cosY
+            s3 = -sn * sinY
+            sxy = np.sqrt(s1 ** 2 + s2 ** 2)
+            lon = np.degrees(np.arctan(s2 / s1)) + self.subLon
+            lat = np.degrees(np.arctan(self.p2 * s3 / sxy))
+            return lon, lat
+
+    def get_lat_lon_grid(self, window=None, arrayName=None):
+        """
+        Get the lat lon coordinates of every pixel in an array.
+
+        Inputs:
+            window - a tuple with firstLine, firstCol, nLines, nCols
+                     specifying a rectangular region of the array. Indexes
+                     start at 0. Defaults to the whole array.
+            arrayName - the name of the array whose dimensions are to be
+                        used. Defaults to the main array.
+
+        Returns: A tuple of 2D numpy arrays, with shape (nLines, nCols),
+        holding the longitudes and latitudes. Pixels that fall outside the
+        Earth's disk are set to NaN.
+        """
+
+        if window is None:
+            nLines, nCols = self._get_dimensions(arrayName)
+            window = (0, 0, nLines, nCols)
+
+        def compute_grid():
+            firstLine, firstCol, nLines, nCols = window
+            lines = np.arange(firstLine, firstLine + nLines).reshape(nLines, 1)
+            cols = np.arange(firstCol, firstCol + nCols).reshape(1, nCols)
+            lons, lats = self.get_lat_lon(lines, cols)
+            return {"lons" : lons, "lats" : lats}
+
+        grid = self._cached_geometry("latLonGrid|%r" % (tuple(window),),
+                                     compute_grid)
+        return grid["lons"], grid["lats"]
+
+    def get_target_grid(self, projectionString=None):
+        """
+        Return the grid that covers the Earth's disk in a target projection.
+
+        Inputs:
+            projectionString - a string, taking any of the accepted PROJ4
+                               formats for describing a projection. Defaults
+                               to +init=epsg:4326
+
+        Returns: A tuple with a GDAL geotransform, the number of lines and
+        the number of columns of the grid. Like gdalwarp does, the grid's
+        square pixels are sized so that its diagonal has about the same
+        number of pixels as the source arrays.
+        """
+
+        if projectionString is None:
+            projectionString = self.latLongProj
+
+        def compute_grid():
+            nLines, nCols = self._get_dimensions()
+            # a coarse grid of source pixels is enough to find the bounds
+            step = max(1, max(nLines, nCols) // 512)
+            lines = np.append(np.arange(0, nLines, step), nLines - 1)
+            cols = np.append(np.arange(0, nCols, step), nCols - 1)
+            lons, lats = self.get_lat_lon(lines.reshape(-1, 1),
+                                          cols.reshape(1, -1))
+            valid = ~np.isnan(lons)
+            xs, ys = _transform_coords(lons[valid], lats[valid],
+                                       self.latLongProj, projectionString)
+            valid = np.isfinite(xs) & np.isfinite(ys)
+            minX, maxX = xs[valid].min(), xs[valid].max()
+            minY, maxY = ys[valid].min(), ys[valid].max()
+            resolution = np.hypot(maxX - minX, maxY - minY) / \
+                         np.hypot(nLines, nCols)
+            targetCols = int(np.ceil((maxX - minX) / resolution)) + 1
+            targetLines = int(np.ceil((maxY - minY) / resolution)) + 1
+            geotransform = (minX - resolution / 2.0, resolution, 0.0,
+                            maxY + resolution / 2.0, 0.0, -resolution)
+            return {"geotransform" : np.array(geotransform),
+                    "shape" : np.array([targetLines, targetCols])}
+
+        grid = self._cached_geometry("targetGrid|%s" % projectionString,
+                                     compute_grid)
+        return (tuple(float(c) for c in grid["geotransform"]),
+                int(grid["shape"][0]), int(grid["shape"][1]))
+
+    def get_output_grid(self, projectionString=None):
+        """
+        Return the grid of the files written by the 'resample' method.
+
+        It is the grid returned by the 'get_target_grid' method, cropped to
+        the bounding box if one is set.
+        """
+
+        if projectionString is None:
+            projectionString = self.latLongProj
+        targetGrid = self.get_target_grid(projectionString)
+        if self.bbox is not None:
+            targetGrid = self._crop_grid(targetGrid, projectionString)
+        return targetGrid
+
+    def get_index_map(self, projectionString=None, targetGrid=None):
+        """
+        Return the source pixel of each pixel of a target grid.
+
+        Inputs:
+            projectionString - a string, taking any of the accepted PROJ4
+                               formats for describing a projection. Defaults
+                               to +init=epsg:4326
+            targetGrid - a tuple with a GDAL geotransform, the number of
+                         lines and the number of columns of the target grid.
+                         Defaults to the grid returned by 'get_target_grid'.
+
+        Returns: A tuple with two 2D float32 numpy arrays, shaped like the
+        target grid, holding the (fractional) line and column indexes of the
+        source pixel that each target pixel's centre falls on. Indexes refer
+        to the centre of the source pixels and start at 0. Target pixels
+        with no source pixel are set to NaN.
+        """
+
+        if projectionString is None:
+            projectionString = self.latLongProj
+        if targetGrid is None:
+            targetGrid = self.get_target_grid(projectionString)
+        geotransform, nLines, nCols = targetGrid
+
+        def compute_map():
+            sourceLines, sourceCols = self._get_dimensions()
+            srcGeotransform = self.get_geotransform()
+            lines = np.empty((nLines, nCols), dtype=np.float32)
+            cols = np.empty((nLines, nCols), dtype=np.float32)
+            targetCols = np.arange(nCols).reshape(1, nCols) + 0.5
+            for first in range(0, nLines, self.blockLines):
+                last = min(first + self.blockLines, nLines)
+                targetLines = np.arange(first, last).reshape(-1, 1) + 0.5
+                xs = geotransform[0] + targetCols * geotransform[1] + \
+                     targetLines * geotransform[2]
+                ys = geotransform[3] + targetCols * geotransform[4] + \
+                     targetLines * geotransform[5]
+                lons, lats = _transform_coords(xs, ys, projectionString,
+                                               self.latLongProj)
+                eastings, northings = self.get_east_north(lons, lats)
+                blockCols = (eastings - srcGeotransform[0]) / \
+                            srcGeotransform[1] - 0.5
+                blockLines = (northings - srcGeotransform[3]) / \
+                             srcGeotransform[5] - 0.5
+                with np.errstate(invalid="ignore"):
+                    outside = (blockCols < -0.5) | \
+                              (blockCols >= sourceCols - 0.5) | \
+                              (blockLines < -0.5) | \
+                              (blockLines >= sourceLines - 0.5)
+                blockCols[outside] = np.nan
+                blockLines[outside] = np.nan
+                lines[first:last] = blockLines
+                cols[first:last] = blockCols
+            return {"lines" : lines, "cols" : cols}
+
+        indexMap = self._cached_geometry("indexMap|%s|%r" % (projectionString,
+                                         targetGrid), compute_map)
+        return indexMap["lines"], indexMap["cols"]
+
+    def _get_dimensions(self, arrayName=None):
+        """
+        Return a tuple with the number of lines and columns of an array.
+
+        If arrayName is None, the dimensions of the main array are returned.
+        """
+
+        if arrayName is None:
+            arrayName = [k for k, v in self.arrays.items() if
+                         v.get("mainArray")][0]
+        return (self.arrays[arrayName]["nLines"],
+                self.arrays[arrayName]["nCols"])
+
     def georef_gtif(self, samplePoints, outFileDir=None, selectedArrays=None):
         """
         Create a georeferenced GeoTiff file for each of the selected arrays.
@@ -177,74 +1068,570 @@ class H5Georef(object):
             samplePoints - a list of tuples containing line, column, northing,
                            easting, for each of the desired GCPs to set. This
                            corresponds to the output of the 'get_sample_coords'
-                           method.
+                           method. If None, no GCPs are used and the arrays
+                           get the exact geotransform computed by the
+                           'get_geotransform' method.
             outFileDir - a string specifying the directory where the files
                          are to be stored.
             selectedArrays - a list of strings specifying the name of the 
                              arrays present in the original HDF5 file that
                              are to be georeferenced.
 
-        This method is calling the 'gdal_translate' utility to perform GCP
-        georeferencing based on the 'samplePoints' argument. The input CRS
-        is assumed to be the GEOS projection.
+        This method is calling GDAL's translate operation, through the
+        instance's backend, to perform GCP georeferencing based on the
+        'samplePoints' argument, or to assign the exact geotransform. The
+        input CRS is assumed to be the GEOS projection.
         """
 
         if outFileDir is None:
             outFileDir = os.getcwd()
-        if selectedArrays is None:
-            selectedArrays = [k for k, v in self.arrays.iteritems() if
-                              v.get("mainArray")]
+        selectedArrays = self._selected_arrays(selectedArrays)
         successfullGeorefs = []
         for arrayName in selectedArrays:
-            missingValue = self.arrays[arrayName].get("missingValue")
-            inFileName = os.path.basename(self.h5FilePath)
-            extensionList = inFileName.rsplit(".")
-            if len(extensionList) > 1:
-                inFileName = ".".join(extensionList[:-1])
-            outFileName = os.path.join(outFileDir, "%s_%s.tif" \
-                                       % (inFileName, arrayName))
-            translateCommand = [
-                    'gdal_translate',
+            outFileName = self._georef_file_name(arrayName, outFileDir)
+            translateOptions = self._georef_options(arrayName, samplePoints)
+            with get_metrics().timer("translate", array=arrayName):
+                success = self.backend.translate(translateOptions,
+                        self._subdataset_name(arrayName), outFileName)
+            if success:
+                successfullGeorefs.append(outFileName)
+        self._count_bytes_written(successfullGeorefs, "translate")
+        return successfullGeorefs
+
+    def extract_arrays(self, samplePoints, outFileDir=None,
+                       selectedArrays=None, multiBand=False, writer=None):
+        """
+        Create georeferenced files for the selected arrays in a single read.
+
+        Inputs:
+            samplePoints - a list of tuples containing line, column, northing,
+                           easting, for each of the desired GCPs to set. If
+                           None, the exact geotransform is used, as in the
+                           'georef_gtif' method.
+            outFileDir - a string specifying the directory where the files
+                         are to be stored.
+            selectedArrays - a list of strings specifying the name of the 
+                             arrays present in the original HDF5 file that
+                             are to be georeferenced.
+            multiBand - a boolean. If True, a single file is created, with
+                        one band for each of the selected arrays, which must
+                        all have the same dimensions and data type. Each
+                        band keeps its array's nodata value, which the raw
+                        writer requires to be the same for all the bands.
+                        Otherwise a file is created for each array.
+            writer - a rasterwriters writer instance, used to write the
+                     files. Defaults to the GDAL writer.
+
+        This method produces the same georeferenced files as 'georef_gtif',
+        in the GEOS projection, but instead of running a translate
+        operation for each array, which reopens the HDF5 file each time, it
+        opens the file once, reads all the selected arrays and writes them
+        with the same georeferencing.
+
+        Returns: A list of paths to the created files.
+        """
+
+        if outFileDir is None:
+            outFileDir = os.getcwd()
+        selectedArrays = self._selected_arrays(selectedArrays)
+        if writer is None:
+            writer = get_writer("gdal", self.outputProfile.intermediate())
+        outputs = []
+        reader = self._open_reader()
+        try:
+            if multiBand:
+                dimensions = set([self._get_dimensions(a) for a in
+                                  selectedArrays])
+                if len(dimensions) > 1:
+                    raise ValueError("Arrays with different dimensions "
+                                     "can not be stored in the same file")
+                dtypes = set([self._output_dtype(a) for a in selectedArrays])
+                if len(dtypes) > 1:
+                    raise ValueError("Arrays with different data types "
+                                     "can not be stored in the same file")
+                window = self._get_window(selectedArrays[0])
+                nLines, nCols = window[2:]
+                geotransform, gcps = self._window_georeferencing(window,
+                                                                 samplePoints)
+                outFileName = os.path.join(outFileDir, "%s_%s%s" % \
+                        (self._base_file_name(), "_".join(selectedArrays),
+                         writer.extension))
+                raster = writer.create(outFileName, nLines, nCols,
+                        self._output_dtype(selectedArrays[0]), geotransform,
+                        self.GEOSProjString,
+                        [self._output_missing_value(a) for a in
+                         selectedArrays],
+                        len(selectedArrays), gcps, selectedArrays,
+                        self._output_scales(selectedArrays))
+                try:
+                    for bandNumber, arrayName in enumerate(selectedArrays):
+                        with get_metrics().timer("extract", array=arrayName):
+                            self._write_values(reader, raster, arrayName,
+                                               window, bandNumber + 1)
+                finally:
+                    raster.close()
+                outputs.append(outFileName)
+            else:
+                for arrayName in selectedArrays:
+                    window = self._get_window(arrayName)
+                    nLines, nCols = window[2:]
+                    geotransform, gcps = self._window_georeferencing(window,
+                            samplePoints)
+                    outFileName = os.path.join(outFileDir, "%s_%s%s" % \
+                            (self._base_file_name(), arrayName,
+                             writer.extension))
+                    raster = writer.create(outFileName, nLines, nCols,
+                            self._output_dtype(arrayName), geotransform,
+                            self.GEOSProjString,
+                            self._output_missing_value(arrayName),
+                            gcps=gcps, bandNames=[arrayName],
+                            scales=self._output_scales([arrayName]))
+                    try:
+                        with get_metrics().timer("extract", array=arrayName):
+                            self._write_values(reader, raster, arrayName,
+                                               window)
+                    finally:
+                        raster.close()
+                    outputs.append(outFileName)
+        finally:
+            reader.close()
+        self._count_bytes_written(outputs, "extract")
+        return outputs
+
+    def _window_georeferencing(self, window, samplePoints=None):
+        """
+        Return the geotransform and the GCPs of a window of the arrays.
+
+        The GCPs are None if 'samplePoints' is None. Otherwise they are the
+        sample points, with their lines and columns moved into the window
+        and placed at the centre of their pixels.
+        """
+
+        firstLine, firstCol = window[:2]
+        gcps = None
+        if samplePoints is not None:
+            gcps = [(line - firstLine + 0.5, col - firstCol + 0.5, northing,
+                     easting) for line, col, northing, easting in
+                    samplePoints]
+        return self.get_geotransform(window), gcps
+
+    def _count_bytes_written(self, filePaths, stage):
+        """
+        Count the size of the files written by a stage.
+        """
+
+        metrics = get_metrics()
+        for filePath in filePaths:
+            if os.path.isfile(filePath):
+                metrics.count("bytes_written", os.path.getsize(filePath),
+                              stage=stage)
+
+    def _open_reader(self):
+        """
+        Return an arrayreader.ArrayReader for the instance's HDF5 file.
+        """
+
+        return ArrayReader(self.h5FilePath, self.blockLines, self.memoryMap)
+
+    def _read_values(self, reader, arrayName, window=None):
+        """
+        Read an array with an ArrayReader and return its output values.
+
+        The output values are the raw values with native types and the
+        physical values otherwise. If a window (a tuple with firstLine,
+        firstCol, nLines, nCols) is specified, only that hyperslab of the
+        array is read.
+        """
+
+        return self._output_values(reader.read(
+                self.arrays[arrayName]["path"], window), arrayName)
+
+    def _write_values(self, reader, raster, arrayName, window=None, band=1):
+        """
+        Write the output values of an array to a raster, block by block.
+
+        Only a block of lines of the array is held in memory at any time.
+        """
+
+        for firstLine, block in reader.read_blocks(
+                self.arrays[arrayName]["path"], window):
+            raster.write_block(firstLine, self._output_values(block,
+                               arrayName), band)
+
+    def georef_and_warp(self, samplePoints, outDir, projectionString=None,
+                        selectedArrays=None, warpOptions=None):
+        """
+        Georeference and warp the selected arrays in a single stage.
+
+        Inputs:
+            samplePoints - a list of tuples containing line, column, northing,
+                           easting, for each of the desired GCPs to set. This
+                           corresponds to the output of the 'get_sample_coords'
+                           method. If None, the exact geotransform is used,
+                           as in the 'georef_gtif' method.
+            outDir - The path to the desired output directory.
+            projectionString - a string, taking any of the accepted PROJ4
+                               formats for describing a projection. Defaults
+                               to +init=epsg:4326
+            selectedArrays - a list of strings specifying the name of the 
+                             arrays present in the original HDF5 file that
+                             are to be processed.
+            warpOptions - a list of additional options to pass to the warp
+                          operation.
+
+        Unlike calling 'georef_gtif' followed by 'warp', this method does not
+        write a georeferenced GeoTiff in the GEOS projection. The translate
+        operation writes a small VRT file instead, which references the
+        HDF5 array and holds the scaling and GCPs, and the warp operation
+        reads the pixels from the HDF5 file through it. The VRT file is kept
+        in memory when the backend supports it and is removed afterwards.
+
+        Returns: A list of paths to the successfully warped files.
+        """
+
+        selectedArrays = self._selected_arrays(selectedArrays)
+        warpedFiles = []
+        for arrayName in selectedArrays:
+            baseName = "%s_%s" % (self._base_file_name(), arrayName)
+            vrtPath = self.backend.temp_path("%s.vrt" % baseName)
+            outFileName = os.path.join(outDir, "%s_warped.tif" % baseName)
+            try:
+                translateOptions = ['-of', 'VRT'] + \
+                        self._translate_options(arrayName, samplePoints)
+                with get_metrics().timer("translate", array=arrayName):
+                    success = self.backend.translate(translateOptions,
+                            self._subdataset_name(arrayName), vrtPath)
+                if success:
+                    with get_metrics().timer("warp", array=arrayName):
+                        success = self.backend.warp(self._warp_options(
+                                arrayName, projectionString, warpOptions),
+                                vrtPath, outFileName)
+                if success:
+                    warpedFiles.append(outFileName)
+            finally:
+                with get_metrics().timer("cleanup"):
+                    self.backend.remove_temp(vrtPath)
+        self._count_bytes_written(warpedFiles, "warp")
+        return warpedFiles
+
+    def resample(self, outDir, projectionString=None, selectedArrays=None,
+                 method="nearest", targetGrid=None, writer=None):
+        """
+        Warp the selected arrays to the desired projection with numpy.
+
+        Inputs:
+            outDir - The path to the desired output directory.
+            projectionString - a string, taking any of the accepted PROJ4
+                               formats for describing a projection. Defaults
+                               to +init=epsg:4326
+            selectedArrays - a list of strings specifying the name of the 
+                             arrays present in the original HDF5 file that
+                             are to be processed.
+            method - the resampling method, either 'nearest' or 'bilinear'.
+            targetGrid - a tuple with a GDAL geotransform, the number of
+                         lines and the number of columns of the output
+                         files. Defaults to the grid returned by the
+                         'get_output_grid' method.
+            writer - a rasterwriters writer instance, used to write the
+                     output files. Defaults to the GDAL writer, if GDAL's
+                     python bindings are available, or the raw writer.
+
+        This method is an alternative to GDAL's warp operation. It reads
+        the arrays from the HDF5 file and resamples them with the index map
+        returned by the 'get_index_map' method. When the instance has a
+        geometry cache, the index map is computed only once for all the
+        files of a region and warping an array becomes a simple gather
+        operation.
+
+        Returns: A list of paths to the successfully warped files.
+        """
+
+        if projectionString is None:
+            projectionString = self.latLongProj
+        selectedArrays = self._selected_arrays(selectedArrays)
+        if targetGrid is None:
+            targetGrid = self.get_output_grid(projectionString)
+        if writer is None:
+            writer = get_writer(profile=self.outputProfile)
+        lines, cols = self.get_index_map(projectionString, targetGrid)
+        geotransform, nLines, nCols = targetGrid
+        warpedFiles = []
+        reader = self._open_reader()
+        try:
+            for arrayName in selectedArrays:
+                params = self.arrays[arrayName]
+                outFileName = os.path.join(outDir, "%s_%s_warped%s" % \
+                        (self._base_file_name(), arrayName, writer.extension))
+                raster = writer.create(outFileName, nLines, nCols,
+                        self._output_dtype(arrayName), geotransform,
+                        projectionString,
+                        self._output_missing_value(arrayName),
+                        bandNames=[arrayName],
+                        scales=self._output_scales([arrayName]))
+                try:
+                    # the output is written in strips of lines and only
+                    # the source pixels used by each strip are read
+                    with get_metrics().timer("resample", array=arrayName):
+                        for firstLine in range(0, nLines, self.blockLines):
+                            lastLine = min(firstLine + self.blockLines,
+                                           nLines)
+                            raster.write_block(firstLine,
+                                    self._resample_strip(reader, arrayName,
+                                    lines[firstLine:lastLine],
+                                    cols[firstLine:lastLine], method))
+                finally:
+                    raster.close()
+                warpedFiles.append(outFileName)
+        finally:
+            reader.close()
+        self._count_bytes_written(warpedFiles, "resample")
+        return warpedFiles
+
+    def _resample_strip(self, reader, arrayName, lines, cols, method):
+        """
+        Resample the part of an array that an index map strip falls on.
+        """
+
+        noData = self._output_missing_value(arrayName)
+        dtype = self._output_dtype(arrayName)
+        window = self._index_map_window(lines, cols)
+        if window is None:
+            return np.full(lines.shape, noData, dtype=dtype)
+        data = self._read_values(reader, arrayName, window)
+        # in double precision, so that the offsets don't change any rounding
+        result = resample(data, lines.astype(np.float64) - window[0],
+                          cols.astype(np.float64) - window[1], noData,
+                          method)
+        if result.dtype != dtype:
+            # interpolated raw values are rounded back to the native type
+            result = np.rint(result).astype(dtype)
+        return result
+
+    def _index_map_window(self, lines, cols):
+        """
+        Return the window of the source arrays used by an index map.
+
+        The window includes the neighbours needed for bilinear resampling.
+        Returns None if the index map does not fall on any source pixel.
+        """
+
+        valid = ~np.isnan(lines)
+        if not valid.any():
+            return None
+        nLines, nCols = self._get_dimensions()
+        firstLine = max(int(np.floor(lines[valid].min())), 0)
+        firstCol = max(int(np.floor(cols[valid].min())), 0)
+        lastLine = min(int(np.floor(lines[valid].max())) + 1, nLines - 1)
+        lastCol = min(int(np.floor(cols[valid].max())) + 1, nCols - 1)
+        return (firstLine, firstCol, lastLine - firstLine + 1,
+                lastCol - firstCol + 1)
+
+    def _crop_grid(self, targetGrid, projectionString):
+        """
+        Crop a target grid to the instance's bounding box.
+
+        The cropped grid keeps the alignment of the original grid's pixels.
+        """
+
+        geotransform, nLines, nCols = targetGrid
+        xs, ys = _transform_coords(*_densify_bbox(self.bbox),
+                                   fromProjection=self.bboxProjection,
+                                   toProjection=projectionString)
+        valid = np.isfinite(xs) & np.isfinite(ys)
+        if not valid.any():
+            raise ValueError("The bounding box %s can not be transformed to "
+                             "%s" % (self.bbox, projectionString))
+        colEdges = (np.array([xs[valid].min(), xs[valid].max()]) - \
+                    geotransform[0]) / geotransform[1]
+        lineEdges = (np.array([ys[valid].max(), ys[valid].min()]) - \
+                     geotransform[3]) / geotransform[5]
+        firstCol = min(max(int(np.floor(colEdges[0])), 0), nCols - 1)
+        lastCol = min(max(int(np.ceil(colEdges[1])), firstCol + 1), nCols)
+        firstLine = min(max(int(np.floor(lineEdges[0])), 0), nLines - 1)
+        lastLine = min(max(int(np.ceil(lineEdges[1])), firstLine + 1), nLines)
+        croppedGeotransform = (
+                geotransform[0] + firstCol * geotransform[1], geotransform[1],
+                geotransform[2],
+                geotransform[3] + firstLine * geotransform[5], geotransform[4],
+                geotransform[5])
+        return (croppedGeotransform, lastLine - firstLine, lastCol - firstCol)
+
+    def _scale(self, rawData, arrayName):
+        """
+        Convert raw array values to float32 physical values.
+
+        Pixels with the raw missing value get the scaled missing value.
+        """
+
+        params = self.arrays[arrayName]
+        return to_physical(rawData, params["scalingFactor"],
+                           params["rawMissingValue"], params["missingValue"])
+
+    def _output_values(self, rawData, arrayName):
+        """
+        Return the values of an array's output files from its raw values.
+        """
+
+        if self.nativeType:
+            return rawData
+        return self._scale(rawData, arrayName)
+
+    def _base_file_name(self):
+        """
+        Return the name of the HDF5 file, without its extension.
+        """
+
+        inFileName = os.path.basename(self.h5FilePath)
+        extensionList = inFileName.rsplit(".")
+        if len(extensionList) > 1:
+            inFileName = ".".join(extensionList[:-1])
+        return inFileName
+
+    def _selected_arrays(self, selectedArrays=None):
+        """
+        Return the names of the selected arrays, defaulting to the main one.
+        """
+
+        if selectedArrays is None:
+            selectedArrays = [k for k, v in self.arrays.items() if
+                              v.get("mainArray")]
+        return selectedArrays
+
+    def _georef_file_name(self, arrayName, outFileDir):
+        """
+        Return the path of the georeferenced GeoTiff file of an array.
+        """
+
+        return os.path.join(outFileDir, "%s_%s.tif" % (self._base_file_name(),
+                                                       arrayName))
+
+    def _warped_file_name(self, filePath, outDir):
+        """
+        Return the path of the warped file of a georeferenced file.
+        """
+
+        extList = os.path.basename(filePath).rsplit(".")
+        outName = "%s_warped.%s" % (".".join(extList[:-1]), extList[-1])
+        return os.path.join(outDir, outName)
+
+    def _georef_options(self, arrayName, samplePoints):
+        """
+        Return the list of GDAL translate options used to write the
+        georeferenced file of an array.
+        """
+
+        return self._translate_options(arrayName, samplePoints) + \
+               self.outputProfile.intermediate().gdal_options(
+                        self._output_dtype(arrayName))
+
+    def _output_dtype(self, arrayName):
+        """
+        Return the name of the data type of an array's output files.
+        """
+
+        if self.nativeType:
+            return self.arrays[arrayName]["dtype"]
+        return "float32"
+
+    def _output_missing_value(self, arrayName):
+        """
+        Return the nodata value of an array's output files.
+        """
+
+        if self.nativeType:
+            return self.arrays[arrayName]["rawMissingValue"]
+        return self.arrays[arrayName]["missingValue"]
+
+    def _output_scales(self, arrayNames):
+        """
+        Return the band scales of an output file with the given arrays.
+
+        Returns None if the file has physical values, which need no scale.
+        """
+
+        if not self.nativeType:
+            return None
+        return [1.0 / float(self.arrays[a]["scalingFactor"]) for a in
+                arrayNames]
+
+    def _translate_options(self, arrayName, samplePoints):
+        """
+        Return the list of GDAL translate options used to georeference an
+        array.
+        """
+
+        params = self.arrays[arrayName]
+        if self.nativeType:
+            # the values are kept and GDAL's scale turns them into
+            # physical values when they are read
+            translateOptions = [
+                    '-a_nodata', '%s' % params["rawMissingValue"],
+                    '-a_scale', '%r' % (1.0 / float(params["scalingFactor"])),
+                    '-a_offset', '0',
+                    '-a_srs', self.GEOSProjString,
+                    ]
+        else:
+            # the physical values are the raw values divided by the scaling
+            # factor, so the linear scale needs no minimum and maximum
+            translateOptions = [
                     '-ot', 'Float32',
-                    '-a_nodata', '%s' % missingValue,
+                    '-a_nodata', '%s' % params.get("missingValue"),
                     '-a_srs', self.GEOSProjString,
-                    '-scale', 
-                    '%s' % self.arrays[arrayName]['oldMin'],
-                    '%s' % self.arrays[arrayName]['oldMax'],
-                    '%s' % self.arrays[arrayName]['min'],
-                    '%s' % self.arrays[arrayName]['max']
+                    '-scale', '0', '%r' % float(params["scalingFactor"]), '0',
+                    '1'
                     ]
+        window = self._get_window(arrayName)
+        firstLine, firstCol, nLines, nCols = window
+        if self.window is not None:
+            translateOptions += ['-srcwin', '%i' % firstCol, '%i' % firstLine,
+                                 '%i' % nCols, '%i' % nLines]
+        if samplePoints is None:
+            (upperLeftEasting, pixelWidth, rowRotation, upperLeftNorthing,
+                colRotation, pixelHeight) = self.get_geotransform(window)
+            translateOptions += [
+                    '-a_ullr',
+                    '%r' % upperLeftEasting,
+                    '%r' % upperLeftNorthing,
+                    '%r' % (upperLeftEasting + nCols * pixelWidth),
+                    '%r' % (upperLeftNorthing + nLines * pixelHeight)]
+        else:
+            # GDAL's pixel and line coordinates start at the corner of the
+            # first pixel, and the GCPs are at the centre of their pixel
             for (line, col, northing, easting) in samplePoints:
-                translateCommand += ['-gcp', '%s' % col, '%s' % line,
+                translateOptions += ['-gcp', '%s' % (col - firstCol + 0.5),
+                                     '%s' % (line - firstLine + 0.5),
                                      '%s' % easting, '%s' % northing]
-            translateCommand += [
-                    'HDF5:"%s"://%s' % (self.h5FilePath, arrayName), 
-                    outFileName]
-            self.logger.debug('translateCommand: \n\n%s\n' % translateCommand)
-            returnCode, stdout, stderr = self._run_command(translateCommand)
-            self.logger.debug('stdout code: %s' % stdout)
-            self.logger.debug('stderr code: %s' % stderr)
-            self.logger.debug('return code: %i' % returnCode)
-            if returnCode == 0:
-                successfullGeorefs.append(outFileName)
-        return successfullGeorefs
+        return translateOptions
+
+    def _subdataset_name(self, arrayName):
+        """
+        Return the name that GDAL's HDF5 driver uses for an array.
+        """
 
-    def _run_command(self, command):
+        return 'HDF5:"%s"://%s' % (os.path.abspath(self.h5FilePath),
+                                     arrayName)
+
+    def _run_command(self, command, stdin=None):
         '''
         Run an external command and return its return code, stdout and stderr.
+
+        If 'stdin' is not None, it is written to the command's standard input.
         '''
 
-        newProcess = Popen(command, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = newProcess.communicate()
+        with get_metrics().timer("subprocess",
+                                 program=os.path.basename(command[0])):
+            newProcess = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = newProcess.communicate(stdin)
         return newProcess.returncode, stdout, stderr
 
-    def warp(self, fileList, outDir, projectionString=None):
+    def warp(self, fileList, outDir, projectionString=None,
+             warpOptions=None):
         """
         Warp the georeferenced files to the desired projection.
 
-        This method uses the external 'gdalwarp' utility program to warp
-        already georeferenced files that are in the GEOS projection to another
-        desired projection.
+        This method uses GDAL's warp operation, through the instance's
+        backend, to warp already georeferenced files that are in the GEOS
+        projection to another desired projection.
 
         Inputs:
             fileList - a list of paths pointing to already
@@ -255,33 +1642,49 @@ class H5Georef(object):
                                to +init=epsg:4326
             outdir - The path to the desired output directory. Defaults
                      to the same directory of the files in 'fileList'.
+            warpOptions - a list of additional options to pass to the warp
+                          operation, such as ['-multi', '-wo',
+                          'NUM_THREADS=ALL_CPUS'] in order to use GDAL's
+                          multithreading.
 
         Returns: A list of paths to the successfully warped files.
         """
 
-        if projectionString is None:
-            projectionString = self.latLongProj
-
         warpedFiles = []
         for filePath in fileList:
             arrayName = self._array_name_from_file(filePath)
-            missingValue = self.arrays[arrayName].get("missingValue")
-            dirName, basename = os.path.split(filePath)
-            extList = basename.rsplit(".")
-            outName = "%s_warped.%s" % (".".join(extList[:-1]), extList[-1])
-            outFileName = os.path.join(outDir, outName)
-            warpCommand = ['gdalwarp', '-dstnodata', '%s' % missingValue, 
-                           '-s_srs', '%s' % self.GEOSProjString, '-t_srs', 
-                           '%s' % projectionString, filePath, outFileName]
-            self.logger.debug('warpCommand:\n\n%s\n' % warpCommand)
-            returnCode, stdout, stderr = self._run_command(warpCommand)
-            self.logger.debug('stdout: %s' % stdout)
-            self.logger.debug('stderr: %s' % stderr)
-            self.logger.debug('returnCode: %s' % returnCode)
-            if returnCode == 0:
+            outFileName = self._warped_file_name(filePath, outDir)
+            with get_metrics().timer("warp", array=arrayName):
+                success = self.backend.warp(self._warp_options(arrayName,
+                        projectionString, warpOptions), filePath, outFileName)
+            if success:
                 warpedFiles.append(outFileName)
+        self._count_bytes_written(warpedFiles, "warp")
         return warpedFiles
 
+    def _warp_options(self, arrayName, projectionString=None,
+                      warpOptions=None):
+        """
+        Return the list of GDAL warp options used to warp an array.
+        """
+
+        if projectionString is None:
+            projectionString = self.latLongProj
+        missingValue = self.arrays[arrayName].get("missingValue")
+        if self.nativeType:
+            missingValue = self.arrays[arrayName]["rawMissingValue"]
+        options = ['-dstnodata', '%s' % missingValue, 
+                   '-s_srs', '%s' % self.GEOSProjString, '-t_srs', 
+                   '%s' % projectionString]
+        options += self.outputProfile.gdal_options(
+                self._output_dtype(arrayName))
+        if self.bbox is not None:
+            options += ['-te'] + ['%r' % float(c) for c in self.bbox] + \
+                       ['-te_srs', self.bboxProjection]
+        if warpOptions is not None:
+            options += warpOptions
+        return options
+
     def _array_name_from_file(self, filePath):
         """
         Extract the name of the array from the input filePath.
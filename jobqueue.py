@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Queues of file processing jobs, shared by workers on many machines.
+
+A job is an HDF5 file to process, along with the processing parameters, as
+built by georef_hdf5's 'make_params' function. Workers take jobs from the
+queue with a lease, which expires after some time unless it is renewed, so
+that the jobs of workers that die are given to other workers. Jobs that
+fail are retried, up to a maximum number of attempts.
+
+A queue exposes the following methods:
+    submit(filePath, params, maxAttempts) - Add a job and return its id.
+    lease(workerId, leaseTime) - Return the next pending job, or a job whose
+                                 lease has expired, as a Job, or None if
+                                 there is no such job.
+    renew(job, leaseTime) - Extend a job's lease. Returns False if the lease
+                            has been lost.
+    complete(job, result) - Record the result of a successful job.
+    fail(job, error) - Record the error of a failed job, which is pending
+                       again, unless it has no attempts left.
+    counts() - Return a dictionary with the number of 'pending', 'leased',
+               'done' and 'failed' jobs.
+    close()
+
+'complete' and 'fail' return False, and do nothing, when the job's lease
+has been lost. Other brokers, such as Redis, can be used by implementing
+these methods.
+
+Available queues:
+    SQLiteQueue - Keeps the jobs in an SQLite database. The database can be
+                  on shared storage whose file locks SQLite can rely on.
+    FilesystemQueue - Keeps each job in a JSON file, in a directory for
+                      each state, and moves the files with atomic renames,
+                      so that it works on shared storage without reliable
+                      locks, such as NFS.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+from contextlib import contextmanager
+
+
+class Job(object):
+
+    def __init__(self, jobId, filePath, params, attempts, maxAttempts,
+                 leaseId):
+        """
+        Inputs:
+            jobId - the id of the job in its queue.
+            filePath - path to the HDF5 file to process.
+            params - a dictionary with the processing parameters.
+            attempts - the number of times the job has been leased,
+                       including this one.
+            maxAttempts - the number of attempts after which a failed job
+                          is given up.
+            leaseId - identifies the lease in the queue, which may change
+                      it when the lease is renewed.
+        """
+
+        self.jobId = jobId
+        self.filePath = filePath
+        self.params = params
+        self.attempts = attempts
+        self.maxAttempts = maxAttempts
+        self.leaseId = leaseId
+
+
+class SQLiteQueue(object):
+
+    name = "sqlite"
+
+    def __init__(self, queuePath):
+        """
+        Inputs:
+            queuePath - path to the SQLite database. It is created if it
+                        does not exist.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # transactions are started explicitly, so that leasing a job
+        # holds the database's write lock from the start
+        self.connection = sqlite3.connect(queuePath, timeout=60,
+                                          isolation_level=None)
+        self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, file TEXT, "
+                "params TEXT, state TEXT, attempts INTEGER, "
+                "max_attempts INTEGER, worker TEXT, lease TEXT, "
+                "expires REAL, submitted REAL, finished REAL, result TEXT, "
+                "error TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state "
+                                "ON jobs (state, id)")
+
+    @contextmanager
+    def _transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def submit(self, filePath, params, maxAttempts=3):
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                    "INSERT INTO jobs (file, params, state, attempts, "
+                    "max_attempts, submitted) VALUES (?, ?, 'pending', 0, "
+                    "?, ?)", (filePath, json.dumps(params), maxAttempts,
+                    time.time()))
+        return cursor.lastrowid
+
+    def lease(self, workerId, leaseTime):
+        now = time.time()
+        leaseId = uuid.uuid4().hex
+        with self._transaction() as connection:
+            connection.execute(
+                    "UPDATE jobs SET state = 'failed', error = 'The lease "
+                    "of ' || worker || ' expired' WHERE state = 'leased' "
+                    "AND expires < ? AND attempts >= max_attempts", (now,))
+            row = connection.execute(
+                    "SELECT id, file, params, attempts, max_attempts FROM "
+                    "jobs WHERE state = 'pending' OR (state = 'leased' AND "
+                    "expires < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                    "UPDATE jobs SET state = 'leased', attempts = attempts "
+                    "+ 1, worker = ?, lease = ?, expires = ? WHERE id = ?",
+                    (workerId, leaseId, now + leaseTime, row[0]))
+        jobId, filePath, params, attempts, maxAttempts = row
+        return Job(jobId, filePath, json.loads(params), attempts + 1,
+                   maxAttempts, leaseId)
+
+    def renew(self, job, leaseTime):
+        return self._update_leased(job, "expires = ?",
+                                   (time.time() + leaseTime,))
+
+    def complete(self, job, result):
+        return self._update_leased(job, "state = 'done', finished = ?, "
+                                   "result = ?", (time.time(),
+                                   json.dumps(result)))
+
+    def fail(self, job, error):
+        return self._update_leased(job, "state = CASE WHEN attempts >= "
+                                   "max_attempts THEN 'failed' ELSE "
+                                   "'pending' END, finished = ?, error = ?",
+                                   (time.time(), error))
+
+    def _update_leased(self, job, assignments, values):
+        """
+        Update a job, if its lease has not been lost, and return True.
+        """
+
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                    "UPDATE jobs SET %s WHERE id = ? AND lease = ? AND "
+                    "state = 'leased'" % assignments,
+                    tuple(values) + (job.jobId, job.leaseId))
+        return cursor.rowcount == 1
+
+    def counts(self):
+        counts = dict((state, 0) for state in ("pending", "leased", "done",
+                                               "failed"))
+        counts.update(self.connection.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return counts
+
+    def close(self):
+        self.connection.close()
+
+
+class FilesystemQueue(object):
+
+    name = "filesystem"
+
+    def __init__(self, queuePath):
+        """
+        Inputs:
+            queuePath - path to the directory of the queue. It is created
+                        if it does not exist.
+
+        Each job is a JSON file in the 'pending', 'leased', 'done' or
+        'failed' subdirectory. A worker leases a job by renaming its file
+        into the 'leased' directory, and only one of the workers that try
+        to rename it succeeds. The name of a leased file holds the id of
+        its lease and the time when it expires, so renewing a lease is
+        also a rename, which fails once the lease has been lost.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.queuePath = queuePath
+        for dirName in ("pending", "leased", "done", "failed", "tmp"):
+            dirPath = os.path.join(queuePath, dirName)
+            if not os.path.isdir(dirPath):
+                try:
+                    os.makedirs(dirPath)
+                except OSError:
+                    # created by another worker in the meantime
+                    if not os.path.isdir(dirPath):
+                        raise
+
+    def _path(self, dirName, fileName):
+        return os.path.join(self.queuePath, dirName, fileName)
+
+    def _read(self, path):
+        with open(path) as fh:
+            return json.load(fh)
+
+    def _write(self, path, data):
+        # written to a temporary file first, so that the job's file is
+        # never seen half written
+        tmpPath = self._path("tmp", "%s.tmp" % uuid.uuid4().hex)
+        with open(tmpPath, "w") as fh:
+            json.dump(data, fh)
+        os.rename(tmpPath, path)
+
+    def _leased_name(self, jobId, leaseId, expires):
+        # the expiry time, in milliseconds
+        return "%s.%s.%i.json" % (jobId, leaseId, expires * 1000)
+
+    def submit(self, filePath, params, maxAttempts=3):
+        # ids sort in submission order
+        jobId = "%016x-%s" % (int(time.time() * 1e6), uuid.uuid4().hex[:8])
+        self._write(self._path("pending", "%s.json" % jobId),
+                    {"id" : jobId, "file" : filePath, "params" : params,
+                     "attempts" : 0, "maxAttempts" : maxAttempts,
+                     "submitted" : time.time(), "errors" : []})
+        return jobId
+
+    def lease(self, workerId, leaseTime):
+        self._reclaim_expired()
+        for fileName in sorted(os.listdir(self._path("pending", ""))):
+            jobId = fileName[:-len(".json")]
+            leasedName = self._leased_name(jobId, uuid.uuid4().hex,
+                                           time.time() + leaseTime)
+            try:
+                os.rename(self._path("pending", fileName),
+                          self._path("leased", leasedName))
+            except OSError:
+                # leased by another worker
+                continue
+            data = self._read(self._path("leased", leasedName))
+            data["attempts"] += 1
+            data["worker"] = workerId
+            self._write(self._path("leased", leasedName), data)
+            return Job(jobId, data["file"], data["params"], data["attempts"],
+                       data["maxAttempts"], leasedName)
+        return None
+
+    def _reclaim_expired(self):
+        now = time.time()
+        for leasedName in os.listdir(self._path("leased", "")):
+            jobId, leaseId, expires = leasedName.split(".")[:3]
+            if int(expires) / 1000.0 >= now:
+                continue
+            job = Job(jobId, None, None, None, None, leasedName)
+            self._release(job, lambda data: data["errors"].append(
+                    "The lease of %s expired" % data.get("worker")))
+
+    def _release(self, job, update):
+        """
+        Move a leased job to its next state, and return True.
+
+        Inputs:
+            job - the leased job.
+            update - a function that receives the job's data, as a
+                     dictionary, and updates it.
+
+        Returns False if the job's lease has been lost.
+        """
+
+        # the job's file is first renamed to a private name, so that the
+        # lease can't be lost while the file is updated
+        privatePath = self._path("tmp", job.leaseId)
+        try:
+            os.rename(self._path("leased", job.leaseId), privatePath)
+        except OSError:
+            return False
+        data = self._read(privatePath)
+        update(data)
+        if "result" in data:
+            state = "done"
+        elif data["attempts"] >= data["maxAttempts"]:
+            state = "failed"
+        else:
+            state = "pending"
+        self._write(privatePath, data)
+        os.rename(privatePath, self._path(state, "%s.json" % job.jobId))
+        return True
+
+    def renew(self, job, leaseTime):
+        jobId, leaseId = job.leaseId.split(".")[:2]
+        leasedName = self._leased_name(jobId, leaseId,
+                                       time.time() + leaseTime)
+        try:
+            os.rename(self._path("leased", job.leaseId),
+                      self._path("leased", leasedName))
+        except OSError:
+            return False
+        job.leaseId = leasedName
+        return True
+
+    def complete(self, job, result):
+        def update(data):
+            data["result"] = result
+            data["finished"] = time.time()
+        return self._release(job, update)
+
+    def fail(self, job, error):
+        def update(data):
+            data["errors"].append(error)
+            data["finished"] = time.time()
+        return self._release(job, update)
+
+    def counts(self):
+        return dict((state, len(os.listdir(self._path(state, "")))) for
+                    state in ("pending", "leased", "done", "failed"))
+
+    def close(self):
+        pass
+
+
+QUEUES = {
+    SQLiteQueue.name : SQLiteQueue,
+    FilesystemQueue.name : FilesystemQueue,
+}
+
+def get_queue(name, queuePath):
+    """
+    Return a queue of the given type, kept at 'queuePath'.
+    """
+
+    try:
+        queueClass = QUEUES[name]
+    except KeyError:
+        raise ValueError("Invalid queue: %s. Choose one of %s" %
+                         (name, sorted(QUEUES.keys())))
+    return queueClass(queuePath)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Deferred imports of the heavy libraries.
+
+Importing numpy and pytables takes several times longer than starting the
+python interpreter, which is paid by every run of the command line script,
+even by those that only print its help. Modules that need these libraries
+bind them with 'lazy_import' instead:
+
+    np = lazy_import("numpy")
+
+The library is only imported when one of its attributes is first used, so
+the import is paid by the code paths that actually need it.
+"""
+
+import types
+import importlib
+
+
+class _LazyModule(types.ModuleType):
+    """
+    A stand-in for a module that imports it on the first attribute access.
+    """
+
+    def __getattr__(self, attr):
+        # only called for the attributes that are not yet cached
+        module = importlib.import_module(self.__name__)
+        value = getattr(module, attr)
+        setattr(self, attr, value)
+        return value
+
+
+def lazy_import(moduleName):
+    """
+    Return a module that is only imported when first used.
+
+    Inputs:
+        moduleName - the full name of the module, such as 'numpy' or
+                     'osgeo.gdal'.
+    """
+
+    return _LazyModule(moduleName)
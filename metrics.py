@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Timers and counters for the processing stages.
+
+The code reports how long each stage takes, and counts things such as the
+bytes written, through the process' Metrics instance, which is returned by
+the 'get_metrics' function:
+
+    metrics = get_metrics()
+    with metrics.timer("warp", program="gdalwarp"):
+        ...
+    metrics.count("bytes_written", 1024, stage="warp")
+
+Each measure is sent as an event, a dictionary, to the sinks that are in
+use by the current thread, so that threads processing different files keep
+their measures apart. Events are dropped when there are no sinks.
+
+Available sinks:
+    JSONLinesSink - Appends each event to a file, as a line of JSON. Several
+                    processes can append to the same file.
+    Aggregator - Keeps, in memory, the number of events, total, minimum and
+                 maximum time of each timer and the total of each counter.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._local = threading.local()
+
+    def _get_sinks(self):
+        """
+        Return the list of the sinks in use by the current thread.
+        """
+
+        if not hasattr(self._local, "sinks"):
+            self._local.sinks = []
+        return self._local.sinks
+
+    @contextmanager
+    def using(self, *sinks):
+        """
+        Send the current thread's events to some sinks while in a 'with'
+        block.
+        """
+
+        threadSinks = self._get_sinks()
+        threadSinks.extend(sinks)
+        try:
+            yield self
+        finally:
+            for sink in sinks:
+                threadSinks.remove(sink)
+
+    @contextmanager
+    def timer(self, name, **tags):
+        """
+        Time the code in a 'with' block.
+
+        Inputs:
+            name - the name of the stage being timed.
+            tags - further information about the event, such as the name of
+                   the array or program. Values must be serializable as JSON.
+        """
+
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            if len(self._get_sinks()) > 0:
+                self.emit({"type" : "timer", "name" : name,
+                           "start" : startTime,
+                           "seconds" : time.time() - startTime,
+                           "tags" : tags})
+
+    def count(self, name, value=1, **tags):
+        """
+        Add a value to a counter.
+        """
+
+        if len(self._get_sinks()) > 0:
+            self.emit({"type" : "counter", "name" : name, "value" : value,
+                       "start" : time.time(), "tags" : tags})
+
+    def emit(self, event):
+        event["pid"] = os.getpid()
+        for sink in self._get_sinks():
+            sink.handle(event)
+
+
+class JSONLinesSink(object):
+
+    def __init__(self, path):
+        """
+        Inputs:
+            path - the path of the file where events are appended.
+        """
+
+        self.path = path
+        self.fh = open(path, "a")
+
+    def handle(self, event):
+        # a single write of a whole line keeps the lines of different
+        # processes from mixing
+        self.fh.write(json.dumps(event) + "\n")
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+
+class Aggregator(object):
+
+    def __init__(self):
+        self.timers = dict()
+        self.counters = dict()
+
+    def handle(self, event):
+        if event["type"] == "timer":
+            self._add_timer(event["name"], 1, event["seconds"],
+                            event["seconds"], event["seconds"])
+        elif event["type"] == "counter":
+            self.counters[event["name"]] = \
+                    self.counters.get(event["name"], 0) + event["value"]
+
+    def _add_timer(self, name, count, total, minimum, maximum):
+        if name not in self.timers:
+            self.timers[name] = {"count" : 0, "total" : 0.0,
+                                 "min" : minimum, "max" : maximum}
+        timer = self.timers[name]
+        timer["count"] += count
+        timer["total"] += total
+        timer["min"] = min(timer["min"], minimum)
+        timer["max"] = max(timer["max"], maximum)
+
+    def summary(self):
+        """
+        Return a dictionary with the aggregated timers and counters.
+
+        It can be serialized as JSON and merged into another aggregator.
+        """
+
+        return {"timers" : dict((k, dict(v)) for k, v in
+                                self.timers.items()),
+                "counters" : dict(self.counters)}
+
+    def merge(self, summary):
+        """
+        Add the summary of another aggregator, such as a worker process'.
+        """
+
+        for name, timer in summary["timers"].items():
+            self._add_timer(name, timer["count"], timer["total"],
+                            timer["min"], timer["max"])
+        for name, value in summary["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def format_summary(self):
+        """
+        Return a text table with the aggregated timers and counters.
+        """
+
+        lines = ["%-15s %8s %10s %10s %10s %10s" % ("stage", "count",
+                 "total(s)", "mean(s)", "min(s)", "max(s)")]
+        # the slowest stages first
+        for name, timer in sorted(self.timers.items(),
+                                  key=lambda item: -item[1]["total"]):
+            lines.append("%-15s %8i %10.3f %10.3f %10.3f %10.3f" % (name,
+                         timer["count"], timer["total"],
+                         timer["total"] / timer["count"], timer["min"],
+                         timer["max"]))
+        for name, value in sorted(self.counters.items()):
+            lines.append("%-15s %8s" % (name, value))
+        return "\n".join(lines)
+
+
+_metrics = Metrics()
+
+def get_metrics():
+    """
+    Return the Metrics instance of the current process.
+    """
+
+    return _metrics
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+A persistent record of the outputs produced from each HDF5 file.
+
+Each output is recorded along with the modification time and size of the
+HDF5 file it was produced from, the selected datasets, the projection
+string, the version of the tool and the other settings that change the
+outputs. An HDF5 file whose outputs all exist and were produced from the
+same version of the file, with the same parameters, is up to date and needs
+not be processed again.
+
+The record is kept in an SQLite database, which is updated as each file is
+processed, so that it survives an interrupted run.
+"""
+
+import os
+import json
+import logging
+import sqlite3
+
+
+class OutputLedger(object):
+
+    def __init__(self, ledgerPath, toolVersion):
+        """
+        Inputs:
+            ledgerPath - path to the SQLite database. It is created if it
+                         does not exist.
+            toolVersion - a string with the version of the tool producing
+                          the outputs. Outputs from other versions are stale.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.toolVersion = toolVersion
+        self.connection = sqlite3.connect(ledgerPath)
+        self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS outputs ("
+                "output TEXT PRIMARY KEY, input TEXT, mtime REAL, "
+                "size INTEGER, datasets TEXT, projection TEXT, "
+                "version TEXT, settings TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS outputs_input "
+                                "ON outputs (input)")
+        self.connection.commit()
+
+    def get_outputs(self, h5FilePath, datasets, projectionString, settings):
+        """
+        Return the outputs of a file if they are up to date, or None.
+
+        Inputs:
+            h5FilePath - path to the HDF5 file.
+            datasets - a list with the names of the selected datasets, or
+                       None if only the main dataset is selected.
+            projectionString - the projection string of the outputs.
+            settings - a dictionary with the other parameters that change
+                       the outputs. Its values must be serializable as JSON.
+
+        Returns: A list with the paths of the outputs, or None if the file
+        has no recorded outputs or some of them are stale or missing.
+        """
+
+        inputPath = os.path.abspath(h5FilePath)
+        rows = self.connection.execute(
+                "SELECT output, mtime, size, datasets, projection, version, "
+                "settings FROM outputs WHERE input = ? ORDER BY output",
+                (inputPath,)).fetchall()
+        if len(rows) == 0:
+            return None
+        stat = os.stat(inputPath)
+        current = (stat.st_mtime, stat.st_size, self._encode(datasets),
+                   projectionString, self.toolVersion,
+                   self._encode(settings))
+        for row in rows:
+            if tuple(row[1:]) != current:
+                self.logger.debug("%s is stale" % row[0])
+                return None
+            if not os.path.isfile(row[0]):
+                self.logger.debug("%s is missing" % row[0])
+                return None
+        return [row[0] for row in rows]
+
+    def record(self, h5FilePath, outputs, datasets, projectionString,
+               settings):
+        """
+        Replace the recorded outputs of a file.
+
+        See the 'get_outputs' method for a description of the arguments.
+        'outputs' is the list of paths of the outputs that were produced.
+        """
+
+        inputPath = os.path.abspath(h5FilePath)
+        stat = os.stat(inputPath)
+        self.connection.execute("DELETE FROM outputs WHERE input = ?",
+                                (inputPath,))
+        self.connection.executemany(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(os.path.abspath(output), inputPath, stat.st_mtime,
+                  stat.st_size, self._encode(datasets), projectionString,
+                  self.toolVersion, self._encode(settings)) for
+                 output in outputs])
+        self.connection.commit()
+
+    def forget(self, h5FilePath):
+        """
+        Remove the recorded outputs of a file, so that it is processed again.
+        """
+
+        self.connection.execute("DELETE FROM outputs WHERE input = ?",
+                                (os.path.abspath(h5FilePath),))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _encode(self, value):
+        # sorting the keys makes equal dictionaries compare equal as text
+        return json.dumps(value, sort_keys=True)
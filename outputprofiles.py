@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Output profiles: the format, layout and compression of the output rasters.
+
+By default GDAL writes stripped and uncompressed GeoTiffs, which are slow to
+serve and take much more space than needed. A profile selects the GDAL
+driver and creation options of the files written by the translate and warp
+operations and by the in-process writers.
+
+Available profiles:
+    plain - GDAL's defaults.
+    tiled - Tiled GeoTiffs, without compression.
+    deflate, lzw, zstd - Tiled GeoTiffs, compressed with DEFLATE, LZW or
+                         ZSTD and a predictor suited to the data type. ZSTD
+                         requires a GDAL (>= 2.3) built with it.
+    cog - Cloud Optimized GeoTiffs, DEFLATE compressed, with internal
+          overviews. It requires GDAL >= 3.1. The intermediary files in the
+          GEOS projection are tiled DEFLATE compressed GeoTiffs instead,
+          without overviews.
+"""
+
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+
+
+class OutputProfile(object):
+
+    def __init__(self, name, driverName="GTiff", tiled=False, compress=None,
+                 blockSize=256):
+        """
+        Inputs:
+            name - the name of the profile.
+            driverName - the short name of the GDAL driver, either 'GTiff'
+                         or 'COG'.
+            tiled - a boolean. If True, the GeoTiffs are tiled. COG files
+                    are always tiled.
+            compress - the name of the compression method, such as
+                       'DEFLATE', 'LZW' or 'ZSTD'. If None, the files are
+                       not compressed.
+            blockSize - the number of lines and columns of the tiles.
+        """
+
+        self.name = name
+        self.driverName = driverName
+        self.tiled = tiled or driverName == "COG"
+        self.compress = compress
+        self.blockSize = blockSize
+
+    def creation_options(self, dtype):
+        """
+        Return a list with the GDAL creation options of a raster.
+
+        Inputs:
+            dtype - the numpy data type of the raster's pixels, which
+                    selects the predictor: floating point prediction for
+                    floats and horizontal differencing for integers.
+        """
+
+        options = []
+        if self.driverName == "COG":
+            options.append("BLOCKSIZE=%i" % self.blockSize)
+            if self.compress is not None:
+                options += ["COMPRESS=%s" % self.compress, "PREDICTOR=YES"]
+            return options
+        if self.tiled:
+            options += ["TILED=YES", "BLOCKXSIZE=%i" % self.blockSize,
+                        "BLOCKYSIZE=%i" % self.blockSize]
+        if self.compress is not None:
+            predictor = 3 if np.dtype(dtype).kind == "f" else 2
+            options += ["COMPRESS=%s" % self.compress,
+                        "PREDICTOR=%i" % predictor]
+        return options
+
+    def gdal_options(self, dtype):
+        """
+        Return the format and creation options of a GDAL operation.
+
+        Inputs:
+            dtype - the numpy data type of the output's pixels.
+
+        Returns: A list with the '-of' and '-co' options for the translate
+        and warp operations.
+        """
+
+        options = ['-of', self.driverName]
+        for option in self.creation_options(dtype):
+            options += ['-co', option]
+        return options
+
+    def intermediate(self):
+        """
+        Return the profile of the intermediary files of this profile.
+
+        Overviews are of no use in files that are only read to be warped,
+        so COG profiles have tiled GeoTiff intermediaries, with the same
+        compression.
+        """
+
+        if self.driverName == "GTiff":
+            return self
+        return OutputProfile(self.name, "GTiff", True, self.compress,
+                             self.blockSize)
+
+
+PROFILES = {
+    "plain" : OutputProfile("plain"),
+    "tiled" : OutputProfile("tiled", tiled=True),
+    "deflate" : OutputProfile("deflate", tiled=True, compress="DEFLATE"),
+    "lzw" : OutputProfile("lzw", tiled=True, compress="LZW"),
+    "zstd" : OutputProfile("zstd", tiled=True, compress="ZSTD"),
+    "cog" : OutputProfile("cog", driverName="COG", compress="DEFLATE"),
+}
+
+def get_profile(name):
+    """
+    Return the output profile with the given name.
+    """
+
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError("Invalid output profile: %s. Choose one of %s" %
+                         (name, sorted(PROFILES.keys())))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Writers for the rasters produced in-process from numpy arrays.
+
+A writer's 'create' method returns an output raster, whose 'write_block'
+method writes a block of lines and whose 'close' method finishes the file.
+This allows rasters to be written strip by strip.
+
+Available writers:
+    GDALWriter - Writes any format supported by GDAL, GeoTiff by default.
+                 It requires GDAL's python bindings.
+    RawWriter - Writes the pixels as a flat binary file, along with an ENVI
+                header, using only numpy.
+"""
+
+import os
+import sys
+import logging
+
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+
+
+class GDALWriter(object):
+
+    name = "gdal"
+    extension = ".tif"
+
+    def __init__(self, driverName="GTiff", creationOptions=None,
+                 profile=None):
+        """
+        Inputs:
+            driverName - the short name of the GDAL driver to use.
+            creationOptions - a list of the driver's creation options, such
+                              as ['TILED=YES', 'COMPRESS=DEFLATE'].
+            profile - an outputprofiles.OutputProfile instance. If given,
+                      it sets the driver and creation options instead.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # importing here so that the raw writer does not require the GDAL
+        # python bindings to be installed
+        from osgeo import gdal, gdal_array, osr
+        self.gdal = gdal
+        self.gdal_array = gdal_array
+        self.osr = osr
+        self.gdal.UseExceptions()
+        self.driverName = driverName
+        self.creationOptions = creationOptions or []
+        self.profile = profile
+        if profile is not None:
+            self.driverName = profile.driverName
+
+    def create(self, path, nLines, nCols, dtype, geotransform,
+               projectionString, noData=None, numBands=1, gcps=None,
+               bandNames=None, scales=None):
+        """
+        Create a new raster and return it, ready to be written.
+
+        Inputs:
+            path - the path of the new raster.
+            nLines, nCols - the dimensions of the raster.
+            dtype - the numpy data type of the pixels.
+            geotransform - a tuple with the six coefficients of a GDAL
+                           geotransform. It is ignored if 'gcps' is given.
+            projectionString - a string, taking any of the accepted PROJ4
+                               formats for describing a projection.
+            noData - the value of the pixels with no data, or a list with
+                     the value of each band.
+            numBands - the number of bands of the raster.
+            gcps - a list of tuples containing line, column, northing,
+                   easting, to georeference the raster with GCPs instead of
+                   a geotransform.
+            bandNames - a list with a name for each band.
+            scales - a list with the scale of each band, by which its values
+                     are multiplied to get physical values.
+        """
+
+        driver = self.gdal.GetDriverByName(self.driverName)
+        gdalType = self.gdal_array.NumericTypeCodeToGDALTypeCode(
+                np.dtype(dtype).type)
+        creationOptions = self.creationOptions
+        if self.profile is not None:
+            creationOptions = self.profile.creation_options(dtype)
+        copyDriver = None
+        if driver.GetMetadataItem(self.gdal.DCAP_CREATE) != "YES":
+            # drivers such as COG can only copy a complete dataset, so the
+            # raster is written in memory and copied when it is closed
+            copyDriver = driver
+            dataset = self.gdal.GetDriverByName("MEM").Create("", nCols,
+                    nLines, numBands, gdalType)
+        else:
+            dataset = driver.Create(path, nCols, nLines, numBands, gdalType,
+                                    creationOptions)
+        spatialRef = self.osr.SpatialReference()
+        spatialRef.SetFromUserInput(projectionString)
+        if gcps is None:
+            dataset.SetGeoTransform(geotransform)
+            dataset.SetProjection(spatialRef.ExportToWkt())
+        else:
+            dataset.SetGCPs([self.gdal.GCP(easting, northing, 0, col, line)
+                             for line, col, northing, easting in gcps],
+                            spatialRef.ExportToWkt())
+        noDataValues = _band_values(noData, numBands)
+        for bandNumber in range(1, numBands + 1):
+            band = dataset.GetRasterBand(bandNumber)
+            if noDataValues is not None:
+                band.SetNoDataValue(float(noDataValues[bandNumber - 1]))
+            if bandNames is not None:
+                band.SetDescription(bandNames[bandNumber - 1])
+            if scales is not None:
+                band.SetScale(scales[bandNumber - 1])
+                band.SetOffset(0.0)
+        return _GDALRaster(dataset, path, copyDriver, creationOptions)
+
+
+class _GDALRaster(object):
+
+    def __init__(self, dataset, path, copyDriver=None, creationOptions=None):
+        self.dataset = dataset
+        self.path = path
+        self.copyDriver = copyDriver
+        self.creationOptions = creationOptions
+
+    def write_block(self, firstLine, block, band=1):
+        """
+        Write a 2D block of lines, starting at 'firstLine', to a band.
+        """
+
+        self.dataset.GetRasterBand(band).WriteArray(block, 0, firstLine)
+
+    def close(self):
+        if self.copyDriver is not None:
+            self.copyDriver.CreateCopy(self.path, self.dataset, 0,
+                                       self.creationOptions)
+        # dereferencing the dataset closes it, flushing it to disk
+        self.dataset = None
+
+
+class RawWriter(object):
+
+    name = "raw"
+    extension = ".bin"
+
+    # ENVI's codes for numpy's data types
+    enviTypes = {
+        "uint8" : 1, "int16" : 2, "int32" : 3, "float32" : 4, "float64" : 5,
+        "uint16" : 12, "uint32" : 13, "int64" : 14, "uint64" : 15,
+    }
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def create(self, path, nLines, nCols, dtype, geotransform,
+               projectionString, noData=None, numBands=1, gcps=None,
+               bandNames=None, scales=None):
+        """
+        Create a new raster and return it, ready to be written.
+
+        See GDALWriter's 'create' method for a description of the arguments.
+        Bands are stored sequentially (ENVI's band sequential interleave).
+        GCPs are not supported, and all the bands must have the same
+        nodata value, as ENVI headers only have one.
+        """
+
+        if gcps is not None:
+            raise ValueError("The raw writer does not support GCPs")
+        noDataValues = _band_values(noData, numBands)
+        if noDataValues is not None:
+            if len(set(noDataValues)) > 1:
+                raise ValueError("The raw writer does not support bands "
+                                 "with different nodata values")
+            noData = noDataValues[0]
+        dtype = np.dtype(dtype)
+        headerLines = [
+            "ENVI",
+            "description = {%s}" % projectionString,
+            "samples = %i" % nCols,
+            "lines = %i" % nLines,
+            "bands = %i" % numBands,
+            "header offset = 0",
+            "file type = ENVI Standard",
+            "data type = %i" % self.enviTypes[dtype.name],
+            "interleave = bsq",
+            "byte order = %i" % _envi_byte_order(dtype),
+            "map info = {Arbitrary, 1, 1, %r, %r, %r, %r}" % \
+                    (geotransform[0], geotransform[3], geotransform[1],
+                     -geotransform[5]),
+        ]
+        if noData is not None:
+            headerLines.append("data ignore value = %s" % noData)
+        if bandNames is not None:
+            headerLines.append("band names = {%s}" % ", ".join(bandNames))
+        if scales is not None:
+            headerLines += [
+                "data gain values = {%s}" % ", ".join(["%r" % s for s in
+                                                       scales]),
+                "data offset values = {%s}" % ", ".join(["0"] * numBands)]
+        fh = open("%s.hdr" % os.path.splitext(path)[0], "w")
+        try:
+            fh.write("\n".join(headerLines) + "\n")
+        finally:
+            fh.close()
+        return _RawRaster(path, nLines, nCols, dtype, numBands)
+
+
+def _band_values(value, numBands):
+    """
+    Return a list with a value for each band, from a single value or a list.
+    """
+
+    if value is None or isinstance(value, (list, tuple)):
+        return value
+    return [value] * numBands
+
+def _envi_byte_order(dtype):
+    """
+    Return ENVI's byte order code: 0 for little endian and 1 for big endian.
+    """
+
+    if dtype.byteorder == ">" or (dtype.byteorder == "=" and
+                                  sys.byteorder == "big"):
+        return 1
+    return 0
+
+
+class _RawRaster(object):
+
+    def __init__(self, path, nLines, nCols, dtype, numBands):
+        self.path = path
+        self.nLines = nLines
+        self.nCols = nCols
+        self.dtype = dtype
+        self.fh = open(path, "wb")
+        self.fh.truncate(nLines * nCols * numBands * dtype.itemsize)
+
+    def write_block(self, firstLine, block, band=1):
+        """
+        Write a 2D block of lines, starting at 'firstLine', to a band.
+        """
+
+        offset = ((band - 1) * self.nLines + firstLine) * self.nCols
+        self.fh.seek(offset * self.dtype.itemsize)
+        self.fh.write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+
+    def close(self):
+        self.fh.close()
+
+
+WRITERS = {
+    GDALWriter.name : GDALWriter,
+    RawWriter.name : RawWriter,
+}
+
+def get_writer(name=None, profile=None):
+    """
+    Return a new instance of the writer with the given name.
+
+    If name is None, the GDAL writer is returned when GDAL's python bindings
+    are available and the raw writer otherwise. The output profile, an
+    outputprofiles.OutputProfile instance, is used by the GDAL writer.
+    """
+
+    if name is None:
+        try:
+            return GDALWriter(profile=profile)
+        except ImportError:
+            return RawWriter()
+    try:
+        writerClass = WRITERS[name]
+    except KeyError:
+        raise ValueError("Invalid writer: %s. Choose one of %s" %
+                         (name, sorted(WRITERS.keys())))
+    if writerClass is GDALWriter:
+        return GDALWriter(profile=profile)
+    return writerClass()
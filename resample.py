@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Vectorized resampling of arrays with precomputed index maps.
+
+An index map holds, for each pixel of a target grid, the fractional line
+and column indexes of the source pixel that it falls on, as returned by
+H5Georef's 'get_index_map' method. Indexes refer to the centre of the source
+pixels and target pixels with no source pixel are set to NaN. Once the index
+map of a region is known, resampling a new array is just a gather operation.
+"""
+
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+
+METHODS = ("nearest", "bilinear")
+
+def resample(data, lines, cols, noData, method="nearest"):
+    """
+    Resample an array with an index map.
+
+    Inputs:
+        data - a 2D numpy array with the source pixels.
+        lines - a numpy array with the fractional source line index of
+                each target pixel.
+        cols - a numpy array with the fractional source column index of
+               each target pixel.
+        noData - the value of the source pixels that have no data. It is
+                 also the value given to the target pixels with no source.
+        method - the resampling method, either 'nearest' or 'bilinear'.
+
+    Returns: A numpy array shaped like 'lines' with the resampled values.
+    """
+
+    if method == "nearest":
+        return resample_nearest(data, lines, cols, noData)
+    elif method == "bilinear":
+        return resample_bilinear(data, lines, cols, noData)
+    raise ValueError("Invalid resampling method: %s. Choose one of %s" %
+                     (method, METHODS))
+
+def resample_nearest(data, lines, cols, noData):
+    """
+    Resample an array using the value of the nearest source pixel.
+
+    See the 'resample' function for a description of the arguments.
+    """
+
+    valid = ~(np.isnan(lines) | np.isnan(cols))
+    result = np.empty(lines.shape, dtype=data.dtype)
+    result[~valid] = noData
+    # rounding half up, unlike np.rint, does not depend on the parity of
+    # the indexes, so results don't change when reading a window
+    nearestLines = np.clip(np.floor(lines[valid] + 0.5).astype(np.intp), 0,
+                           data.shape[0] - 1)
+    nearestCols = np.clip(np.floor(cols[valid] + 0.5).astype(np.intp), 0,
+                          data.shape[1] - 1)
+    result[valid] = data[nearestLines, nearestCols]
+    return result
+
+def resample_bilinear(data, lines, cols, noData):
+    """
+    Resample an array by bilinear interpolation of the four nearest pixels.
+
+    Source pixels with no data are left out of the interpolation and the
+    weights of the remaining pixels are normalized accordingly. The result
+    has a floating point type.
+
+    See the 'resample' function for a description of the arguments.
+    """
+
+    resultType = np.promote_types(data.dtype, np.float32)
+    valid = ~(np.isnan(lines) | np.isnan(cols))
+    result = np.empty(lines.shape, dtype=resultType)
+    result[~valid] = noData
+    validLines = np.clip(lines[valid], 0, data.shape[0] - 1)
+    validCols = np.clip(cols[valid], 0, data.shape[1] - 1)
+    firstLines = np.minimum(np.floor(validLines).astype(np.intp),
+                            data.shape[0] - 2 if data.shape[0] > 1 else 0)
+    firstCols = np.minimum(np.floor(validCols).astype(np.intp),
+                           data.shape[1] - 2 if data.shape[1] > 1 else 0)
+    lineWeights = validLines - firstLines
+    colWeights = validCols - firstCols
+    values = np.zeros(validLines.shape, dtype=resultType)
+    weights = np.zeros(validLines.shape, dtype=resultType)
+    lastLine = data.shape[0] - 1
+    lastCol = data.shape[1] - 1
+    for lineOffset, lineWeight in ((0, 1 - lineWeights), (1, lineWeights)):
+        neighbourLines = np.minimum(firstLines + lineOffset, lastLine)
+        for colOffset, colWeight in ((0, 1 - colWeights), (1, colWeights)):
+            neighbourCols = np.minimum(firstCols + colOffset, lastCol)
+            neighbours = data[neighbourLines, neighbourCols]
+            weight = lineWeight * colWeight
+            weight[neighbours == noData] = 0
+            values += weight * neighbours
+            weights += weight
+    hasData = weights > 0
+    values[hasData] /= weights[hasData]
+    values[~hasData] = noData
+    result[valid] = values
+    return result
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+A persistent cache for the statistics of the arrays in HDF5 files.
+
+The statistics of an array (minimum, maximum, number of valid pixels and,
+optionally, an histogram) are stored in a JSON sidecar file, keyed by the
+path of the HDF5 file, its modification time and the name of the array.
+When a file is modified its old entries are no longer valid and the
+statistics are computed again.
+
+Several processes can share a cache: the file is updated under a lock file,
+and the entries saved by other processes are read again before saving.
+"""
+
+import os
+import json
+import time
+import errno
+import logging
+import tempfile
+from contextlib import contextmanager
+
+
+class StatsCache(object):
+
+    def __init__(self, cachePath, lockTimeout=60):
+        """
+        Inputs:
+            cachePath - path to the JSON file where the statistics are
+                        stored. It is created if it does not exist.
+            lockTimeout - number of seconds after which a lock file is
+                          considered to be left by a process that died, and
+                          is removed.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cachePath = cachePath
+        self.lockTimeout = lockTimeout
+        self._entries = None
+
+    def get(self, h5FilePath, arrayName):
+        """
+        Return the cached statistics of an array, or None if there are none.
+        """
+
+        return self._load().get(self._make_key(h5FilePath, arrayName))
+
+    def set(self, h5FilePath, arrayName, stats):
+        """
+        Store the statistics of an array and save the cache to disk.
+
+        Inputs:
+            h5FilePath - path to the HDF5 file.
+            arrayName - name of the array.
+            stats - a dictionary with the statistics. Its values must be
+                    serializable as JSON.
+        """
+
+        with self._locked():
+            # merged with the entries saved by other processes
+            self._entries = None
+            entries = self._load()
+            staleKeys = [k for k in entries.keys() if
+                         k.startswith(self._make_prefix(h5FilePath)) and
+                         not k.startswith(self._make_prefix(h5FilePath,
+                                                            True))]
+            for key in staleKeys:
+                del entries[key]
+            entries[self._make_key(h5FilePath, arrayName)] = stats
+            self._save()
+
+    def _make_prefix(self, h5FilePath, withMtime=False):
+        prefix = "%s|" % os.path.abspath(h5FilePath)
+        if withMtime:
+            prefix += "%r|" % os.path.getmtime(h5FilePath)
+        return prefix
+
+    def _make_key(self, h5FilePath, arrayName):
+        return "%s%s" % (self._make_prefix(h5FilePath, True), arrayName)
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = dict()
+            if os.path.isfile(self.cachePath):
+                try:
+                    fh = open(self.cachePath)
+                    try:
+                        self._entries = json.load(fh)
+                    finally:
+                        fh.close()
+                except ValueError:
+                    self.logger.warning("Ignoring invalid stats cache %s"
+                                        % self.cachePath)
+        return self._entries
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the cache's lock file while in a 'with' block.
+
+        The lock file is created exclusively, which also works on shared
+        storage without reliable file locks.
+        """
+
+        cacheDir = os.path.dirname(os.path.abspath(self.cachePath))
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        lockPath = "%s.lock" % self.cachePath
+        while True:
+            try:
+                fd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.path.getmtime(lockPath) > \
+                        self.lockTimeout:
+                    self.logger.warning("Removing stale lock %s" % lockPath)
+                    os.remove(lockPath)
+                    continue
+            except OSError:
+                # released in the meantime
+                continue
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(lockPath)
+
+    def _save(self):
+        """
+        Write the cache to disk.
+
+        The contents are written to a temporary file which is then renamed,
+        so that readers never see a partially written cache.
+        """
+
+        cacheDir = os.path.dirname(os.path.abspath(self.cachePath))
+        fd, tempPath = tempfile.mkstemp(dir=cacheDir, suffix=".tmp")
+        fh = os.fdopen(fd, "w")
+        try:
+            json.dump(self._entries, fh)
+        finally:
+            fh.close()
+        try:
+            os.rename(tempPath, self.cachePath)
+        except OSError:
+            # windows does not allow renaming over an existing file
+            os.remove(self.cachePath)
+            os.rename(tempPath, self.cachePath)
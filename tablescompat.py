@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+The pytables library, with the names of its 2.x API.
+
+The code uses the names of pytables 2.x, such as 'openFile' and
+'createCArray', which pytables 3.0 renamed to 'open_file', 'create_carray'
+and so on, and which the later versions no longer have. Importing this
+module adds the old names back when the installed pytables lacks them, so
+that the code runs with either version. Modules use it in place of pytables:
+
+    tables = lazy_import("tablescompat")
+"""
+
+import tables
+from tables import *
+
+# the pytables 2.x names and the pytables 3.x names they were renamed to
+RENAMED = [
+    (tables, "openFile", "open_file"),
+    (tables.File, "getNode", "get_node"),
+    (tables.File, "walkNodes", "walk_nodes"),
+    (tables.File, "createArray", "create_array"),
+    (tables.File, "createCArray", "create_carray"),
+    (tables.File, "createEArray", "create_earray"),
+    (tables.File, "createVLArray", "create_vlarray"),
+    (tables.Group, "_f_getChild", "_f_get_child"),
+]
+
+for owner, oldName, newName in RENAMED:
+    if not hasattr(owner, oldName):
+        setattr(owner, oldName, getattr(owner, newName))
+
+openFile = tables.openFile
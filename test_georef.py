@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Tests of the georeferencing code.
+
+The tests that need an HDF5 file use a small synthetic LSA-SAF file with the
+geometry of the Euro region. Run them with:
+
+    python -m unittest test_georef
+"""
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import unittest
+import threading
+
+import numpy as np
+
+import gcpfit
+import georef_hdf5
+import jobqueue
+import tablescompat as tables
+import timecube
+from h5georef import H5Georef
+from metrics import Metrics, Aggregator
+from resample import resample
+from statscache import StatsCache
+
+
+# lines, columns and the line and column of the first pixel in the MSG disk
+# of the Euro region
+EURO_REGION = (651, 1701, 50, 1550)
+
+def make_euro_file(path):
+    """
+    Create a synthetic LSA-SAF LST file with the geometry of the Euro region.
+    """
+
+    nLines, nCols, firstLine, firstCol = EURO_REGION
+    h5File = tables.openFile(path, "w")
+    try:
+        attrs = h5File.root._v_attrs
+        attrs.PRODUCT = "LST"
+        attrs.PROJECTION_NAME = "GEOS<+000.0>"
+        attrs.COFF = 1857 - firstCol
+        attrs.LOFF = 1857 - firstLine
+        attrs.CFAC = 13642337
+        attrs.LFAC = 13642337
+        values = np.arange(nLines * nCols).reshape(nLines, nCols) % 5000
+        for name, scalingFactor, missingValue in (("LST", 100.0, -8000),
+                                                  ("Q_FLAGS", 1.0, 0)):
+            arr = h5File.createArray(h5File.root, name,
+                                     values.astype(np.int16))
+            arr._v_attrs.SCALING_FACTOR = scalingFactor
+            arr._v_attrs.MISSING_VALUE = missingValue
+            arr._v_attrs.N_COLS = nCols
+            arr._v_attrs.N_LINES = nLines
+    finally:
+        h5File.close()
+
+def _find_program(name):
+    """
+    Return True if an executable program is found in the PATH.
+    """
+
+    for dirPath in os.environ.get("PATH", "").split(os.pathsep):
+        if os.access(os.path.join(dirPath, name), os.X_OK):
+            return True
+    return False
+
+
+class GeometryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempDir = tempfile.mkdtemp()
+        cls.h5FilePath = os.path.join(cls.tempDir, "Euro.h5")
+        make_euro_file(cls.h5FilePath)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempDir)
+
+    def setUp(self):
+        random.seed(0)
+        self.h5g = H5Georef(self.h5FilePath)
+
+    def test_lat_lon(self):
+        nLines, nCols = self.h5g._get_dimensions()
+        lines = [random.randint(0, nLines - 1) for i in range(200)]
+        cols = [random.randint(0, nCols - 1) for i in range(200)]
+        # the upper left corner of the full disk is off the Earth
+        lines.append(-self.h5g.loff)
+        cols.append(-self.h5g.coff)
+        lons, lats = self.h5g.get_lat_lon(lines, cols)
+        for line, col, lon, lat in zip(lines, cols, lons, lats):
+            expectedLon, expectedLat = self.h5g._get_lat_lon(line, col)
+            if expectedLon is None:
+                self.assertTrue(np.isnan(lon) and np.isnan(lat))
+            else:
+                self.assertAlmostEqual(lon, expectedLon, 9)
+                self.assertAlmostEqual(lat, expectedLat, 9)
+
+    def test_lat_lon_grid(self):
+        window = (100, 200, 30, 40)
+        lons, lats = self.h5g.get_lat_lon_grid(window)
+        self.assertEqual(lons.shape, (30, 40))
+        expectedLons, expectedLats = self.h5g.get_lat_lon(
+                np.arange(100, 130)[:, np.newaxis], np.arange(200, 240))
+        np.testing.assert_allclose(lons, expectedLons)
+        np.testing.assert_allclose(lats, expectedLats)
+
+    def test_east_north(self):
+        eastings, northings = self.h5g.get_east_north(
+                [0.0, 10.0, -10.0, 120.0, np.nan],
+                [0.0, 40.0, 40.0, 0.0, np.nan])
+        # the sub-satellite point is the origin of the GEOS coordinates
+        self.assertAlmostEqual(eastings[0], 0.0, 6)
+        self.assertAlmostEqual(northings[0], 0.0, 6)
+        self.assertTrue(eastings[1] > 0 and northings[1] > 0)
+        self.assertAlmostEqual(eastings[1], -eastings[2], 6)
+        self.assertAlmostEqual(northings[1], northings[2], 6)
+        # points that are not visible from the satellite
+        self.assertTrue(np.isnan(eastings[3:]).all())
+        self.assertTrue(np.isnan(northings[3:]).all())
+        self.assertEqual(self.h5g._get_east_north(120.0, 0.0), (None, None))
+
+    def test_east_north_cs2cs(self):
+        if not _find_program("cs2cs"):
+            # the reference implementation needs proj's cs2cs
+            return
+        lons = [-10.0, 0.0, 5.5, 20.25, 120.0]
+        lats = [35.0, 45.0, 50.5, 60.25, 0.0]
+        eastings, northings = self.h5g.get_east_north(lons, lats)
+        cs2csEastings, cs2csNorthings = self.h5g._get_east_north_cs2cs(lons,
+                                                                       lats)
+        for easting, northing, cs2csEasting, cs2csNorthing in zip(eastings,
+                northings, cs2csEastings, cs2csNorthings):
+            if cs2csEasting is None:
+                self.assertTrue(np.isnan(easting))
+            else:
+                self.assertAlmostEqual(easting, cs2csEasting, 2)
+                self.assertAlmostEqual(northing, cs2csNorthing, 2)
+
+    def test_east_north_round_trip(self):
+        lines = np.arange(0, 651, 13)[:, np.newaxis]
+        cols = np.arange(0, 1701, 17)
+        lons, lats = self.h5g.get_lat_lon(lines, cols)
+        eastings, northings = self.h5g.get_east_north(lons, lats)
+        geotransform = self.h5g.get_geotransform()
+        # the indexes of the lat lon methods are those of the pixels' centre,
+        # and their earth model differs slightly from proj's
+        pixels = (eastings - geotransform[0]) / geotransform[1] - (cols + 0.5)
+        pixelLines = (northings - geotransform[3]) / geotransform[5] - \
+                     (lines + 0.5)
+        valid = ~np.isnan(eastings)
+        self.assertTrue(valid.any())
+        self.assertTrue(np.abs(pixels[valid]).max() <= 0.06)
+        self.assertTrue(np.abs(pixelLines[valid]).max() <= 0.06)
+
+    def test_geotransform_matches_gcps(self):
+        for window in (None, (100, 300, 200, 400)):
+            if window is not None:
+                self.h5g.window = window
+            geotransform = self.h5g.get_geotransform(window)
+            firstLine, firstCol = (0, 0) if window is None else window[:2]
+            for line, col, northing, easting in \
+                    self.h5g.get_sample_coords(50):
+                pixel = (easting - geotransform[0]) / geotransform[1]
+                pixelLine = (northing - geotransform[3]) / geotransform[5]
+                self.assertTrue(abs(pixel - (col - firstCol + 0.5)) <= 0.06)
+                self.assertTrue(abs(pixelLine - (line - firstLine + 0.5)) <=
+                                0.06)
+
+    def test_window_of_smaller_array(self):
+        self.h5g.set_bbox((0.0, 40.0, 10.0, 50.0))
+        firstLine, firstCol, nLines, nCols = self.h5g.window
+        self.h5g.arrays["Q_FLAGS"]["nLines"] = firstLine + nLines // 2
+        self.assertEqual(self.h5g._get_window("LST"), self.h5g.window)
+        self.assertEqual(self.h5g._get_window("Q_FLAGS"),
+                         (firstLine, firstCol, nLines // 2, nCols))
+
+    def test_describe_file_stats(self):
+        cachePath = os.path.join(self.tempDir, "stats.json")
+        description = georef_hdf5.describe_file(self.h5FilePath, True,
+                                                StatsCache(cachePath))
+        lst = description["datasets"][0]
+        self.assertEqual(lst["name"], "LST")
+        self.assertEqual((lst["min"], lst["max"]), (0.0, 49.99))
+        self.assertEqual(lst["count"], 651 * 1701)
+        cached = StatsCache(cachePath).get(self.h5FilePath, "Q_FLAGS")
+        self.assertEqual(cached["count"], description["datasets"][1]["count"])
+
+    def test_dense_check_points_are_held_out(self):
+        cell = (100, 300, 50, 50)
+        gcp, checkPoints = self.h5g._cell_samples([cell])[cell]
+        self.assertEqual(len(checkPoints), 24)
+        self.assertFalse((checkPoints[:, :2] == gcp[:2]).all(axis=1).any())
+
+    def test_dense_samples_order(self):
+        samples, warpOptions = georef_hdf5.get_dense_samples(self.h5g, 0.1,
+                                                             2)
+        self.assertEqual(warpOptions, ["-order", "2"])
+        self.assertTrue(len(samples) >= gcpfit.num_terms(2))
+
+
+class ResampleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.array([[1, 2, 3],
+                              [4, 5, 6],
+                              [7, 8, -1]], dtype=np.int16)
+
+    def test_nearest(self):
+        lines = np.array([[0.0, 0.4], [1.6, np.nan]])
+        cols = np.array([[0.0, 1.6], [0.4, 1.0]])
+        result = resample(self.data, lines, cols, -1, "nearest")
+        self.assertEqual(result.dtype, self.data.dtype)
+        np.testing.assert_array_equal(result, [[1, 3], [7, -1]])
+
+    def test_nearest_clips_to_edges(self):
+        result = resample(self.data, np.array([-0.4, 2.4]),
+                          np.array([2.4, -0.4]), -1)
+        np.testing.assert_array_equal(result, [3, 7])
+
+    def test_nearest_rounds_half_up(self):
+        # unlike rounding half to even, it gives the same pixels whichever
+        # window of the array is read
+        result = resample(self.data, np.array([0.5, 1.5]),
+                          np.array([0.5, 1.5]), -1)
+        np.testing.assert_array_equal(result, [5, -1])
+
+    def test_bilinear(self):
+        lines = np.array([0.5, 0.0, np.nan])
+        cols = np.array([0.5, 1.5, 0.0])
+        result = resample(self.data, lines, cols, -1, "bilinear")
+        np.testing.assert_allclose(result, [3.0, 2.5, -1.0])
+
+    def test_bilinear_skips_nodata(self):
+        # the lower right pixel has no data, so it has no weight
+        result = resample(self.data, np.array([1.5]), np.array([1.5]), -1,
+                          "bilinear")
+        np.testing.assert_allclose(result, [(5 + 6 + 8) / 3.0])
+
+    def test_invalid_method(self):
+        self.assertRaises(ValueError, resample, self.data, np.zeros(1),
+                          np.zeros(1), -1, "cubic")
+
+
+class TimeCubeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.cubePath = os.path.join(self.tempDir, "cube.h5")
+        self.targetGrid = ((-10.0, 0.5, 0.0, 60.0, 0.0, -0.5), 4, 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def _cube(self, datasets=None):
+        if datasets is None:
+            datasets = {"LST" : -80.0}
+        return timecube.CubeWriter(self.cubePath, datasets, self.targetGrid,
+                                   "+proj=latlong", (0.0, 1, 2, 3, 4, 5, 6),
+                                   timeChunk=2, tileSize=2)
+
+    def _add_slot(self, cube, timestamp, value):
+        raster = cube.slot_writer().create("LST", 4, 6, "Float32",
+                self.targetGrid[0], "+proj=latlong", -80.0,
+                bandNames=["LST"])
+        raster.write_block(0, np.full((4, 6), value, dtype=np.float32))
+        raster.close()
+        cube.add_slot(timestamp, "slot_%i.h5" % timestamp)
+
+    def test_stack_output_options(self):
+        for options in ({"nativeType" : True}, {"outputProfile" : "tiled"}):
+            self.assertRaises(ValueError, georef_hdf5.stack, [], "cube.h5",
+                              None, self.tempDir, "+proj=latlong", **options)
+
+    def test_slot_timestamp(self):
+        self.assertEqual(timecube.slot_timestamp(
+                "HDF5_LSASAF_MSG_LST_Euro_201107011215"), 1309522500)
+        self.assertEqual(timecube.slot_timestamp("any.h5", "20110701121500"),
+                         1309522500)
+        self.assertRaises(ValueError, timecube.slot_timestamp, "LST.h5")
+
+    def test_series(self):
+        cube = self._cube()
+        # out of order, and across a chunk and a reopened cube
+        self._add_slot(cube, 300, 3.0)
+        self._add_slot(cube, 100, 1.0)
+        self._add_slot(cube, 200, 2.0)
+        cube.close()
+        cube = self._cube()
+        self.assertTrue(cube.has_slot(200))
+        self.assertFalse(cube.has_slot(400))
+        self._add_slot(cube, 400, 4.0)
+        cube.close()
+        timestamps, values = timecube.read_series(self.cubePath, "LST", 3, 5)
+        np.testing.assert_array_equal(timestamps, [100, 200, 300, 400])
+        np.testing.assert_array_equal(values, [1.0, 2.0, 3.0, 4.0])
+
+    def test_mismatched_cube(self):
+        self._cube().close()
+        self.assertRaises(ValueError, self._cube, {"Q_FLAGS" : 0.0})
+
+    def test_mismatched_raster(self):
+        cube = self._cube()
+        try:
+            self.assertRaises(ValueError, cube.slot_writer().create, "LST",
+                              3, 6, "Float32", self.targetGrid[0],
+                              "+proj=latlong", -80.0, bandNames=["LST"])
+        finally:
+            cube.close()
+
+
+class GcpFitTest(unittest.TestCase):
+
+    def _points(self, function, numPoints=30):
+        randomState = np.random.RandomState(0)
+        northings = randomState.uniform(4e6, 5e6, numPoints)
+        eastings = randomState.uniform(-1e6, 1e6, numPoints)
+        lines, cols = function(northings, eastings)
+        return list(zip(lines, cols, northings, eastings))
+
+    def test_num_terms(self):
+        self.assertEqual([gcpfit.num_terms(o) for o in (1, 2, 3)],
+                         [3, 6, 10])
+
+    def test_affine_fit(self):
+        points = self._points(lambda n, e: (-n / 3000.0 + 1500,
+                                            e / 3000.0 + 300))
+        fit = gcpfit.fit_polynomial(points, 1)
+        lines, cols = gcpfit.evaluate_polynomial(fit, np.array([4.5e6]),
+                                                 np.array([0.0]))
+        self.assertAlmostEqual(lines[0], 0.0, 6)
+        self.assertAlmostEqual(cols[0], 300.0, 6)
+        rmsError, maxError = gcpfit.fit_error(points, 1)
+        self.assertTrue(maxError < 1e-6)
+
+    def test_higher_order(self):
+        function = lambda n, e: (n / 3000.0 + (e / 1e6) ** 2 * 50,
+                                 e / 3000.0)
+        points = self._points(function)
+        checkPoints = self._points(function, 100)
+        self.assertTrue(gcpfit.fit_error(points, 1, checkPoints)[1] > 1.0)
+        self.assertTrue(gcpfit.fit_error(points, 2, checkPoints)[1] < 1e-6)
+
+    def test_too_few_gcps(self):
+        points = self._points(lambda n, e: (n, e), 5)
+        self.assertRaises(ValueError, gcpfit.fit_polynomial, points, 2)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_threads_keep_their_sinks(self):
+        metrics = Metrics()
+        threadAggregator = Aggregator()
+        entered = threading.Event()
+        exited = threading.Event()
+
+        def count_in_thread():
+            with metrics.using(threadAggregator):
+                entered.set()
+                # the main thread's block ends while this one is open
+                exited.wait(10)
+                metrics.count("files", 1)
+
+        thread = threading.Thread(target=count_in_thread)
+        thread.start()
+        entered.wait(10)
+        aggregator = Aggregator()
+        with metrics.using(aggregator):
+            metrics.count("files", 2)
+        exited.set()
+        thread.join()
+        metrics.count("files", 4)
+        self.assertEqual(aggregator.counters, {"files" : 2})
+        self.assertEqual(threadAggregator.counters, {"files" : 1})
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def _queues(self):
+        for name in sorted(jobqueue.QUEUES):
+            queue = jobqueue.get_queue(name, os.path.join(self.tempDir, name))
+            try:
+                yield queue
+            finally:
+                queue.close()
+
+    def _assert_counts(self, queue, pending=0, leased=0, done=0, failed=0):
+        self.assertEqual(queue.counts(), {"pending" : pending,
+                                          "leased" : leased, "done" : done,
+                                          "failed" : failed})
+
+    def test_invalid_queue(self):
+        self.assertRaises(ValueError, jobqueue.get_queue, "redis",
+                          self.tempDir)
+
+    def test_complete(self):
+        for queue in self._queues():
+            queue.submit("a.h5", {"warpedDir" : "out"})
+            queue.submit("b.h5", {"warpedDir" : "out"})
+            self._assert_counts(queue, pending=2)
+            job = queue.lease("worker", 60)
+            self.assertEqual((job.filePath, job.params, job.attempts),
+                             ("a.h5", {"warpedDir" : "out"}, 1))
+            self._assert_counts(queue, pending=1, leased=1)
+            self.assertTrue(queue.renew(job, 60))
+            self.assertTrue(queue.complete(job, {"success" : True}))
+            self._assert_counts(queue, pending=1, done=1)
+            # a job can only be completed once
+            self.assertFalse(queue.complete(job, {"success" : True}))
+            self.assertEqual(queue.lease("worker", 60).filePath, "b.h5")
+            self.assertEqual(queue.lease("worker", 60), None)
+
+    def test_retries(self):
+        for queue in self._queues():
+            queue.submit("a.h5", {}, maxAttempts=2)
+            job = queue.lease("worker", 60)
+            self.assertTrue(queue.fail(job, "first error"))
+            self._assert_counts(queue, pending=1)
+            job = queue.lease("worker", 60)
+            self.assertEqual(job.attempts, 2)
+            self.assertTrue(queue.fail(job, "second error"))
+            self._assert_counts(queue, failed=1)
+            self.assertEqual(queue.lease("worker", 60), None)
+
+    def test_expired_lease(self):
+        for queue in self._queues():
+            queue.submit("a.h5", {}, maxAttempts=2)
+            lostJob = queue.lease("dead worker", 0.05)
+            time.sleep(0.1)
+            job = queue.lease("worker", 60)
+            self.assertEqual((job.filePath, job.attempts), ("a.h5", 2))
+            # the first worker's lease is lost
+            self.assertFalse(queue.renew(lostJob, 60))
+            self.assertFalse(queue.complete(lostJob, {"success" : True}))
+            self._assert_counts(queue, leased=1)
+            self.assertTrue(queue.complete(job, {"success" : True}))
+            self._assert_counts(queue, done=1)
+
+    def test_expired_last_attempt(self):
+        for queue in self._queues():
+            queue.submit("a.h5", {}, maxAttempts=1)
+            queue.lease("dead worker", 0.05)
+            time.sleep(0.1)
+            self.assertEqual(queue.lease("worker", 60), None)
+            self._assert_counts(queue, failed=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
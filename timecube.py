@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Time series cubes of the warped datasets of many slots of a region.
+
+Instead of a file for each slot and dataset, the slots are stacked in a
+single HDF5 file, with an array for each dataset, shaped (time, lines,
+columns), along with the index of the slots' timestamps:
+
+    /<dataset>  float32 array with the warped values of the dataset. Its
+                MISSING_VALUE attribute holds the value of the pixels with
+                no data.
+    /time       int64 array with the timestamp of each slot, in seconds
+                since 1970-01-01 00:00:00 UTC.
+    /files      the name of the HDF5 file of each slot.
+    /x, /y      the coordinates of the centre of the pixels' columns and
+                lines, in the cube's projection.
+
+The root's attributes hold, as JSON, the names of the datasets, the GDAL
+geotransform, the projection string and the geometry key of the region (see
+H5Georef's 'geometry_key' method).
+
+The arrays are chunked in tiles of a few pixels by many slots, and
+compressed, so that reading the time series of a pixel reads a single chunk
+for each 'timeChunk' slots. To write whole chunks, the slots are buffered
+in memory, which takes 'timeChunk' times the size of a warped dataset, and
+written when the buffer is full. New slots can be appended to an existing
+cube of the same region, grid and datasets.
+"""
+
+import os
+import re
+import json
+import time
+import calendar
+import logging
+
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+tables = lazy_import("tablescompat")
+
+TIME_UNITS = "seconds since 1970-01-01 00:00:00 UTC"
+
+def slot_timestamp(h5FilePath, acquisitionTime=None):
+    """
+    Return the timestamp of an HDF5 file's slot, in seconds since 1970 UTC.
+
+    Inputs:
+        h5FilePath - path to the HDF5 file.
+        acquisitionTime - the value of the file's IMAGE_ACQUISITION_TIME
+                          attribute, as 'YYYYMMDDHHMMSS', if it has one.
+                          Otherwise the slot is taken from the file's name,
+                          which LSA-SAF products end with 'YYYYMMDDHHMM'.
+    """
+
+    if acquisitionTime is not None:
+        text = acquisitionTime
+    else:
+        match = re.search(r"(\d{12})(?!.*\d{12})",
+                          os.path.basename(h5FilePath))
+        if match is None:
+            raise ValueError("Unable to find the time of the slot of %s" %
+                             h5FilePath)
+        text = match.group(1)
+    return calendar.timegm(time.strptime(text[:12], "%Y%m%d%H%M"))
+
+
+class CubeWriter(object):
+
+    def __init__(self, cubePath, datasets, targetGrid, projectionString,
+                 geometryKey, timeChunk=32, tileSize=32, complevel=4):
+        """
+        Create a cube, or open an existing one to append slots to it.
+
+        Inputs:
+            cubePath - path to the cube's HDF5 file.
+            datasets - a dictionary with the name of each dataset to stack
+                       and the value of its pixels with no data.
+            targetGrid - a tuple with a GDAL geotransform, the number of
+                         lines and the number of columns of the warped
+                         datasets.
+            projectionString - the projection string of the target grid.
+            geometryKey - the geometry key of the region's HDF5 files.
+            timeChunk - the number of slots of each chunk.
+            tileSize - the number of lines and columns of each chunk.
+            complevel - the zlib compression level, from 0 to 9.
+
+        An existing cube must have the same datasets, target grid,
+        projection and geometry key. Otherwise a ValueError is raised.
+        """
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cubePath = cubePath
+        self.geotransform, self.nLines, self.nCols = targetGrid
+        self.datasets = dict(datasets)
+        self.timeChunk = timeChunk
+        self.header = {"datasets" : sorted(self.datasets),
+                       "geotransform" : list(self.geotransform),
+                       "projection" : projectionString,
+                       "geometryKey" : list(geometryKey)}
+        if os.path.isfile(cubePath):
+            self.h5File = tables.openFile(cubePath, "a")
+            try:
+                self._check_cube()
+            except ValueError:
+                self.h5File.close()
+                raise
+        else:
+            self.h5File = tables.openFile(cubePath, "w")
+            self._create_cube(tileSize, complevel)
+        self.timestamps = set(int(t) for t in self.h5File.root.time[:])
+        # the slots that are not yet written to the cube
+        self.buffers = dict((name, np.empty((timeChunk, self.nLines,
+                             self.nCols), dtype=np.float32)) for name in
+                            self.datasets)
+        self.bufferedTimes = []
+        self.bufferedFiles = []
+
+    def _create_cube(self, tileSize, complevel):
+        self.logger.debug("Creating %s" % self.cubePath)
+        root = self.h5File.root
+        for key, value in self.header.items():
+            root._v_attrs[key.upper()] = json.dumps(value)
+        filters = tables.Filters(complevel=complevel, complib="zlib",
+                                 shuffle=True)
+        chunkshape = (self.timeChunk, min(tileSize, self.nLines),
+                      min(tileSize, self.nCols))
+        for name, noData in self.datasets.items():
+            arr = self.h5File.createEArray(root, name,
+                    tables.Float32Atom(dflt=noData),
+                    (0, self.nLines, self.nCols), filters=filters,
+                    chunkshape=chunkshape)
+            arr._v_attrs.MISSING_VALUE = noData
+        timeArray = self.h5File.createEArray(root, "time",
+                tables.Int64Atom(), (0,), chunkshape=(1024,))
+        timeArray._v_attrs.UNITS = TIME_UNITS
+        self.h5File.createVLArray(root, "files", tables.VLStringAtom())
+        xs = self.geotransform[0] + (np.arange(self.nCols) + 0.5) * \
+             self.geotransform[1]
+        ys = self.geotransform[3] + (np.arange(self.nLines) + 0.5) * \
+             self.geotransform[5]
+        self.h5File.createArray(root, "x", xs)
+        self.h5File.createArray(root, "y", ys)
+
+    def _check_cube(self):
+        root = self.h5File.root
+        for key, value in self.header.items():
+            # comparing as JSON, so that tuples and lists are equal
+            if json.loads(root._v_attrs[key.upper()]) != \
+                    json.loads(json.dumps(value)):
+                raise ValueError("%s does not match the stacked files' %s" %
+                                 (self.cubePath, key))
+
+    def has_slot(self, timestamp):
+        """
+        Return True if the cube already has a slot with the given timestamp.
+        """
+
+        return timestamp in self.timestamps
+
+    def slot_writer(self):
+        """
+        Return a writer that writes the next slot's datasets to the cube.
+
+        The writer has the interface of the rasterwriters writers, and
+        can be passed to H5Georef's 'resample' method, which must create a
+        raster for each dataset of the cube, named after the dataset. The
+        slot is only added to the cube by the 'add_slot' method.
+        """
+
+        for name, noData in self.datasets.items():
+            self.buffers[name][len(self.bufferedTimes)] = noData
+        return _SlotWriter(self, len(self.bufferedTimes))
+
+    def add_slot(self, timestamp, h5FilePath):
+        """
+        Add the slot written by the last slot writer to the cube.
+        """
+
+        self.bufferedTimes.append(timestamp)
+        self.bufferedFiles.append(os.path.basename(h5FilePath))
+        self.timestamps.add(timestamp)
+        if len(self.bufferedTimes) == self.timeChunk:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered slots to the cube.
+        """
+
+        numSlots = len(self.bufferedTimes)
+        if numSlots == 0:
+            return
+        self.logger.debug("Writing %i slots to %s" % (numSlots,
+                          self.cubePath))
+        root = self.h5File.root
+        for name, buff in self.buffers.items():
+            self.h5File.getNode(root, name).append(buff[:numSlots])
+        root.time.append(np.array(self.bufferedTimes, dtype=np.int64))
+        for fileName in self.bufferedFiles:
+            root.files.append(fileName.encode("utf-8"))
+        self.h5File.flush()
+        self.bufferedTimes = []
+        self.bufferedFiles = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.h5File.close()
+
+
+class _SlotWriter(object):
+
+    name = "cube"
+    extension = ""
+
+    def __init__(self, cube, slotIndex):
+        self.cube = cube
+        self.slotIndex = slotIndex
+
+    def create(self, path, nLines, nCols, dtype, geotransform,
+               projectionString, noData=None, numBands=1, gcps=None,
+               bandNames=None, scales=None):
+        """
+        Return the raster of a dataset in the slot.
+
+        See rasterwriters.GDALWriter's 'create' method for a description of
+        the arguments. The raster must be a single band named after one of
+        the cube's datasets, with the cube's dimensions, and hold physical
+        values.
+        """
+
+        if numBands != 1 or bandNames is None or \
+                bandNames[0] not in self.cube.buffers:
+            raise ValueError("The raster is not one of the cube's datasets")
+        if scales is not None:
+            raise ValueError("The cube only stores physical values")
+        if (nLines, nCols) != (self.cube.nLines, self.cube.nCols):
+            raise ValueError("The raster's dimensions are different from "
+                             "the cube's")
+        return _SlotRaster(self.cube.buffers[bandNames[0]][self.slotIndex])
+
+
+class _SlotRaster(object):
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def write_block(self, firstLine, block, band=1):
+        self.slot[firstLine:firstLine + block.shape[0]] = block
+
+    def close(self):
+        pass
+
+
+def read_series(cubePath, datasetName, line, col):
+    """
+    Return the time series of a pixel of a cube.
+
+    Inputs:
+        cubePath - path to the cube's HDF5 file.
+        datasetName - the name of the dataset.
+        line, col - the indexes of the pixel, starting at 0.
+
+    Returns: A tuple with a numpy array with the timestamps of the slots, in
+    seconds since 1970 UTC, and a numpy array with the pixel's values, both
+    sorted by time.
+    """
+
+    h5File = tables.openFile(cubePath)
+    try:
+        timestamps = h5File.root.time[:]
+        values = h5File.getNode(h5File.root, datasetName)[:, line, col]
+    finally:
+        h5File.close()
+    order = np.argsort(timestamps, kind="mergesort")
+    return timestamps[order], values[order]
@@ -97,11 +97,23 @@ class Ui_Form(object):
         self.horizontalLayout_2.addWidget(self.deleteIntermediaryCB)
         spacerItem5 = QtGui.QSpacerItem(40, 20, QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Minimum)
         self.horizontalLayout_2.addItem(spacerItem5)
+        self.label_5 = QtGui.QLabel(Form)
+        self.label_5.setObjectName(_fromUtf8("label_5"))
+        self.horizontalLayout_2.addWidget(self.label_5)
+        self.workersSB = QtGui.QSpinBox(Form)
+        self.workersSB.setMinimum(1)
+        self.workersSB.setMaximum(64)
+        self.workersSB.setObjectName(_fromUtf8("workersSB"))
+        self.horizontalLayout_2.addWidget(self.workersSB)
         self.verticalLayout.addLayout(self.horizontalLayout_2)
         self.progressBar = QtGui.QProgressBar(Form)
         self.progressBar.setProperty(_fromUtf8("value"), 24)
         self.progressBar.setObjectName(_fromUtf8("progressBar"))
         self.verticalLayout.addWidget(self.progressBar)
+        self.statusLabel = QtGui.QLabel(Form)
+        self.statusLabel.setText(_fromUtf8(""))
+        self.statusLabel.setObjectName(_fromUtf8("statusLabel"))
+        self.verticalLayout.addWidget(self.statusLabel)
         self.line = QtGui.QFrame(Form)
         self.line.setFrameShape(QtGui.QFrame.HLine)
         self.line.setFrameShadow(QtGui.QFrame.Sunken)
@@ -114,12 +126,16 @@ class Ui_Form(object):
         self.horizontalLayout.addWidget(self.helpPB)
         spacerItem6 = QtGui.QSpacerItem(40, 20, QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Minimum)
         self.horizontalLayout.addItem(spacerItem6)
+        self.cancelPB = QtGui.QPushButton(Form)
+        self.cancelPB.setObjectName(_fromUtf8("cancelPB"))
+        self.horizontalLayout.addWidget(self.cancelPB)
         self.processFilesPB = QtGui.QPushButton(Form)
         self.processFilesPB.setObjectName(_fromUtf8("processFilesPB"))
         self.horizontalLayout.addWidget(self.processFilesPB)
         self.verticalLayout.addLayout(self.horizontalLayout)
         self.label.setBuddy(self.inputFilesLE)
         self.label_3.setBuddy(self.outputDirLE)
+        self.label_5.setBuddy(self.workersSB)
 
         self.retranslateUi(Form)
         QtCore.QMetaObject.connectSlotsByName(Form)
@@ -131,8 +147,10 @@ class Ui_Form(object):
         Form.setTabOrder(self.customProjectionTE, self.outputDirLE)
         Form.setTabOrder(self.outputDirLE, self.outputDirPB)
         Form.setTabOrder(self.outputDirPB, self.deleteIntermediaryCB)
-        Form.setTabOrder(self.deleteIntermediaryCB, self.processFilesPB)
-        Form.setTabOrder(self.processFilesPB, self.helpPB)
+        Form.setTabOrder(self.deleteIntermediaryCB, self.workersSB)
+        Form.setTabOrder(self.workersSB, self.processFilesPB)
+        Form.setTabOrder(self.processFilesPB, self.cancelPB)
+        Form.setTabOrder(self.cancelPB, self.helpPB)
 
     def retranslateUi(self, Form):
         Form.setWindowTitle(QtGui.QApplication.translate("Form", "HDF5 Georeferencer", None, QtGui.QApplication.UnicodeUTF8))
@@ -146,6 +164,8 @@ class Ui_Form(object):
         self.label_3.setText(QtGui.QApplication.translate("Form", "Output directory", None, QtGui.QApplication.UnicodeUTF8))
         self.outputDirPB.setText(QtGui.QApplication.translate("Form", "Browse...", None, QtGui.QApplication.UnicodeUTF8))
         self.deleteIntermediaryCB.setText(QtGui.QApplication.translate("Form", "Delete intermediary files", None, QtGui.QApplication.UnicodeUTF8))
+        self.label_5.setText(QtGui.QApplication.translate("Form", "Parallel workers", None, QtGui.QApplication.UnicodeUTF8))
         self.helpPB.setText(QtGui.QApplication.translate("Form", "Help", None, QtGui.QApplication.UnicodeUTF8))
+        self.cancelPB.setText(QtGui.QApplication.translate("Form", "Cancel", None, QtGui.QApplication.UnicodeUTF8))
         self.processFilesPB.setText(QtGui.QApplication.translate("Form", "Process files", None, QtGui.QApplication.UnicodeUTF8))
 